@@ -0,0 +1,250 @@
+from sqlite3 import Connection
+from datetime import datetime
+from openai import OpenAI
+from openai.types.chat import ChatCompletion
+import json
+import pathlib
+import shutil
+import time
+import uuid
+
+from utils import read_sql_file, create_dir_if_not_exist
+from db_writer import transaction
+
+BATCH_DIR = "batch"
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+# Batch statuses after which the batch will not change anymore
+TERMINAL_STATUSES = set(["completed", "failed", "expired", "cancelled"])
+
+def batch_request(custom_id: str, model: str, messages: list[dict[str, str]], json_enabled: bool = True, max_tokens: int = 2048) -> dict:
+	"""
+	Builds one line of a batch file, with the same body `llm_chat` would send.
+	"""
+	return {
+		"custom_id": custom_id,
+		"method": "POST",
+		"url": CHAT_COMPLETIONS_URL,
+		"body": {
+			"model": model,
+			"messages": messages,
+			"response_format": {"type": "json_object"} if json_enabled else None,
+			"temperature": 1,
+			"max_tokens": max_tokens,
+		},
+	}
+
+def write_batch_file(path: str, requests: list[dict]):
+	create_dir_if_not_exist(str(pathlib.Path(path).parent))
+	with open(path, "w", encoding="utf-8") as file:
+		for request in requests:
+			file.write(json.dumps(request, ensure_ascii=False) + "\n")
+
+def read_batch_results(path: str) -> dict:
+	"""
+	Reads a batch result file.
+
+	Returns:
+		dict[str, ChatCompletion | str]: The response to each request by custom_id, or
+		the error it failed with.
+	"""
+	results = {}
+	with open(path, encoding="utf-8") as file:
+		for line in file:
+			if not line.strip():
+				continue
+			result = json.loads(line)
+			response = result.get("response") or {}
+			if result.get("error") is not None:
+				results[result["custom_id"]] = str(result["error"].get("message", result["error"]))
+			elif response.get("status_code") != 200:
+				results[result["custom_id"]] = f"HTTP {response.get('status_code')}: {json.dumps(response.get('body'))}"
+			else:
+				results[result["custom_id"]] = ChatCompletion.model_validate(response["body"])
+	return results
+
+def get_content(result) -> str:
+	"""
+	Returns the content of a batch response.
+
+	Raises:
+		RuntimeError: If the request failed or the response was cut off.
+	"""
+	if result is None:
+		raise RuntimeError("No result for the request")
+	if isinstance(result, str):
+		raise RuntimeError(result)
+	if result.choices[0].finish_reason == "length":
+		raise RuntimeError("LLM response was cut off, check the max_tokens parameter.")
+	return result.choices[0].message.content
+
+class OpenAIBatchEndpoint:
+	"""
+	The batch API of the provider, which processes a batch file within the completion window.
+	"""
+
+	def __init__(self, client: OpenAI, completion_window: str = "24h"):
+		self.client = client
+		self.completion_window = completion_window
+
+	def submit(self, input_path: str) -> str:
+		with open(input_path, "rb") as file:
+			input_file = self.client.files.create(file=file, purpose="batch")
+		batch = self.client.batches.create(input_file_id=input_file.id, endpoint=CHAT_COMPLETIONS_URL, completion_window=self.completion_window)
+		return batch.id
+
+	def get_status(self, batch_id: str) -> str:
+		return self.client.batches.retrieve(batch_id).status
+
+	def download(self, batch_id: str, output_path: str):
+		batch = self.client.batches.retrieve(batch_id)
+		with open(output_path, "w", encoding="utf-8") as file:
+			for file_id in [batch.output_file_id, batch.error_file_id]:
+				if file_id is not None:
+					file.write(self.client.files.content(file_id).text)
+
+class LocalBatchEndpoint:
+	"""
+	A file-based stand-in for the batch API, e.g. to test batch mode against the mock
+	server. Submitted files are copied under `directory`, and processed request by request
+	through the chat API of `client` the first time the status of the batch is checked.
+	"""
+
+	def __init__(self, client: OpenAI, directory: str = f"{BATCH_DIR}/local"):
+		self.client = client
+		self.directory = directory
+
+	def _path(self, batch_id: str, name: str) -> pathlib.Path:
+		return pathlib.Path(self.directory) / batch_id / name
+
+	def submit(self, input_path: str) -> str:
+		batch_id = f"batch_{uuid.uuid4().hex}"
+		create_dir_if_not_exist(str(self._path(batch_id, "")))
+		shutil.copyfile(input_path, self._path(batch_id, "input.jsonl"))
+		self._path(batch_id, "status").write_text("in_progress")
+		return batch_id
+
+	def _process(self, batch_id: str):
+		with open(self._path(batch_id, "input.jsonl"), encoding="utf-8") as input_file, \
+			open(self._path(batch_id, "output.jsonl"), "w", encoding="utf-8") as output_file:
+			for line in input_file:
+				if not line.strip():
+					continue
+				request = json.loads(line)
+				result = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "response": None, "error": None}
+				try:
+					response = self.client.chat.completions.create(**request["body"])
+					result["response"] = {"status_code": 200, "body": response.model_dump()}
+				except Exception as e:
+					result["response"] = {"status_code": getattr(e, "status_code", 500), "body": {"error": {"message": str(e)}}}
+				output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+		self._path(batch_id, "status").write_text("completed")
+
+	def get_status(self, batch_id: str) -> str:
+		if self._path(batch_id, "status").read_text() == "in_progress":
+			self._process(batch_id)
+		return self._path(batch_id, "status").read_text()
+
+	def download(self, batch_id: str, output_path: str):
+		shutil.copyfile(self._path(batch_id, "output.jsonl"), output_path)
+
+def load_batch_endpoint(config: dict, client: OpenAI):
+	"""
+	Creates the batch endpoint described by the `batch` section of `config.json`.
+
+	```json
+	"batch": {
+		"endpoint": "openai",
+		"directory": "batch",
+		"completion-window": "24h",
+		"wait": false,
+		"poll-interval": 60
+	}
+	```
+
+	`"endpoint": "local"` processes the batch files through the chat API of the client
+	instead (see `LocalBatchEndpoint`).
+	"""
+	batch_config = config.get("batch", {})
+	if batch_config.get("endpoint", "openai") == "local":
+		return LocalBatchEndpoint(client, f"{batch_config.get('directory', BATCH_DIR)}/local")
+	return OpenAIBatchEndpoint(client, batch_config.get("completion-window", "24h"))
+
+def save_batch_job(connection: Connection, job: dict):
+	with transaction(connection):
+		connection.execute(
+			read_sql_file("src/queries/upsert-batch-job.sql"),
+			(job["job_id"], job["kind"], job["status"], job["endpoint_batch_id"], job["input_path"], job["output_path"], json.dumps(job["items"])),
+		)
+
+def get_open_batch_jobs(connection: Connection, kind: str) -> list[dict]:
+	"""
+	Returns the jobs of a kind that were submitted but not ingested yet.
+	"""
+	keys = ["job_id", "kind", "status", "endpoint_batch_id", "input_path", "output_path", "items"]
+	jobs = [dict(zip(keys, row)) for row in connection.execute(read_sql_file("src/queries/select-open-batch-jobs.sql"), (kind,))]
+	for job in jobs:
+		job["items"] = json.loads(job["items"])
+	return jobs
+
+def submit_batch_job(connection: Connection, endpoint, kind: str, requests: list[dict], items: dict, directory: str = BATCH_DIR) -> dict:
+	"""
+	Writes the requests to a batch file, submits it and records the job.
+
+	Args:
+		connection (Connection): The connection to the database tracking the jobs.
+		endpoint (OpenAIBatchEndpoint | LocalBatchEndpoint): The batch endpoint.
+		kind (str): "extraction" or "classification".
+		requests (list[dict]): The lines of the batch file (see `batch_request`).
+		items (dict): What the requests were made for, as needed to ingest their results.
+		directory (str, optional): The directory of the batch files.
+
+	Returns:
+		dict: The job.
+	"""
+	job_id = f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+	job = {
+		"job_id": job_id,
+		"kind": kind,
+		"status": "submitted",
+		"endpoint_batch_id": None,
+		"input_path": f"{directory}/{job_id}-input.jsonl",
+		"output_path": f"{directory}/{job_id}-output.jsonl",
+		"items": items,
+	}
+	write_batch_file(job["input_path"], requests)
+	job["endpoint_batch_id"] = endpoint.submit(job["input_path"])
+	save_batch_job(connection, job)
+	return job
+
+def collect_batch_job(connection: Connection, endpoint, job: dict, wait: bool = False, poll_interval: float = 60):
+	"""
+	Downloads the results of a job once its batch is complete.
+
+	Args:
+		wait (bool, optional): Whether to wait for the batch to complete, instead of
+			returning None if it is still running.
+		poll_interval (float, optional): The seconds between two status checks.
+
+	Returns:
+		dict[str, ChatCompletion | str] | None: The results (see `read_batch_results`), or
+		None if the batch is still running or did not complete, in which case the job
+		is marked as failed.
+	"""
+	status = endpoint.get_status(job["endpoint_batch_id"])
+	while wait and status not in TERMINAL_STATUSES:
+		time.sleep(poll_interval)
+		status = endpoint.get_status(job["endpoint_batch_id"])
+
+	if status not in TERMINAL_STATUSES:
+		print(f"Batch job {job['job_id']} is still {status}.")
+		return None
+	if status != "completed":
+		print(f"Warning: Batch job {job['job_id']} is {status}.")
+		save_batch_job(connection, {**job, "status": "failed"})
+		return None
+
+	endpoint.download(job["endpoint_batch_id"], job["output_path"])
+	return read_batch_results(job["output_path"])
+
+def finish_batch_job(connection: Connection, job: dict):
+	save_batch_job(connection, {**job, "status": "ingested"})
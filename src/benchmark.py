@@ -0,0 +1,245 @@
+from latex_frontend import markdown2latex, RENDERER_VERSION
+from compile_paper import render_stems, compose_paper, write_document
+from db_writer import connect, prepare_database, transaction, write_syllabus, BulkWriter
+from exercise_queries import select_exercises
+from synthetic_corpus import generate_syllabus, generate_papers
+from utils import create_dir_if_not_exist
+from datetime import datetime
+import itertools
+import json
+import pathlib
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = "benchmarks"
+
+def percentile(values: list[float], p: float) -> float:
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def summarise_latencies(latencies: list[float]) -> dict:
+	"""
+	Summarises latencies in seconds as milliseconds.
+	"""
+	return {
+		"runs": len(latencies),
+		"mean_ms": sum(latencies) / len(latencies) * 1000,
+		"p50_ms": percentile(latencies, 50) * 1000,
+		"p95_ms": percentile(latencies, 95) * 1000,
+		"max_ms": max(latencies) * 1000,
+	}
+
+def bench_markdown2latex(stems: list[str]) -> dict:
+	"""
+	Measures the single-process throughput of `markdown2latex`.
+	"""
+	start = time.perf_counter()
+	for stem in stems:
+		markdown2latex(stem)
+	seconds = time.perf_counter() - start
+	size = sum(len(stem.encode("utf-8")) for stem in stems)
+	return {
+		"stems": len(stems),
+		"seconds": seconds,
+		"stems_per_second": len(stems) / seconds,
+		"mb_per_second": size / seconds / 1024 / 1024,
+	}
+
+def bench_ingest(db_path: str, syllabus: list[dict], papers) -> dict:
+	"""
+	Measures the ingest of generated papers through the writer thread of
+	`construct_exercise_db`, in exercise and matching rows per second.
+	"""
+	connection = connect(db_path)
+	prepare_database(connection)
+	with transaction(connection):
+		write_syllabus(connection, syllabus)
+	connection.close()
+
+	exercises = 0
+	matchings = 0
+	start = time.perf_counter()
+	with BulkWriter(db_path) as writer:
+		writes = []
+		for paper in papers:
+			exercises += len(paper["exercises"])
+			matchings += len(paper["matchings"])
+			writes.append(writer.write_paper(paper))
+	for write in writes:
+		write.result()
+	seconds = time.perf_counter() - start
+
+	return {
+		"papers": len(writes),
+		"exercises": exercises,
+		"matchings": matchings,
+		"seconds": seconds,
+		"rows_per_second": (exercises + matchings) / seconds,
+		"exercises_per_second": exercises / seconds,
+	}
+
+def bench_select(connection: sqlite3.Connection, syllabus: list[dict], queries: int, relevance: float = 0.5, seed: int = 0) -> dict:
+	"""
+	Measures the latency of `select-exercises-by-syllabus` for subtrees at each
+	level of the syllabus, and for the whole syllabus.
+	"""
+	rng = random.Random(seed)
+	levels = {}
+	for point in syllabus:
+		parts = point["id"].split(".")
+		for level in range(1, len(parts) + 1):
+			levels.setdefault(level, set()).add(".".join(parts[:level]))
+
+	results = {}
+	for (level, subtrees) in sorted(levels.items()):
+		subtrees = sorted(subtrees)
+		latencies = []
+		rows = 0
+		for _ in range(queries):
+			start = time.perf_counter()
+			rows += len(select_exercises(connection, [rng.choice(subtrees)], relevance).fetchall())
+			latencies.append(time.perf_counter() - start)
+		results[f"level_{level}"] = {**summarise_latencies(latencies), "mean_rows": rows / queries}
+
+	latencies = []
+	for _ in range(max(1, queries // 10)):
+		start = time.perf_counter()
+		rows = len(select_exercises(connection, [], relevance).fetchall())
+		latencies.append(time.perf_counter() - start)
+	results["all"] = {**summarise_latencies(latencies), "mean_rows": rows}
+	return results
+
+def bench_compile(connection: sqlite3.Connection, subtrees: list[str], relevance: float = 0.5) -> dict:
+	"""
+	Measures the LaTeX generation of `compile_paper`, from the selection to the
+	document, with a cold and then a warm rendering cache, and then through the
+	streaming writer into a file.
+	"""
+	connection.execute("DELETE FROM rendered_latex WHERE renderer_version = ?", (RENDERER_VERSION,))
+
+	results = {}
+	for run in ["cold", "warm"]:
+		start = time.perf_counter()
+		rows = select_exercises(connection, subtrees, relevance).fetchall()
+		selected = time.perf_counter()
+		descriptions = render_stems(connection, [row[1] for row in rows])
+		rendered = time.perf_counter()
+		latex = compose_paper([{"id": row[0], "description": description, "relevance": row[2]} for (row, description) in zip(rows, descriptions)])
+		composed = time.perf_counter()
+		results[run] = {
+			"exercises": len(rows),
+			"select_seconds": selected - start,
+			"render_seconds": rendered - selected,
+			"compose_seconds": composed - rendered,
+			"seconds": composed - start,
+			"latex_bytes": len(latex.encode("utf-8")),
+		}
+
+	# The streaming writer used by `compile_paper`, with a warm cache
+	with tempfile.TemporaryDirectory() as directory:
+		latex_file = pathlib.Path(directory) / "paper.tex"
+		start = time.perf_counter()
+		exercises = write_document(connection, select_exercises(connection, subtrees, relevance), str(latex_file))
+		results["stream"] = {
+			"exercises": exercises,
+			"seconds": time.perf_counter() - start,
+			"latex_bytes": latex_file.stat().st_size if exercises else 0,
+		}
+	return results
+
+def run_benchmarks(exercise_count: int, seed: int = 0, markdown_sample: int = 2000, select_queries: int = 50) -> dict:
+	"""
+	Runs every benchmark on a synthetic corpus.
+
+	Args:
+		exercise_count (int): The number of generated exercises, e.g. 1000 to 1000000.
+		seed (int, optional): The seed of the corpus generator.
+		markdown_sample (int, optional): The number of stems rendered by the
+			`markdown2latex` benchmark.
+		select_queries (int, optional): The number of selections per syllabus level.
+
+	Returns:
+		dict: The run metadata and the results of each benchmark.
+	"""
+	syllabus = generate_syllabus(seed=seed)
+	results = {
+		"meta": {
+			"timestamp": datetime.now().isoformat(timespec="seconds"),
+			"exercise_count": exercise_count,
+			"seed": seed,
+			"python": platform.python_version(),
+			"sqlite": sqlite3.sqlite_version,
+			"platform": platform.platform(),
+			"renderer_version": RENDERER_VERSION,
+		}
+	}
+
+	stems = [
+		exercise["stem"]
+		for paper in generate_papers(min(markdown_sample, exercise_count), syllabus, seed=seed)
+		for exercise in paper["exercises"]
+	]
+	print(f"Rendering {len(stems)} stems...")
+	results["markdown2latex"] = bench_markdown2latex(stems)
+
+	with tempfile.TemporaryDirectory() as directory:
+		db_path = str(pathlib.Path(directory) / "benchmark.db")
+		print(f"Ingesting {exercise_count} exercises...")
+		results["ingest"] = bench_ingest(db_path, syllabus, generate_papers(exercise_count, syllabus, seed=seed))
+
+		connection = connect(db_path)
+		connection.execute("ANALYZE")
+		print("Selecting exercises...")
+		results["select"] = bench_select(connection, syllabus, select_queries, seed=seed)
+		print("Generating a paper...")
+		results["compile"] = bench_compile(connection, [syllabus[0]["id"].rsplit(".", 1)[0]])
+		connection.close()
+
+	return results
+
+def save_results(results: dict, directory: str = BENCHMARK_DIR) -> str:
+	create_dir_if_not_exist(directory)
+	path = pathlib.Path(directory) / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{results['meta']['exercise_count']}.json"
+	path.write_text(json.dumps(results, indent=2))
+	return str(path)
+
+def flatten(results: dict, prefix: str = "") -> dict:
+	flat = {}
+	for (key, value) in results.items():
+		if isinstance(value, dict):
+			flat.update(flatten(value, f"{prefix}{key}."))
+		elif isinstance(value, (int, float)) and not isinstance(value, bool):
+			flat[prefix + key] = value
+	return flat
+
+def compare_results(base: dict, head: dict):
+	"""
+	Prints the metrics of two runs side by side, with the ratio of the second to the first.
+	"""
+	(base, head) = (flatten(base), flatten(head))
+	width = max(len(key) for key in itertools.chain(base, head))
+	for key in base:
+		if key not in head or key.startswith("meta."):
+			continue
+		ratio = f"{head[key] / base[key]:.2f}x" if base[key] else "-"
+		print(f"{key:<{width}}  {base[key]:>14.3f}  {head[key]:>14.3f}  {ratio:>8}")
+
+if __name__ == "__main__":
+	# python src/benchmark.py [exercise-count] [seed]
+	# python src/benchmark.py compare <base.json> <head.json>
+	if len(sys.argv) > 1 and sys.argv[1] == "compare":
+		if len(sys.argv) != 4:
+			print("Usage: python src/benchmark.py compare <base.json> <head.json>")
+			exit(1)
+		compare_results(*[json.loads(pathlib.Path(path).read_text()) for path in sys.argv[2:4]])
+		exit(0)
+
+	exercise_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+	results = run_benchmarks(exercise_count, seed)
+	print(json.dumps(results, indent=2))
+	print("Saved the results to: ", save_results(results))
@@ -1,6 +1,13 @@
-from latex_frontend import markdown2latex
+from latex_frontend import markdown2latex, RENDERER_VERSION
 from utils import read_sql_file, create_dir_if_not_exist
+from exercise_queries import select_exercises, parse_subtrees
+from db_writer import connect, prepare_database, transaction
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
 import subprocess
+import getpass
+import hashlib
+import json
 import os
 from datetime import datetime
 import pathlib
@@ -35,27 +42,104 @@ def compile_latex(latex_file: str, output_dir: str = None):
 		capture_output=True  # Capture output for debugging
 	)
 
+def get_stem_hash(stem: str):
+	return hashlib.sha256(stem.encode("utf-8")).hexdigest()
+
+def render_stems(connection: Connection, stems: list[str], workers: int = None, parallel_threshold: int = 32, executor: ProcessPoolExecutor = None):
+	"""
+	Renders Markdown stems to LaTeX, reusing the LaTeX cached in the database.
+
+	Stems are cached by their hash and the renderer version, so unchanged stems are
+	never rendered twice. Cache misses are rendered across a process pool when there
+	are enough of them to outweigh its start-up cost, and stored for the next time.
+
+	Args:
+		connection (Connection): The connection to the exercise database.
+		stems (list[str]): The Markdown stems to render.
+		workers (int, optional): The number of rendering processes. Defaults to the
+			number of CPUs.
+		parallel_threshold (int, optional): The minimum number of cache misses to
+			render in parallel.
+		executor (ProcessPoolExecutor, optional): The process pool to render with,
+			e.g. to reuse it across calls. One is created for the call otherwise.
+
+	Returns:
+		list[str]: The LaTeX of each stem, in order.
+	"""
+	hashes = [get_stem_hash(stem) for stem in stems]
+	query = read_sql_file("src/queries/select-rendered-latex.sql")
+	rendered = dict(connection.execute(query, (RENDERER_VERSION, json.dumps(list(set(hashes))))).fetchall())
+
+	misses = {}
+	for (stem_hash, stem) in zip(hashes, stems):
+		if stem_hash not in rendered:
+			misses[stem_hash] = stem
+
+	if misses:
+		if len(misses) >= parallel_threshold and executor is not None:
+			results = list(executor.map(markdown2latex, misses.values(), chunksize=16))
+		elif len(misses) >= parallel_threshold:
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				results = list(executor.map(markdown2latex, misses.values(), chunksize=16))
+		else:
+			results = [markdown2latex(stem) for stem in misses.values()]
+		rendered.update(zip(misses.keys(), results))
+
+		with transaction(connection):
+			connection.executemany(
+				read_sql_file("src/queries/insert-rendered-latex.sql"),
+				[(stem_hash, RENDERER_VERSION, rendered[stem_hash]) for stem_hash in misses],
+			)
+
+	return [rendered[stem_hash] for stem_hash in hashes]
+
 def into_minipage(latex_code: str):
 	return f"\\begin{{minipage}}{{\\textwidth}}\n{latex_code.strip()}\n\\end{{minipage}}"
 
-def remove_redundant_newline(latex_content):
-	double_newline = re.compile(r'(\\newline|\\\\)\s*(\\newline|\\\\)')
-	newline_after_section = re.compile(r"(\\section\{[^\}]*\})\s*(\\newline|\\\\)")
-	newline_after_end = re.compile(r"(\\end\{[^\}]*\})\s*(\\newline|\\\\)")
+LINE_BREAK = r"(?:\\newline|\\\\)"
+LINE_BREAK_PAIR_PATTERN = re.compile(rf"{LINE_BREAK}\s*{LINE_BREAK}")
+LINE_BREAK_RUN_PATTERN = re.compile(rf"{LINE_BREAK}(?:\s*{LINE_BREAK})+")
+# A maximal stretch of backslashes, whitespace and `newline`s after a backslash
+# holding at least two line breaks
+LINE_BREAK_CLUSTER_PATTERN = re.compile(rf"(?<![\\\s])(?<!\\newline)(?:\\|\s|(?<=\\)newline)*?{LINE_BREAK}\s*{LINE_BREAK}(?:\\|\s|(?<=\\)newline)*")
+NEWLINE_AFTER_SECTION_PATTERN = re.compile(rf"(\\section\{{[^\}}]*\}})(?:\s*{LINE_BREAK})+")
+NEWLINE_AFTER_END_PATTERN = re.compile(rf"(\\end\{{[^\}}]*\}})(?:\s*{LINE_BREAK})+")
 
-	while double_newline.search(latex_content):
-		latex_content = double_newline.sub("\\\\newline", latex_content)
+def collapse_line_breaks(match: re.Match) -> str:
+	"""
+	Collapses a cluster of line breaks into one `\\newline`.
 
-	while newline_after_section.search(latex_content):
-		latex_content = newline_after_section.sub("\\1\n", latex_content)
+	Stray backslashes (e.g. from `\\\\\\parbox`) pair up with the line breaks around
+	them, and the result depends on the order in which pairs were collapsed so far.
+	A trailing stray backslash cannot pair with anything after it, so only clusters
+	with a stray backslash inside are collapsed pair by pair, as before. This only
+	touches the cluster, and each round halves its line breaks.
+	"""
+	cluster = match.group(0)
+	inner = cluster[:-1] if cluster.endswith("\\") else cluster
+	if "\\\\\\" not in inner and "\\\\newline" not in inner:
+		return LINE_BREAK_RUN_PATTERN.sub(r"\\newline", cluster)
+	while LINE_BREAK_PAIR_PATTERN.search(cluster):
+		cluster = LINE_BREAK_PAIR_PATTERN.sub(r"\\newline", cluster)
+	return cluster
 
-	while newline_after_end.search(latex_content):
-		latex_content = newline_after_end.sub("\\1\n", latex_content)
+def remove_redundant_newline(latex_content):
+	"""
+	Collapses consecutive line breaks into one, and drops the line breaks right
+	after a section or the end of an environment. Each pattern scans the document once.
+	"""
+	latex_content = LINE_BREAK_CLUSTER_PATTERN.sub(collapse_line_breaks, latex_content)
+	latex_content = NEWLINE_AFTER_SECTION_PATTERN.sub("\\1\n", latex_content)
+	return NEWLINE_AFTER_END_PATTERN.sub("\\1\n", latex_content)
 
-	return latex_content
+def get_author():
+	try:
+		return os.getlogin()
+	except OSError:
+		# No controlling terminal, e.g. under cron or in a container
+		return getpass.getuser()
 
-def into_document(latex_code: str, title: str):
-	latex_content = f"""
+DOCUMENT_HEAD = """
 \\documentclass{{article}}
 \\usepackage[a4paper, margin=1in]{{geometry}}
 \\usepackage{{caption}}
@@ -64,7 +148,7 @@ def into_document(latex_code: str, title: str):
 \\usepackage{{hyperref}}
 
 \\title{{{title}}}
-\\author{{{os.getlogin()}}}
+\\author{{{author}}}
 \\date{{\\today}}
 
 \\begin{{document}}
@@ -73,10 +157,149 @@ def into_document(latex_code: str, title: str):
 \\maketitle
 \\newpage
 \\pdfbookmark[1]{{Questions}}{{questions}}
-{latex_code.strip()}
-\\end{{document}}
 """
-	return remove_redundant_newline(latex_content.strip())
+DOCUMENT_TAIL = "\n\\end{document}"
+
+def iter_unique(items, key):
+	"""
+	Yields the items whose key was not seen before, in order. Only the keys are kept,
+	so memory does not grow with the stems or the LaTeX of the items.
+	"""
+	seen = set()
+	for item in items:
+		item_key = key(item)
+		if item_key not in seen:
+			seen.add(item_key)
+			yield item
+
+def iter_chunks(items, size: int):
+	items = iter(items)
+	while chunk := list(islice(items, size)):
+		yield chunk
+
+def iter_rendered(connection: Connection, rows, chunk_size: int = 256, workers: int = None):
+	"""
+	Renders the stems of selected rows to LaTeX chunk by chunk (see `render_stems`),
+	so that only one chunk of stems is held at a time. The process pool is shared by
+	the chunks, and only started if a chunk has enough cache misses.
+
+	Args:
+		connection (Connection): The connection to the exercise database.
+		rows: The rows (id, stem, relevance, cluster) of the exercises, e.g. a cursor
+			returned by `select_exercises`.
+		chunk_size (int, optional): The number of stems rendered at a time.
+		workers (int, optional): The number of rendering processes.
+
+	Yields:
+		dict: The `id`, LaTeX `description`, `relevance` and `cluster` of each exercise.
+	"""
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		for chunk in iter_chunks(rows, chunk_size):
+			descriptions = render_stems(connection, [row[1] for row in chunk], executor=executor)
+			for (row, description) in zip(chunk, descriptions):
+				yield {"id": row[0], "description": description, "relevance": row[2], "cluster": row[3]}
+
+def iter_fragments(matched):
+	"""
+	Yields the LaTeX of each matched exercise, in a minipage numbered in order.
+	"""
+	for (counter, item) in enumerate(matched, start=1):
+		meta = item["id"].split("-")
+		header = f"[{meta[0]}/{meta[1]}/{meta[2]}/{'-'.join(meta[3:])}]"
+		content = f"\\textbf{{{str(counter)}.}} {item['description'].strip()}"
+		fragment = f"\\pdfbookmark[2]{{{counter}. {header}}}{{question-{counter}}}"
+		fragment += into_minipage(f"\\texttt{{{header}}} \\newline\n{content}\n\n")
+		fragment += "\\newline\\vspace{1cm}\n\n"
+		# The line breaks to clean up never span two exercises
+		yield remove_redundant_newline(fragment)
+
+def iter_document(matched):
+	"""
+	Lays the matched exercises out as a LaTeX document, one exercise per minipage,
+	yielding the document piece by piece.
+
+	Args:
+		matched: The matched exercises, each with an `id` and its LaTeX `description`,
+			without duplicates (see `iter_unique`).
+
+	Yields:
+		str: The pieces of the document. Nothing if there are no exercises.
+	"""
+	matched = iter(matched)
+	first = next(matched, None)
+	if first is None:
+		return
+	syllabus = first["id"].split("-")[0]
+	yield remove_redundant_newline(DOCUMENT_HEAD.format(title=f"Topic Questions on {syllabus}", author=get_author()).lstrip())
+
+	# The whitespace after the last exercise is dropped, so it is held back until the next one
+	pending = ""
+	for fragment in iter_fragments(chain([first], matched)):
+		body = fragment.rstrip()
+		yield pending + body
+		pending = fragment[len(body):]
+	yield DOCUMENT_TAIL
+
+def get_unique_key(one_per_cluster: bool = False):
+	"""
+	Returns the key matched exercises are de-duplicated by: their id, or their
+	near-duplicate cluster if only one exercise per cluster is kept.
+	"""
+	if one_per_cluster:
+		return lambda item: item.get("cluster") or item["id"]
+	return lambda item: item["id"]
+
+def compose_paper(matched: list[dict], one_per_cluster: bool = False) -> str:
+	"""
+	Lays the matched exercises out as a LaTeX document, one exercise per minipage.
+
+	Args:
+		matched (list[dict]): The matched exercises, each with an `id`, its near-duplicate
+			`cluster` and its LaTeX `description`. Must not be empty. Exercises matched
+			several times are included once.
+		one_per_cluster (bool, optional): Whether to include only the first exercise of
+			each near-duplicate cluster (e.g. a question reused across variants).
+
+	Returns:
+		str: The LaTeX document.
+	"""
+	return "".join(iter_document(iter_unique(matched, get_unique_key(one_per_cluster))))
+
+def write_document(connection: Connection, rows, latex_file: str, one_per_cluster: bool = False, chunk_size: int = 256) -> int:
+	"""
+	Streams selected exercises to a LaTeX document on disk: the rows are de-duplicated
+	as they are read, rendered chunk by chunk and written as they are laid out, so
+	memory does not grow with the number of matched exercises (beyond their ids).
+
+	Args:
+		connection (Connection): The connection to the exercise database.
+		rows: The rows (id, stem, relevance, cluster) of the matched exercises, e.g. a
+			cursor returned by `select_exercises`.
+		latex_file (str): The path of the document.
+		one_per_cluster (bool, optional): Whether to include only the first exercise of
+			each near-duplicate cluster.
+		chunk_size (int, optional): The number of stems rendered at a time.
+
+	Returns:
+		int: The number of exercises written. The file is not created if there are none.
+	"""
+	key = get_unique_key(one_per_cluster)
+	rows = iter_unique(rows, lambda row: key({"id": row[0], "cluster": row[3]}))
+	first = next(rows, None)
+	if first is None:
+		return 0
+
+	count = 0
+	def counted(matched):
+		nonlocal count
+		for item in matched:
+			count += 1
+			yield item
+
+	with open(latex_file, "w", encoding="utf-8") as file:
+		for piece in iter_document(counted(iter_rendered(connection, chain([first], rows), chunk_size))):
+			file.write(piece)
+	return count
 
 def compile_latex_to_pdf(latex_file, output_dir=None):
 	# Ensure the file exists
@@ -100,38 +323,24 @@ def compile_latex_to_pdf(latex_file, output_dir=None):
 		print("Error: pdflatex is not installed or not in your PATH.")
 
 if __name__ == "__main__":
-	syllabus_criteria = input("Enter the syllabus criteria (Support GLOB): ")
+	syllabus_criteria = input("Enter the syllabus subtrees, separated by commas (e.g. 1.2, 3.1; empty for all): ")
 	relevance_criteria = input("Enter the minimum relevance criteria: ")
+	search_criteria = input("Enter the full-text search terms (optional): ").strip()
+	one_per_cluster = input("Keep one exercise per near-duplicate cluster? (y/N): ").strip().lower() == "y"
 
 	path = f"compile/{datetime.now().strftime('%Y%m%d-%H%M%S')}/"
-	query = read_sql_file("src/queries/select-exercises-by-syllabus.sql")
-
-	conn = sqlite3.connect("./papers.db")
-	cursor = conn.cursor()
-	cursor.execute(query, (syllabus_criteria, float(relevance_criteria)))
-	matched = [{"id": i[0], "description": markdown2latex(i[1]), "relevance": i[2]} for i in cursor.fetchall()]
-	latex = ""
-	counter = 1
-	if(len(matched) == 0):
-		print("No exercises matched the criteria.")
-		exit(1)
-	syllabus = matched[0]["id"].split("-")[0]
-	matched = {d["id"]: d for d in matched}.values()
-	for item in matched:
-		meta = item["id"].split("-")
-		header = f"[{meta[0]}/{meta[1]}/{meta[2]}/{'-'.join(meta[3:])}]"
-		content = f"\\textbf{{{str(counter)}.}} {item['description'].strip()}"
-		latex += f"\\pdfbookmark[2]{{{counter}. {header}}}{{question-{counter}}}"
-		latex += into_minipage(f"\\texttt{{{header}}} \\newline\n{content}\n\n")
-		latex += "\\newline\\vspace{1cm}\n\n"
-		counter += 1
 
-	latex = into_document(latex, f"Topic Questions on {syllabus}")
+	conn = connect("./papers.db")
+	prepare_database(conn)
+	cursor = select_exercises(conn, parse_subtrees(syllabus_criteria), float(relevance_criteria), search_criteria)
 
 	create_dir_if_not_exist("compile")
 	create_dir_if_not_exist(path)
 	latex_file = path + "paper.tex"
-	pathlib.Path(latex_file).write_text(latex, encoding="utf-8")
+	if write_document(conn, cursor, latex_file, one_per_cluster) == 0:
+		print("No exercises matched the criteria.")
+		os.rmdir(path)
+		exit(1)
 	print("Compiled LaTeX file to: ", latex_file)
 	compile_latex_to_pdf(latex_file, path)
 
@@ -1,86 +1,238 @@
 import sqlite3
 from sqlite3 import Connection
+import hashlib
 import pathlib
-from utils import list_files, get_filename_with_other_ext, read_sql_file
-from exercise_classification import exercise_classification
-from openai import OpenAI
+from utils import list_files, get_filename_with_other_ext, read_sql_file, set_llm_cache, file_sha256, set_llm_throttle
+from llm_cache import load_llm_cache
+from llm_throttle import load_llm_throttle
+from llm_pool import load_client
+from llm_telemetry import telemetry_context, set_telemetry, load_telemetry
+from exercise_classification import (
+    exercise_classification,
+    index_classification,
+    parse_classification,
+    classification_batch_requests,
+)
+from batch_jobs import (
+    load_batch_endpoint,
+    submit_batch_job,
+    collect_batch_job,
+    finish_batch_job,
+    get_open_batch_jobs,
+    get_content,
+)
+from syllabus_search import load_search_index, get_search_index_path
+from near_duplicates import get_inherited_classification, get_signatures, DEFAULT_THRESHOLD
+from prompt_templates import load_prompt
+from db_writer import (
+    BulkWriter,
+    connect,
+    prepare_database,
+    transaction,
+    write_syllabus,
+    write_manifest_entry,
+)
 import json
+import sys
 from tqdm import tqdm
 
 
 def prepare_table(connection: Connection):
-    schema = read_sql_file("src/queries/schema.sql")
-    connection.executescript(schema)
+    prepare_database(connection)
 
 
-def insert_exercise(connection: Connection, exercise: dict):
-    connection.execute("BEGIN TRANSACTION")
-    query = read_sql_file("src/queries/insert-exercise.sql")
+def insert_syllabus(connection: Connection, syllabus: list[dict]):
+    try:
+        with transaction(connection):
+            write_syllabus(connection, syllabus)
+    except (sqlite3.Error, KeyError) as e:
+        print("Fail to insert syllabus point due to", e)
+        raise RuntimeError("Failed to insert syllabus point")
+
+
+def get_prompt_version():
+    """
+    Returns a fingerprint of the classification prompt, so that papers classified
+    with an older prompt are reclassified.
+    """
+    return hashlib.sha256(load_prompt("classify-exercises").encode("utf-8")).hexdigest()
+
 
+def get_manifest_entry(connection: Connection, source_file: str):
+    query = read_sql_file("src/queries/select-manifest-entry.sql")
+    row = connection.execute(query, (source_file,)).fetchone()
+    if row is None:
+        return None
+    keys = ["pdf_hash", "json_hash", "prompt_version", "model", "status", "classification"]
+    return dict(zip(keys, row))
+
+
+def update_manifest(connection: Connection, source_file: str, entry: dict):
     try:
-        connection.execute(
-            query,
-            (
-                exercise["id"],
-                exercise["stem"],
-                json.dumps(exercise["options"]),
-                json.dumps(exercise["figures"]),
-                exercise["origin"],
-            ),
-        )
-    except Exception as e:
-        connection.execute("ROLLBACK")
-        print("Fail to insert exercise due to", e)
-        raise RuntimeError("Failed to insert exercise")
-    connection.execute("COMMIT")
+        with transaction(connection):
+            write_manifest_entry(connection, source_file, entry)
+    except sqlite3.Error as e:
+        print("Fail to update ingestion manifest due to", e)
+        raise RuntimeError("Failed to update ingestion manifest")
 
 
-def insert_syllabus(connection: Connection, syllabus: list[dict]):
-    connection.execute("BEGIN TRANSACTION")
-    query = read_sql_file("src/queries/insert-syllabus-points.sql")
+def get_manifest_state(connection: Connection, file: str, prompt_version: str, model: str):
+    """
+    Compares an exercise JSON file with its ingestion manifest entry.
 
-    for point in syllabus:
-        try:
-            connection.execute(query, (point["id"], point["description"]))
-        except Exception as e:
-            connection.execute("ROLLBACK")
-            print("Fail to insert syllabus point due to", e)
-            raise RuntimeError("Failed to insert syllabus point")
-    connection.execute("COMMIT")
+    Returns:
+        tuple: The manifest entry describing the file as it is now, the previous entry
+        (or None), and whether the previous entry is up to date.
+    """
+    entry = {
+        "pdf_hash": file_sha256(get_filename_with_other_ext(file, "pdf")),
+        "json_hash": file_sha256(file),
+        "prompt_version": prompt_version,
+        "model": model,
+    }
+    previous = get_manifest_entry(connection, file)
+    up_to_date = previous is not None and all(
+        previous[key] == entry[key] for key in entry
+    )
+    return (entry, previous, up_to_date)
 
 
-def insert_matching(connection: Connection, matching: list[dict]):
-    # exercise_id, syllabus_id, relevance
-    connection.execute("BEGIN TRANSACTION")
-    query = read_sql_file("src/queries/insert-exercise-syllabus-mapping.sql")
+def needs_replace(previous: dict, up_to_date: bool):
+    """
+    Returns whether the exercises of a paper may already be in the database and must be
+    deleted before it is written. The manifest records the hashes of a paper before it is
+    classified, so an entry that is not complete may describe a paper whose previous
+    version is still in the database.
+    """
+    return previous is not None and (previous["status"] != "complete" or not up_to_date)
 
-    for match in matching:
-        try:
-            connection.execute(
-                query, (match["question-id"], match["syllabus-id"], match["relevance"])
+
+def load_exercises(file: str):
+    origin = pathlib.Path(get_filename_with_other_ext(file, "pdf")).name
+    return [
+        {**e, **{"matching_syllabus": None, "origin": origin}}
+        for e in json.loads(pathlib.Path(file).read_text())
+    ]
+
+
+def build_paper(file: str, entry: dict, replace: bool, exercises: list[dict], classified: list[dict], duplicate_threshold: float = DEFAULT_THRESHOLD, signatures: dict = None):
+    """
+    Matches the exercises of a paper with their classification, and builds the writes
+    of the paper (see `db_writer.write_paper`), completing its manifest entry.
+
+    The near-duplicate signatures of the exercises are computed here rather than by
+    the writer thread, so that they overlap with the writes of the previous papers,
+    unless they are given (see `near_duplicates.get_signatures`).
+    """
+    classification = index_classification(classified)
+    for exercise in exercises:
+        if exercise["id"] not in classification:
+            print("Warning: Fail to find matching for exercise: " + exercise["id"])
+            continue
+        exercise["matching_syllabus"] = classification[exercise["id"]]
+
+    matchings = []
+    for exercise in exercises:
+        if exercise["matching_syllabus"] == None:
+            continue
+        for match in exercise["matching_syllabus"]:
+            matchings.append(
+                {
+                    "syllabus-id": match["syllabus-id"],
+                    "question-id": exercise["id"],
+                    "relevance": match["relevance"],
+                }
             )
-        except Exception as e:
-            connection.execute("ROLLBACK")
-            print("Fail to insert matching due to", e)
-            raise RuntimeError("Failed to insert matching")
-    connection.execute("COMMIT")
 
+    original_pdf_file = get_filename_with_other_ext(file, "pdf")
+    return {
+        "pdf": original_pdf_file,
+        "pdf_hash": entry["pdf_hash"],
+        "origin": pathlib.Path(original_pdf_file).name,
+        "replace": replace,
+        "exercises": exercises,
+        "matchings": matchings,
+        "source": file,
+        "minhashes": signatures if signatures is not None else get_signatures(exercises),
+        "duplicate_threshold": duplicate_threshold,
+        "manifest": {
+            **entry,
+            "status": "complete",
+            "classification": json.dumps(classified),
+        },
+    }
 
-def insert_pdf_file(connection: Connection, file_path: str, file_name: str = None):
-    if file_name == None:
-        file_name = pathlib.Path(file_path).name
-    connection.execute("BEGIN TRANSACTION")
-    query = read_sql_file("src/queries/insert-pdf-file.sql")
 
-    try:
-        with open(file_path, "rb") as file:
-            file_data = file.read()
+def prepare_classification_batch(connection: Connection, endpoint, files: list[str], syllabus_points: list[dict], model: str, prompt_version: str, search_index=None, prefilter: dict = {}, directory: str = "batch"):
+    """
+    Writes the classification requests of every paper still to be classified to a
+    batch file and submits it. The papers are marked as batched in the manifest, so
+    that they are not batched again until the job is ingested.
 
-        connection.execute(query, (file_name, file_data))
-    except sqlite3.Error as e:
-        connection.execute("ROLLBACK")
-        raise RuntimeError("Failed to insert pdf file " + file_path)
-    connection.execute("COMMIT")
+    Returns:
+        dict | None: The job, or None if there is nothing to classify.
+    """
+    in_open_jobs = set(
+        source
+        for job in get_open_batch_jobs(connection, "classification")
+        for source in job["items"]["sources"]
+    )
+    requests = []
+    sources = {}
+    for file in files:
+        (entry, previous, up_to_date) = get_manifest_state(connection, file, prompt_version, model)
+        if up_to_date and previous["status"] in ["complete", "classified"]:
+            continue
+        if file in in_open_jobs:
+            continue
+        file_requests = classification_batch_requests(
+            load_exercises(file),
+            syllabus_points,
+            model,
+            file,
+            search_index=search_index,
+            top_k=prefilter.get("top-k", 10),
+            min_score=prefilter.get("min-score", 1.0),
+        )
+        requests.extend(file_requests)
+        sources[file] = {"entry": entry, "replace": needs_replace(previous, up_to_date), "batches": len(file_requests)}
+
+    if not requests:
+        return None
+    job = submit_batch_job(connection, endpoint, "classification", requests, {"sources": sources}, directory)
+    for (file, source) in sources.items():
+        update_manifest(connection, file, {**source["entry"], "status": "batched"})
+    return job
+
+
+def ingest_classification_batch(connection: Connection, writer: BulkWriter, job: dict, results: dict, prompt_version: str, model: str, duplicate_threshold: float = DEFAULT_THRESHOLD):
+    """
+    Validates the results of a classification job and writes the papers through the
+    same path as interactive classification. Papers whose results are incomplete, or
+    which changed since the job was prepared, are left to the next run.
+
+    Returns:
+        list: The source files and the futures of their writes.
+    """
+    writes = []
+    for (file, source) in job["items"]["sources"].items():
+        (entry, previous, up_to_date) = get_manifest_state(connection, file, prompt_version, model)
+        if entry != source["entry"]:
+            print(f"Warning: {file} changed since it was batched, skipping it.")
+            continue
+        try:
+            classified = [
+                item
+                for i in range(source["batches"])
+                for item in parse_classification(get_content(results.get(f"{file}#{i}")))
+            ]
+        except RuntimeError as e:
+            print(f"Warning: Fail to classify {file} in batch job {job['job_id']} due to", e)
+            writer.submit(write_manifest_entry, file, {**entry, "status": "pending"})
+            continue
+        paper = build_paper(file, entry, source["replace"], load_exercises(file), classified, duplicate_threshold)
+        writes.append((file, writer.write_paper(paper)))
+    return writes
 
 
 if __name__ == "__main__":
@@ -88,54 +240,122 @@ if __name__ == "__main__":
     # files = [file for file in list_files(exercises_folder) if file.endswith(".json")]
 
     config = json.loads(pathlib.Path("config.json").read_text())
-    client = OpenAI(
-        api_key=config["openai"]["key"], base_url=config["openai"]["base-url"]
-    )
+    client = load_client(config)
     model = config["model"]
+    set_llm_cache(load_llm_cache(config))
+    set_llm_throttle(load_llm_throttle(config))
+    set_telemetry(load_telemetry(config))
 
     syllabus = json.loads(pathlib.Path("syllabus/index-9618-2021-2023-syllabus-as.json").read_text())
     files = [file for file in list_files("papers") if file.endswith(".json")]
 
-    connection = sqlite3.connect("./papers.db")
+    db_path = "./papers.db"
+    connection = connect(db_path)
     prepare_table(connection)
     insert_syllabus(connection, syllabus["points"])
 
-    for file in tqdm(files):
-        original_pdf_file = get_filename_with_other_ext(file, "pdf")
-        insert_pdf_file(connection, original_pdf_file)
+    # Shortlist the syllabus points sent with each batch, unless "prefilter" is false
+    prefilter = config.get("prefilter", {})
+    search_index = None
+    if prefilter is not False:
+        search_index = load_search_index(
+            syllabus["points"], get_search_index_path(db_path)
+        )
+    else:
+        prefilter = {}
 
-        exercises = [
-            {**e, **{"matching_syllabus": None, "origin": pathlib.Path(original_pdf_file).name}}
-            for e in json.loads(pathlib.Path(file).read_text())
-        ]
+    prompt_version = get_prompt_version()
 
-        classification = exercise_classification(exercises, syllabus, client, model)
-        for exercise in exercises:
-            info_in_matching = list(
-                filter(lambda x: x["question-id"] == exercise["id"], classification)
-            )
-            if len(info_in_matching) == 0:
-                print("Warning: Fail to find matching for exercise: " + exercise["id"])
-                continue
-            exercise["matching_syllabus"] = info_in_matching[0]["matches"]
+    # Exercises with a near-duplicate in another paper inherit its syllabus mapping
+    near_duplicates = config.get("near-duplicates", {})
+    duplicate_threshold = near_duplicates.get("threshold", DEFAULT_THRESHOLD)
+
+    # python src/construct_exercise_db.py [batch-prepare | batch-ingest]
+    mode = sys.argv[1] if len(sys.argv) > 1 else "interactive"
+    batch_config = config.get("batch", {})
 
-        for exercise in exercises:
-            try:
-                insert_exercise(connection, exercise)
-            except:
-                print("Warning: Fail to insert exercise: " + exercise["id"])
+    if mode == "batch-prepare":
+        job = prepare_classification_batch(
+            connection,
+            load_batch_endpoint(config, client),
+            files,
+            syllabus["points"],
+            model,
+            prompt_version,
+            search_index,
+            prefilter,
+            batch_config.get("directory", "batch"),
+        )
+        print(f"Submitted batch job {job['job_id']}" if job is not None else "Nothing to classify.")
+        exit(0)
+
+    # All writes go through the single writer thread, overlapping with classification
+    writes = []
+    with BulkWriter(db_path) as writer:
+        if mode == "batch-ingest":
+            endpoint = load_batch_endpoint(config, client)
+            for job in get_open_batch_jobs(connection, "classification"):
+                results = collect_batch_job(
+                    connection, endpoint, job, batch_config.get("wait", False), batch_config.get("poll-interval", 60)
+                )
+                if results is None:
+                    continue
+                job_writes = ingest_classification_batch(connection, writer, job, results, prompt_version, model, duplicate_threshold)
+                for file, write in job_writes:
+                    write.exception()
+                finish_batch_job(connection, job)
+                writes.extend(job_writes)
+            files = []
 
-        matchings = []
-        for exercise in exercises:
-            if exercise["matching_syllabus"] == None:
+        for file in tqdm(files):
+            # Skip up-to-date papers, resume classified ones and redo changed ones
+            (entry, previous, up_to_date) = get_manifest_state(connection, file, prompt_version, model)
+            if up_to_date and previous["status"] == "complete":
                 continue
-            for match in exercise["matching_syllabus"]:
-                matchings.append(
-                    {
-                        "syllabus-id": match["syllabus-id"],
-                        "question-id": exercise["id"],
-                        "relevance": match["relevance"],
-                    }
+
+            exercises = load_exercises(file)
+            signatures = get_signatures(exercises)
+
+            if up_to_date and previous["status"] == "classified":
+                classified = json.loads(previous["classification"])
+            else:
+                writer.submit(write_manifest_entry, file, {**entry, "status": "pending"})
+                inherited = []
+                if near_duplicates.get("inherit", True):
+                    inherited = get_inherited_classification(connection, exercises, signatures, duplicate_threshold)
+                inherited_ids = set(item["question-id"] for item in inherited)
+                try:
+                    with telemetry_context(paper=file):
+                        classified = inherited + exercise_classification(
+                            [e for e in exercises if e["id"] not in inherited_ids],
+                            syllabus["points"],
+                            client,
+                            model,
+                            config.get("handshake", False),
+                            concurrency=config.get("concurrency", 4),
+                            search_index=search_index,
+                            top_k=prefilter.get("top-k", 10),
+                            min_score=prefilter.get("min-score", 1.0),
+                        )
+                except RuntimeError as e:
+                    # The paper stays pending, and is classified again by the next run
+                    print(f"Warning: Fail to classify {file} due to", e)
+                    continue
+                writer.submit(
+                    write_manifest_entry,
+                    file,
+                    {**entry, "status": "classified", "classification": json.dumps(classified)},
                 )
 
-        insert_matching(connection, matchings)
+            writes.append(
+                (
+                    file,
+                    writer.write_paper(
+                        build_paper(file, entry, needs_replace(previous, up_to_date), exercises, classified, duplicate_threshold, signatures)
+                    ),
+                )
+            )
+
+    for file, write in writes:
+        if write.exception() is not None:
+            print(f"Warning: Fail to write {file} due to", write.exception())
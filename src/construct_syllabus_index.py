@@ -1,8 +1,17 @@
-from utils import get_filename_with_other_ext, llm_chat
+from utils import get_filename_with_other_ext, llm_chat, set_llm_cache, set_llm_throttle
+from llm_cache import load_llm_cache
+from llm_throttle import load_llm_throttle
+from llm_pool import load_client
+from llm_telemetry import telemetry_stage, set_telemetry, load_telemetry
+from prompt_templates import build_messages
+from syllabus_sections import split_sections, get_context_prefix, stitch_points
 from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import json
 import pathlib
 
+@telemetry_stage("syllabus-index")
 def syllabus_index_construction(syllabus_text: str, client: OpenAI, model: str):
 	"""
 	Constructs an index for the given syllabus text using an LLM (Language Learning Model).
@@ -16,19 +25,59 @@ def syllabus_index_construction(syllabus_text: str, client: OpenAI, model: str):
 		str: The generated index content as a string.
 	"""
 
-	prompt = pathlib.Path("prompts/syllabus-index.md").read_text()
-	messages = [
-		{"role": "system", "content": prompt},
-		{"role": "user", "content": syllabus_text},
-	]
+	messages = build_messages("syllabus-index", syllabus_text)
 	return llm_chat(model, client, messages, True, 8192).choices[0].message.content
 
+def construct_syllabus_index(syllabus_text: str, client: OpenAI, model: str, max_chars: int = 12000, concurrency: int = 4) -> dict:
+	"""
+	Constructs the index of a syllabus section by section, so that long syllabi are not
+	truncated by the token limit of a single response, and the sections are indexed
+	concurrently.
+
+	The syllabus is split at its headings and topic numbers (see
+	`syllabus_sections.split_sections`). Each section is sent with the topic lines
+	enclosing it, and the knowledge points of all sections are merged in id order.
+
+	Args:
+		syllabus_text (str): The text content of the syllabus.
+		client (OpenAI): An instance of the OpenAI client used to interact with the LLM.
+		model (str): The name of the LLM model to be used for generating the index.
+		max_chars (int, optional): The target size of a section.
+		concurrency (int, optional): The maximum number of sections indexed at the same time.
+
+	Returns:
+		dict: The index, as `{"points": [{"id": ..., "description": ...}, ...]}`.
+
+	Raises:
+		RuntimeError: If the index of a section is not a valid JSON.
+	"""
+	sections = split_sections(syllabus_text, max_chars)
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		# Worker threads do not inherit the telemetry tags of the caller
+		futures = [
+			executor.submit(contextvars.copy_context().run, syllabus_index_construction, get_context_prefix(section) + section["text"], client, model)
+			for section in sections
+		]
+		results = []
+		for (section, future) in zip(sections, futures):
+			try:
+				results.append(json.loads(future.result())["points"])
+			except (json.JSONDecodeError, KeyError, TypeError):
+				raise RuntimeError(f"The index of the section starting at topic {(section['topics'] or ['-'])[0]} is not a valid JSON, check the max_tokens parameter.")
+	return {"points": stitch_points(results)}
+
 syllabus_md_path = "syllabus/9618-2021-2023-syllabus-as.md"
 
 if __name__ == "__main__":
 	config = json.loads(pathlib.Path("config.json").read_text())
-	client = OpenAI(api_key=config["openai"]["key"], base_url=config["openai"]["base-url"])
+	client = load_client(config)
 	model = config["model"]
+	set_llm_cache(load_llm_cache(config))
+	set_llm_throttle(load_llm_throttle(config))
+	set_telemetry(load_telemetry(config))
 	syllabus_text = pathlib.Path(syllabus_md_path).read_text()
 	index_path = "/".join(syllabus_md_path.split("/")[:-1] + ["index-" + get_filename_with_other_ext(syllabus_md_path, "json").split("/")[-1]])
-	pathlib.Path(index_path).write_text(syllabus_index_construction(syllabus_text, client, model))
+	# "syllabus-sections": {"max-chars": 12000} sets the size of the sections indexed at once
+	sections_config = config.get("syllabus-sections", {})
+	index = construct_syllabus_index(syllabus_text, client, model, sections_config.get("max-chars", 12000), config.get("concurrency", 4))
+	pathlib.Path(index_path).write_text(json.dumps(index, indent=2, ensure_ascii=False))
@@ -0,0 +1,304 @@
+import sqlite3
+from sqlite3 import Connection
+from concurrent.futures import Future
+from contextlib import contextmanager
+import json
+import queue
+import threading
+
+from utils import read_sql_file
+from pdf_store import store_pdf, prune_pdf_blobs, migrate_legacy_pdf_files
+from exercise_queries import get_syllabus_closure
+from near_duplicates import index_exercises, delete_index_by_origin, DEFAULT_THRESHOLD
+
+PRAGMAS = [
+	"PRAGMA journal_mode=WAL",
+	"PRAGMA synchronous=NORMAL",
+	"PRAGMA temp_store=MEMORY",
+	"PRAGMA cache_size=-65536", # 64 MiB
+	"PRAGMA mmap_size=268435456", # 256 MiB
+]
+
+def connect(db_path: str) -> Connection:
+	"""
+	Opens a connection to the exercise database with WAL and the tuned pragmas.
+
+	The connection is in autocommit mode; writes are grouped with `transaction`.
+	Statements are prepared once per connection and reused from its statement cache.
+
+	Args:
+		db_path (str): The path to the database file.
+
+	Returns:
+		Connection: The configured connection.
+	"""
+	connection = sqlite3.connect(db_path, isolation_level=None, cached_statements=256, timeout=30, check_same_thread=False)
+	for pragma in PRAGMAS:
+		connection.execute(pragma)
+	return connection
+
+def table_exists(connection: Connection, name: str) -> bool:
+	query = "SELECT 1 FROM sqlite_master WHERE name = ?"
+	return connection.execute(query, (name,)).fetchone() is not None
+
+def prepare_database(connection: Connection):
+	"""
+	Creates the schema of the exercise database, and migrates or backfills the
+	tables of databases created by earlier versions.
+	"""
+	had_search_index = table_exists(connection, "exercises_fts")
+	had_syllabus_closure = table_exists(connection, "syllabus_closure")
+	had_near_duplicates = table_exists(connection, "exercise_minhash")
+	connection.executescript(read_sql_file("src/queries/schema.sql"))
+	migrate_legacy_pdf_files(connection)
+	migrate_exercises_row_id(connection)
+	if not had_search_index:
+		rebuild_search_index(connection)
+	if not had_syllabus_closure:
+		rebuild_syllabus_closure(connection)
+	if not had_near_duplicates:
+		rebuild_near_duplicates(connection)
+
+def migrate_exercises_row_id(connection: Connection):
+	"""
+	Recreates the `exercises` table of earlier versions with its `row_id` column, and
+	the full-text index with it as key, as the index went stale once VACUUM renumbered
+	the implicit rowid. Does nothing on up-to-date databases.
+
+	Must be called once the schema has been created, outside of a transaction.
+	"""
+	columns = [row[1] for row in connection.execute("PRAGMA table_info(exercises)")]
+	if "row_id" in columns:
+		return
+
+	# executescript commits any open transaction, so the migration is a single script
+	# that recreates the exercises, the full-text index and its triggers
+	script = "\n".join([
+		"BEGIN TRANSACTION;",
+		read_sql_file("src/queries/migrate-exercises-row-id.sql"),
+		read_sql_file("src/queries/schema.sql"),
+		read_sql_file("src/queries/copy-legacy-exercises.sql"),
+		"DROP TABLE legacy_exercises;",
+		"COMMIT;",
+	])
+	try:
+		connection.executescript(script)
+	except sqlite3.Error:
+		if connection.in_transaction:
+			connection.execute("ROLLBACK")
+		raise RuntimeError("Failed to migrate the exercises table")
+
+def rebuild_search_index(connection: Connection):
+	"""
+	Rebuilds the full-text index of the exercises from scratch, e.g. for a database
+	created before the index existed.
+	"""
+	connection.executescript(read_sql_file("src/queries/rebuild-exercises-fts.sql"))
+
+def rebuild_syllabus_closure(connection: Connection):
+	"""
+	Fills the syllabus hierarchy from the known syllabus ids, e.g. for a database
+	created before the hierarchy existed.
+	"""
+	query = read_sql_file("src/queries/select-syllabus-ids.sql")
+	syllabus_ids = [row[0] for row in connection.execute(query)]
+	with transaction(connection):
+		write_syllabus_closure(connection, syllabus_ids)
+
+def rebuild_near_duplicates(connection: Connection, threshold: float = DEFAULT_THRESHOLD):
+	"""
+	Rebuilds the near-duplicate index of the exercises from scratch, e.g. for a database
+	created before the index existed.
+	"""
+	query = read_sql_file("src/queries/select-exercises.sql")
+	exercises = [{"id": row[0], "stem": row[1]} for row in connection.execute(query)]
+	with transaction(connection):
+		connection.execute(read_sql_file("src/queries/delete-lsh-buckets.sql"))
+		connection.execute(read_sql_file("src/queries/delete-minhashes.sql"))
+		index_exercises(connection, exercises, threshold=threshold)
+
+@contextmanager
+def transaction(connection: Connection):
+	"""
+	Runs the enclosed writes in a single transaction, rolling back on any error.
+	"""
+	connection.execute("BEGIN TRANSACTION")
+	try:
+		yield connection
+	except BaseException:
+		connection.execute("ROLLBACK")
+		raise
+	connection.execute("COMMIT")
+
+def write_exercises(connection: Connection, exercises: list[dict]):
+	rows = []
+	for exercise in exercises:
+		try:
+			rows.append((
+				exercise["id"],
+				exercise["stem"],
+				json.dumps(exercise["options"]),
+				json.dumps(exercise["figures"]),
+				exercise["origin"],
+			))
+		except KeyError as e:
+			print(f"Warning: Fail to insert exercise {exercise.get('id')}, missing key", e)
+	connection.executemany(read_sql_file("src/queries/insert-exercise.sql"), rows)
+
+def write_syllabus_closure(connection: Connection, syllabus_ids: list[str]):
+	connection.executemany(
+		read_sql_file("src/queries/insert-syllabus-closure.sql"),
+		[row for syllabus_id in set(syllabus_ids) for row in get_syllabus_closure(syllabus_id)],
+	)
+
+def write_syllabus(connection: Connection, syllabus: list[dict]):
+	connection.executemany(
+		read_sql_file("src/queries/insert-syllabus-points.sql"),
+		[(point["id"], point["description"]) for point in syllabus],
+	)
+	write_syllabus_closure(connection, [point["id"] for point in syllabus])
+
+def write_matchings(connection: Connection, matching: list[dict]):
+	connection.executemany(
+		read_sql_file("src/queries/insert-exercise-syllabus-mapping.sql"),
+		[(match["question-id"], match["syllabus-id"], match["relevance"]) for match in matching],
+	)
+	# Matched ids missing from the syllabus index stay reachable by subtree queries
+	write_syllabus_closure(connection, [match["syllabus-id"] for match in matching])
+
+def write_pdf_file(connection: Connection, file_path: str, file_name: str = None, content_hash: str = None):
+	store_pdf(connection, file_path, file_name, content_hash)
+	# A changed file replaces the content its name referred to, which may now be unused
+	prune_pdf_blobs(connection)
+
+def write_manifest_entry(connection: Connection, source_file: str, entry: dict):
+	connection.execute(
+		read_sql_file("src/queries/upsert-manifest-entry.sql"),
+		(
+			source_file,
+			entry["pdf_hash"],
+			entry["json_hash"],
+			entry["prompt_version"],
+			entry["model"],
+			entry["status"],
+			entry.get("classification"),
+		),
+	)
+
+def write_extraction_entry(connection: Connection, source_file: str, entry: dict):
+	connection.execute(
+		read_sql_file("src/queries/upsert-extraction-entry.sql"),
+		(
+			source_file,
+			entry["pdf_hash"],
+			entry.get("json_hash"),
+			entry["prompt_version"],
+			entry["model"],
+			entry["status"],
+		),
+	)
+
+def delete_paper(connection: Connection, origin: str):
+	connection.execute(read_sql_file("src/queries/delete-mappings-by-origin.sql"), (origin,))
+	delete_index_by_origin(connection, origin)
+	connection.execute(read_sql_file("src/queries/delete-exercises-by-origin.sql"), (origin,))
+
+def write_paper(connection: Connection, paper: dict):
+	"""
+	Writes everything ingested from one paper in a single transaction.
+
+	Args:
+		connection (Connection): The connection to write with.
+		paper (dict): The paper, with the following keys:
+
+			- pdf (str, optional): The path to the original PDF file.
+			- pdf_hash (str, optional): The SHA-256 of the PDF file, if already known.
+			- origin (str): The name the exercises refer to the PDF file by.
+			- replace (bool, optional): Whether to remove the previously ingested exercises
+			  of the paper first.
+			- exercises (list[dict]): The exercises to insert.
+			- matchings (list[dict]): The exercise-syllabus matchings to insert.
+			- minhashes (dict, optional): The MinHash signatures of the exercises already
+			  computed, by id. The others are computed while indexing the exercises.
+			- duplicate_threshold (float, optional): The minimum similarity of near-duplicates.
+			- source (str, optional): The source file recorded in the ingestion manifest.
+			- manifest (dict, optional): The ingestion manifest entry of the source file.
+	"""
+	with transaction(connection):
+		if paper.get("replace"):
+			delete_paper(connection, paper["origin"])
+		if paper.get("pdf") is not None:
+			write_pdf_file(connection, paper["pdf"], paper["origin"], paper.get("pdf_hash"))
+		write_exercises(connection, paper["exercises"])
+		write_matchings(connection, paper["matchings"])
+		index_exercises(connection, paper["exercises"], paper.get("minhashes"), paper.get("duplicate_threshold", DEFAULT_THRESHOLD))
+		if paper.get("manifest") is not None:
+			write_manifest_entry(connection, paper["source"], paper["manifest"])
+
+class BulkWriter:
+	"""
+	A single writer thread owning the only write connection to the database.
+
+	Workers submit write jobs through a bounded queue instead of writing
+	themselves, so concurrent extraction or classification workers never contend
+	for the database lock. Each job runs in the writer thread and its outcome is
+	reported through the returned `Future`.
+
+	Args:
+		db_path (str): The path to the database file.
+		max_pending (int, optional): The maximum number of queued jobs before
+			`submit` blocks.
+	"""
+
+	def __init__(self, db_path: str, max_pending: int = 64):
+		self.db_path = db_path
+		self.queue = queue.Queue(max_pending)
+		self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+		self.thread.start()
+
+	def _run(self):
+		connection = connect(self.db_path)
+		try:
+			while True:
+				item = self.queue.get()
+				if item is None:
+					break
+				(job, args, future) = item
+				if not future.set_running_or_notify_cancel():
+					continue
+				try:
+					future.set_result(job(connection, *args))
+				except BaseException as e:
+					future.set_exception(e)
+		finally:
+			connection.close()
+
+	def submit(self, job, *args) -> Future:
+		"""
+		Queues a job to be run by the writer thread as `job(connection, *args)`.
+
+		Returns:
+			Future: The result of the job.
+		"""
+		future = Future()
+		self.queue.put((job, args, future))
+		return future
+
+	def write_paper(self, paper: dict) -> Future:
+		"""
+		Queues the writes of one paper, see `write_paper`.
+		"""
+		return self.submit(write_paper, paper)
+
+	def close(self):
+		"""
+		Waits for the queued jobs to finish and stops the writer thread.
+		"""
+		self.queue.put(None)
+		self.thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
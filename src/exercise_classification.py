@@ -1,17 +1,157 @@
-from utils import get_filename_with_other_ext, llm_chat
+from utils import get_filename_with_other_ext, llm_chat, set_llm_cache, set_llm_throttle
+from llm_cache import load_llm_cache
+from llm_throttle import load_llm_throttle
+from llm_pool import load_client
+from llm_telemetry import telemetry_context, telemetry_stage, set_telemetry, load_telemetry
+from prompt_templates import open_conversation, open_single_shot
+from batch_jobs import batch_request
+from syllabus_search import SyllabusSearchIndex, exercise_search_text
 from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import json
 import pathlib
 
-def exercise_classification(exercises: list[dict], syllabus_index: list[dict], client: OpenAI, model: str) -> list[dict]:
+def estimate_tokens(text: str) -> int:
+	"""
+	Roughly estimates the number of tokens of a text (about four characters per token).
+	"""
+	return len(text) // 4 + 1
+
+def split_into_batches(exercises: list[dict], token_budget: int = 4096, max_batch_size: int = 20) -> list[list[dict]]:
+	"""
+	Splits exercises into batches whose serialised size stays within a token budget.
+
+	Args:
+		exercises (list[dict]): The exercises to split, in order.
+		token_budget (int, optional): The estimated number of input tokens allowed per batch.
+			An exercise larger than the budget gets a batch of its own.
+		max_batch_size (int, optional): The maximum number of exercises per batch, which
+			bounds the size of the classification returned for a batch.
+
+	Returns:
+		list[list[dict]]: The batches, in the order of the exercises.
+	"""
+	batches = []
+	batch = []
+	batch_tokens = 0
+	for exercise in exercises:
+		tokens = estimate_tokens(json.dumps(exercise))
+		if batch and (batch_tokens + tokens > token_budget or len(batch) >= max_batch_size):
+			batches.append(batch)
+			batch = []
+			batch_tokens = 0
+		batch.append(exercise)
+		batch_tokens += tokens
+	if batch:
+		batches.append(batch)
+	return batches
+
+def narrow_syllabus(exercises: list[dict], syllabus_index: list[dict], search_index: SyllabusSearchIndex = None, top_k: int = 10, min_score: float = 1.0) -> list[dict]:
+	"""
+	Narrows the syllabus points down to the lexical candidates of a batch of exercises.
+
+	Args:
+		exercises (list[dict]): The batch of exercises.
+		syllabus_index (list[dict]): The full list of syllabus points.
+		search_index (SyllabusSearchIndex, optional): The search index over the syllabus
+			points. If None, the full list is returned.
+		top_k (int, optional): The number of candidates kept per exercise.
+		min_score (float, optional): The score below which an exercise is considered
+			ambiguous, in which case the full list is returned.
+
+	Returns:
+		list[dict]: The candidate syllabus points, in syllabus order.
+	"""
+	if search_index is None:
+		return syllabus_index
+	candidates = search_index.shortlist([exercise_search_text(e) for e in exercises], top_k, min_score)
+	if candidates is None:
+		return syllabus_index
+	return [point for point in syllabus_index if point["id"] in candidates]
+
+@telemetry_stage("classification")
+def classify_batch(exercises: list[dict], syllabus_index: list[dict], client: OpenAI, model: str, handshake: bool = False) -> list[dict]:
+	"""
+	Classifies a single batch of exercises in one LLM request.
+
+	Raises:
+		RuntimeError: If the LLM is not ready (in handshake mode) or if its response is
+		not a valid classification.
+	"""
+	messages = open_conversation(model, client, "classify-exercises", json.dumps({"points": syllabus_index}), handshake)
+	messages.append({"role": "user", "content": json.dumps(exercises)})
+
+	response = llm_chat(model, client, messages, True, 8192, validate=parse_classification)
+	return parse_classification(response.choices[0].message.content)
+
+def parse_classification(content: str) -> list[dict]:
+	"""
+	Parses the content of a classification response.
+
+	Raises:
+		RuntimeError: If the response is not a valid classification.
+	"""
+	try:
+		return json.loads(content)["classified"]
+	except (json.JSONDecodeError, KeyError, TypeError):
+		raise RuntimeError("LLM response is not a valid classification, check the max_tokens parameter.")
+
+def classification_batch_requests(exercises: list[dict], syllabus_index: list[dict], model: str, custom_id_prefix: str, token_budget: int = 4096, search_index: SyllabusSearchIndex = None, top_k: int = 10, min_score: float = 1.0) -> list[dict]:
+	"""
+	Builds the batch file lines classifying exercises, split into the same batches
+	`exercise_classification` would send. The custom_id of each line is the prefix
+	followed by `#` and the index of the batch.
+	"""
+	requests = []
+	for (i, batch) in enumerate(split_into_batches(exercises, token_budget)):
+		messages = open_single_shot("classify-exercises", json.dumps({"points": narrow_syllabus(batch, syllabus_index, search_index, top_k, min_score)}))
+		messages.append({"role": "user", "content": json.dumps(batch)})
+		requests.append(batch_request(f"{custom_id_prefix}#{i}", model, messages, True, 8192))
+	return requests
+
+def index_classification(classified: list[dict]) -> dict[str, list[dict]]:
+	"""
+	Indexes a classification by question id.
+
+	Args:
+		classified (list[dict]): The classification returned by `exercise_classification`.
+
+	Returns:
+		dict[str, list[dict]]: The matches of each question id. If a question id was
+		classified more than once, its first classification is kept.
+	"""
+	index = {}
+	for item in classified:
+		index.setdefault(item["question-id"], item["matches"])
+	return index
+
+def exercise_classification(exercises: list[dict], syllabus_index: list[dict], client: OpenAI, model: str, handshake: bool = False, token_budget: int = 4096, concurrency: int = 4, max_attempts: int = 3, search_index: SyllabusSearchIndex = None, top_k: int = 10, min_score: float = 1.0) -> list[dict]:
 	"""
 	Classifies exercises based on the provided syllabus index using an LLM.
 
+	The exercises are split into token-budgeted batches which are classified
+	concurrently. Batches that fail are retried on their own, and the results are
+	merged back in the order of the exercises.
+
+	If a search index is given, each batch is only sent the syllabus points that are
+	lexical candidates for its exercises, falling back to the full syllabus when the
+	candidates score too low.
+
 	Args:
 		exercises (list[dict]): A list of exercise dictionaries to be classified.
 		syllabus_index (list[dict]): A list of syllabus points used as a reference for classification.
 		client (OpenAI): An instance of the OpenAI client for interacting with the LLM.
 		model (str): The name of the LLM model to use for classification.
+		handshake (bool, optional): Whether to wait for the LLM to confirm it is ready
+			before sending the exercises, instead of sending everything in a single shot.
+		token_budget (int, optional): The estimated number of input tokens of exercises per batch.
+		concurrency (int, optional): The maximum number of batches classified at the same time.
+		max_attempts (int, optional): How many times a batch is attempted before giving up.
+		search_index (SyllabusSearchIndex, optional): The search index used to shortlist
+			the syllabus points of each batch.
+		top_k (int, optional): The number of candidate syllabus points kept per exercise.
+		min_score (float, optional): The candidate score below which the full syllabus is used.
 
 	Returns:
 		list[dict]: A list of classified exercises, where each exercise is associated with relevant syllabus points.
@@ -31,38 +171,52 @@ def exercise_classification(exercises: list[dict], syllabus_index: list[dict], c
 		```
 
 	Raises:
-		RuntimeError: If the LLM is not ready to process the classification request.
+		RuntimeError: If a batch still fails after `max_attempts` attempts.
 	"""
 
-	prompt = pathlib.Path("prompts/classify-exercises.md").read_text()
-	messages = [
-		{"role": "system", "content": prompt},
-		{"role": "user", "content": json.dumps({"points": syllabus_index})},
-	]
-
-	response = llm_chat(model, client, messages)
-	if(json.loads(response.choices[0].message.content)["response"] != "ready"):
-		raise RuntimeError("LLM not ready, please check the prompt")
-
-	messages.append({"role": "assistant", "content": response.choices[0].message.content})
-	messages.append({"role": "user", "content": json.dumps(exercises)})
+	batches = split_into_batches(exercises, token_budget)
+	batch_syllabi = [narrow_syllabus(batch, syllabus_index, search_index, top_k, min_score) for batch in batches]
+	results = [None] * len(batches)
+	pending = list(range(len(batches)))
+
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		for attempt in range(max_attempts):
+			# Worker threads do not inherit the telemetry tags of the caller
+			with telemetry_context(attempt=attempt):
+				futures = {
+					i: executor.submit(contextvars.copy_context().run, classify_batch, batches[i], batch_syllabi[i], client, model, handshake)
+					for i in pending
+				}
+			pending = []
+			for (i, future) in futures.items():
+				try:
+					results[i] = future.result()
+				except Exception as e:
+					print(f"Warning: Fail to classify batch {i + 1}/{len(batches)} (attempt {attempt + 1}) due to", e)
+					pending.append(i)
+			if not pending:
+				break
 
-	response = llm_chat(model, client, messages, True, 8192)
+	if pending:
+		raise RuntimeError(f"Failed to classify {len(pending)} of {len(batches)} batches")
 
-	return json.loads(response.choices[0].message.content)["classified"]
+	return [item for result in results for item in result]
 
 syllabus_index_path = "syllabus/index-9618-2021-2023-syllabus-as.json"
 exercise_json_path = "papers/9618_s24_qp_13.json"
 
 if __name__ == "__main__":
 	config = json.loads(pathlib.Path("config.json").read_text())
-	client = OpenAI(api_key=config["openai"]["key"], base_url=config["openai"]["base-url"])
+	client = load_client(config)
 	model = config["model"]
+	set_llm_cache(load_llm_cache(config))
+	set_llm_throttle(load_llm_throttle(config))
+	set_telemetry(load_telemetry(config))
 	syllabus = json.loads(pathlib.Path(syllabus_index_path).read_text())
 
 	exercises = json.loads(pathlib.Path(exercise_json_path).read_text())
 	syllabus = json.loads(pathlib.Path(syllabus_index_path).read_text())["points"]
 
-	pathlib.Path("output.json").write_text(json.dumps(exercise_classification(exercises, syllabus, client, model)))
+	pathlib.Path("output.json").write_text(json.dumps(exercise_classification(exercises, syllabus, client, model, config.get("handshake", False))))
 
 
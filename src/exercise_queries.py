@@ -0,0 +1,92 @@
+from sqlite3 import Connection
+import json
+import re
+
+from utils import read_sql_file
+
+FTS_TERM_PATTERN = re.compile(r'"[^"]*"|\S+')
+
+def to_fts_query(text: str) -> str:
+	"""
+	Turns free text into an FTS5 query matching exercises that contain every term.
+
+	Terms are quoted, so that punctuation (e.g. "binary-search") is not parsed as
+	FTS5 syntax. Quoted phrases are kept as phrases.
+
+	Examples
+	--------
+	>>> to_fts_query('binary search "linked list"')
+	'"binary" "search" "linked list"'
+	"""
+	terms = []
+	for term in FTS_TERM_PATTERN.findall(text):
+		term = term.strip('"')
+		if term:
+			terms.append('"' + term.replace('"', '""') + '"')
+	return " ".join(terms)
+
+def get_syllabus_closure(syllabus_id: str) -> list[tuple[str, str, int]]:
+	"""
+	Lists the closure table rows of a syllabus id: one per ancestor, itself included.
+
+	Examples
+	--------
+	>>> get_syllabus_closure("1.2.3")
+	[('1', '1.2.3', 2), ('1.2', '1.2.3', 1), ('1.2.3', '1.2.3', 0)]
+	"""
+	parts = [part.strip() for part in syllabus_id.strip().split(".") if part.strip()]
+	return [(".".join(parts[:level]), ".".join(parts), len(parts) - level) for level in range(1, len(parts) + 1)]
+
+def parse_subtrees(text: str) -> list[str]:
+	"""
+	Parses a comma or space separated list of syllabus subtrees (e.g. "1.2, 3").
+
+	Wildcards of the earlier GLOB/LIKE criteria are tolerated, so "1.2.*" and
+	"1.2%" both select the subtree "1.2".
+
+	Returns:
+		list[str]: The root id of each subtree. Empty if every syllabus point is selected.
+	"""
+	subtrees = []
+	for part in re.split(r"[,\s]+", text):
+		part = part.strip("%*?. ")
+		if part:
+			subtrees.append(part)
+	return subtrees
+
+def get_syllabus_roots(connection: Connection) -> list[str]:
+	query = read_sql_file("src/queries/select-syllabus-roots.sql")
+	return [row[0] for row in connection.execute(query)]
+
+def select_exercises(connection: Connection, subtrees: list[str], relevance: float, search: str = None):
+	"""
+	Selects the exercises matching the syllabus and relevance criteria.
+
+	The syllabus criteria are subtrees of the syllabus hierarchy: "1.2" selects
+	"1.2" and everything under it (e.g. "1.2.3"), but not "11.2.3" or "1.20.1".
+	They are resolved through the `syllabus_closure` table, so each subtree is a
+	range scan over its primary key.
+
+	Args:
+		connection (Connection): The connection to the exercise database.
+		subtrees (list[str]): The root ids of the selected subtrees. If empty, every
+			syllabus point is selected.
+		relevance (float): The minimum relevance of the matching.
+		search (str, optional): Free text the exercises must contain. If given, the
+			exercises are ranked by full-text relevance first.
+
+	Returns:
+		sqlite3.Cursor: The rows (id, stem, relevance, cluster) of the matched exercises,
+		where cluster is the near-duplicate cluster of the exercise (its own id if it is
+		not indexed). An exercise matching several selected syllabus points is returned
+		once per point.
+	"""
+	if len(subtrees) == 0:
+		subtrees = get_syllabus_roots(connection)
+
+	if search:
+		query = read_sql_file("src/queries/search-exercises.sql")
+		return connection.execute(query, (to_fts_query(search), json.dumps(subtrees), relevance))
+
+	query = read_sql_file("src/queries/select-exercises-by-syllabus.sql")
+	return connection.execute(query, (json.dumps(subtrees), relevance))
@@ -1,14 +1,197 @@
-import pymupdf4llm
-from openai import OpenAI
-from zhipuai import ZhipuAI
+from openai import OpenAI, AsyncOpenAI
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import hashlib
 import pathlib
 import json
+import sys
 import tqdm
 
-from utils import llm_chat, list_files, get_filename_with_other_ext, get_paper_meta_prefix, get_paper_meta
+from utils import llm_chat, llm_chat_async, llm_chat_stream, llm_chat_stream_async, list_files, get_filename_with_other_ext, get_paper_meta_prefix, get_paper_meta, set_llm_cache, set_llm_throttle, read_sql_file, file_sha256
+from llm_cache import load_llm_cache
+from llm_throttle import load_llm_throttle
+from llm_pool import load_client, load_async_client
+from pdf_markdown import PDFMarkdownConverter, load_pdf_converter
+from paper_segmentation import segment_paper, get_exercise_question
+from batch_jobs import batch_request, load_batch_endpoint, submit_batch_job, collect_batch_job, finish_batch_job, get_open_batch_jobs, get_content
+from db_writer import connect, prepare_database, transaction, write_extraction_entry
+from prompt_templates import load_prompt, open_conversation, open_conversation_async, open_single_shot
+from json_stream import JSONArrayStreamParser
+from llm_telemetry import telemetry_context, telemetry_stage, set_telemetry, load_telemetry
 
+EXERCISE_KEYS = set(["id", "stem", "options", "figures"])
 
-def extract_exercises_to_json(paper_md_text: str, client: OpenAI, model: str, file_meta: dict = None):
+def parse_extraction_response(content: str) -> dict:
+	"""
+	Parses the raw content of an extraction response.
+
+	Raises:
+		RuntimeError: If the response is not a valid JSON.
+	"""
+	try:
+		return json.loads(content)
+	except(json.JSONDecodeError):
+		raise RuntimeError("LLM response is not a valid JSON, check the max_tokens parameter.")
+
+def check_extracted(extracted: dict, retry_times: int, min_exercises: int = 5):
+	"""
+	Validates an extraction response.
+
+	Args:
+		extracted (dict): The parsed response of the LLM.
+		retry_times (int): How many times the LLM has been asked to check again so far.
+		min_exercises (int, optional): Below this number of exercises, the LLM is asked
+			once whether it extracted them all.
+
+	Returns:
+		str | None: The follow-up message asking the LLM to check again, or None if the
+		extracted exercises are valid.
+	"""
+	# If the extracted JSON does not contain the 'exercises' key, ask the LLM to check again
+	if "exercises" not in extracted:
+		print("The extracted JSON does not contain the 'exercises' key. Asking the LLM to check again.")
+		return f"The extracted JSON does not contain the 'exercises' key. Please check the prompt and try again."
+
+	exercises = extracted["exercises"]
+
+	# If the number of exercises is too small, ask the LLM to check again
+	if ((len(exercises) < min_exercises) and (retry_times == 0)):
+		print("The number of exercises is too small. Asking the LLM to check again.")
+		return f"Are you sure that you have extracted all the exercises? Please check again. \nIf everything works fine, please return the same JSON again. Otherwise, please extract again."
+
+	for exercise in exercises:
+		if(set(exercise.keys()) != EXERCISE_KEYS):
+			print("The extracted JSON does not contain the correct keys. Asking the LLM to check again.")
+			return f"The extracted JSON does not contain the correct keys. Please check the prompt and try again."
+		if(not isinstance(exercise["stem"], str)):
+			print("The extracted JSON does not contain the correct stem. Asking the LLM to check again.")
+			return f"The extracted JSON does not contain the correct stem. Please check the prompt and try again."
+
+	return None
+
+def prefix_exercise_ids(exercises: list[dict], file_meta: dict = None):
+	"""
+	Uses the given file meta to format the exercise id (adding meta prefix).
+	"""
+	if file_meta is not None:
+		for exercise in exercises:
+			exercise["id"] = f'{get_paper_meta_prefix(file_meta["syllabus_id"], file_meta["time_id"], file_meta["component_id"])}-{exercise["id"]}'
+	return exercises
+
+class ExtractionStream:
+	"""
+	Streams an extraction response, yielding each exercise as soon as it is complete.
+
+	If the response is cut off (`finish_reason == "length"`), a continuation request
+	asks the LLM for the exercises after the last complete one, instead of
+	regenerating the whole paper. A response cut off before any exercise is complete
+	has nothing to continue from, so the request is sent again as it was. Once
+	iterated, `extracted` holds the parsed response with the exercises of every
+	continuation merged in, and `content` its serialised form.
+
+	Args:
+		model (str): The model name to be used for the LLM.
+		client (OpenAI): The OpenAI client used to interact with the LLM.
+		messages (list[dict]): The conversation so far, ending with the extraction request.
+		max_tokens (int, optional): The maximum number of tokens of each response.
+		max_continuations (int, optional): The maximum number of continuation requests.
+	"""
+
+	def __init__(self, model: str, client: OpenAI, messages: list[dict[str, str]], max_tokens: int = 8192, max_continuations: int = 3):
+		self.model = model
+		self.client = client
+		self.messages = messages
+		self.max_tokens = max_tokens
+		self.max_continuations = max_continuations
+		self.extracted = None
+		self.content = None
+
+	def _finish(self, text: str, finish_reason: str, exercises: list[dict], continuation: int) -> bool:
+		"""
+		Returns:
+			bool: Whether the response is complete, in which case `extracted` and
+			`content` are set.
+
+		Raises:
+			RuntimeError: If the response is cut off after the last continuation.
+		"""
+		if finish_reason == "length":
+			if continuation == self.max_continuations:
+				raise RuntimeError("LLM response is still cut off after the maximum number of continuations.")
+			return False
+		extracted = parse_extraction_response(text)
+		if "exercises" in extracted or continuation > 0:
+			extracted["exercises"] = exercises
+		self.extracted = extracted
+		self.content = json.dumps(extracted, ensure_ascii=False)
+		return True
+
+	def _continue(self, messages: list[dict[str, str]], parser: JSONArrayStreamParser, exercises: list[dict]):
+		"""
+		Appends the partial answer and the continuation request to the conversation.
+		"""
+		prefix = parser.get_completed_prefix()
+		if not prefix:
+			print("The response was cut off before any exercise was complete. Sending the request again.")
+			return
+		print(f"The response was cut off after {len(exercises)} exercises. Asking the LLM to continue.")
+		messages.append({"role": "assistant", "content": prefix + "]}"})
+		messages.append({"role": "user", "content": (
+			f"Your response was cut off after the exercise with id \"{exercises[-1]['id']}\". "
+			"Please continue extracting the remaining exercises, and return them as a new JSON object with the same structure, without repeating the exercises above."
+		)})
+
+	def __iter__(self):
+		messages = list(self.messages)
+		exercises = []
+
+		for continuation in range(self.max_continuations + 1):
+			parser = JSONArrayStreamParser("exercises")
+			text = ""
+			finish_reason = None
+			for (delta, reason) in llm_chat_stream(self.model, self.client, messages, max_tokens=self.max_tokens):
+				text += delta
+				finish_reason = reason or finish_reason
+				for exercise in parser.feed(delta):
+					exercises.append(exercise)
+					yield exercise
+
+			if self._finish(text, finish_reason, exercises, continuation):
+				break
+			self._continue(messages, parser, exercises)
+
+class AsyncExtractionStream(ExtractionStream):
+	"""
+	Asynchronous counterpart of `ExtractionStream`, for use with an `AsyncOpenAI`
+	client and `async for`.
+	"""
+
+	async def __aiter__(self):
+		messages = list(self.messages)
+		exercises = []
+
+		for continuation in range(self.max_continuations + 1):
+			parser = JSONArrayStreamParser("exercises")
+			text = ""
+			finish_reason = None
+			async for (delta, reason) in llm_chat_stream_async(self.model, self.client, messages, max_tokens=self.max_tokens):
+				text += delta
+				finish_reason = reason or finish_reason
+				for exercise in parser.feed(delta):
+					exercises.append(exercise)
+					yield exercise
+
+			if self._finish(text, finish_reason, exercises, continuation):
+				break
+			self._continue(messages, parser, exercises)
+
+def get_file_meta(file: str) -> dict:
+	(syllabus_id, time_id, component_id) =  get_paper_meta(file)
+	return {"syllabus_id": syllabus_id, "time_id": time_id, "component_id": component_id}
+
+@telemetry_stage("extraction")
+def extract_exercises_to_json(paper_md_text: str, client: OpenAI, model: str, file_meta: dict = None, handshake: bool = False, stream: bool = False, min_exercises: int = 5):
 	"""
 	Extracts exercises from a PDF file and returns them as a JSON object.
 
@@ -16,6 +199,12 @@ def extract_exercises_to_json(paper_md_text: str, client: OpenAI, model: str, fi
 		pdf_path (str): The path to the PDF file from which exercises are to be extracted.
 		client (OpenAI): The OpenAI client used to interact with the LLM.
 		model (str): The model name to be used for the LLM.
+		handshake (bool, optional): Whether to wait for the LLM to confirm it is ready
+			before sending the paper, instead of sending it in a single shot.
+		stream (bool, optional): Whether to stream the response, continuing it when it
+			is cut off by the max_tokens limit (see `ExtractionStream`).
+		min_exercises (int, optional): The number of exercises below which the LLM is
+			asked to check again (see `check_extracted`).
 
 	Returns:
 		list: A list of dictionaries, where each dictionary represents an exercise with the following keys:
@@ -26,102 +215,413 @@ def extract_exercises_to_json(paper_md_text: str, client: OpenAI, model: str, fi
 			- figures (list): A list of figures or images associated with the exercise.
 
 	Raises:
-		RuntimeError: If the LLM is not ready or if the response from the LLM is not a valid JSON.
+		RuntimeError: If the LLM is not ready (in handshake mode) or if the response from the LLM is not a valid JSON.
 	"""
 
-	classification_prompt = pathlib.Path("prompts/extraction-prompt.md").read_text()
-	pre_content_prompt = pathlib.Path("prompts/extraction-pre-content-prompt.md").read_text()
-
-	pathlib.Path(get_filename_with_other_ext(file, "md")).write_text(paper_md_text)
+	pre_content_prompt = load_prompt("extraction-pre-content-prompt")
 
 	# model = "deepseek-chat"
 	# model = "glm-4-flash"
 
-	messages = [
-		{"role": "system", "content": classification_prompt},
-		{"role": "user", "content": "Are you ready to begin?"},
-	]
+	messages = open_conversation(model, client, "extraction-prompt", handshake=handshake)
+	messages.append({"role": "user", "content": f"{pre_content_prompt}\n\n{paper_md_text}"})
+
+	retry_times = 0
+	follow_up = None
+	extracted_exercises = []
+	while retry_times < 5:
+		with telemetry_context(attempt=retry_times, retry_reason=follow_up):
+			if stream:
+				response = ExtractionStream(model, client, messages)
+				for _ in response:
+					pass
+				messages.append({"role": "assistant", "content": response.content})
+				extracted = response.extracted
+			else:
+				response = llm_chat(model, client, messages, max_tokens=8192)
+				messages.append({"role": "assistant", "content": response.choices[0].message.content})
+				extracted = parse_extraction_response(response.choices[0].message.content)
+
+		follow_up = check_extracted(extracted, retry_times, min_exercises)
+		if follow_up is not None:
+			messages.append({"role": "user", "content": follow_up})
+			retry_times += 1
+			continue
 
-	response = llm_chat(model, client, messages)
-	if(json.loads(response.choices[0].message.content)["response"] != "ready"):
-		raise RuntimeError("LLM not ready, please check the prompt")
+		extracted_exercises = extracted["exercises"]
+		break
 
-	messages.append({"role": "assistant", "content": response.choices[0].message.content})
+	return prefix_exercise_ids(extracted_exercises, file_meta)
+
+@telemetry_stage("extraction")
+async def extract_exercises_to_json_async(paper_md_text: str, client: AsyncOpenAI, model: str, file_meta: dict = None, handshake: bool = False, min_exercises: int = 5, stream: bool = False):
+	"""
+	Asynchronous counterpart of `extract_exercises_to_json`, using an `AsyncOpenAI` client.
+
+	Returns:
+		list: The extracted exercises, in the same format as `extract_exercises_to_json`.
+
+	Raises:
+		RuntimeError: If the LLM is not ready (in handshake mode) or if the response from the LLM is not a valid JSON.
+	"""
+	pre_content_prompt = load_prompt("extraction-pre-content-prompt")
+
+	messages = await open_conversation_async(model, client, "extraction-prompt", handshake=handshake)
 	messages.append({"role": "user", "content": f"{pre_content_prompt}\n\n{paper_md_text}"})
 
 	retry_times = 0
-	exit_flag = False
+	follow_up = None
 	extracted_exercises = []
-	while not exit_flag and retry_times < 5:
-		response = llm_chat(model, client, messages, max_tokens=8192)
-		messages.append({"role": "assistant", "content": response.choices[0].message.content})
+	while retry_times < 5:
+		with telemetry_context(attempt=retry_times, retry_reason=follow_up):
+			if stream:
+				response = AsyncExtractionStream(model, client, messages)
+				async for _ in response:
+					pass
+				messages.append({"role": "assistant", "content": response.content})
+				extracted = response.extracted
+			else:
+				response = await llm_chat_async(model, client, messages, max_tokens=8192)
+				messages.append({"role": "assistant", "content": response.choices[0].message.content})
+				extracted = parse_extraction_response(response.choices[0].message.content)
 
-		try:
-			extracted = json.loads(response.choices[0].message.content)
-		except(json.JSONDecodeError):
-			raise RuntimeError("LLM response is not a valid JSON, check the max_tokens parameter.")
-
-		# If the extracted JSON does not contain the 'exercises' key, ask the LLM to check again
-		if "exercises" not in extracted:
-			print("The extracted JSON does not contain the 'exercises' key. Asking the LLM to check again.")
-			messages.append({"role": "user", "content": f"The extracted JSON does not contain the 'exercises' key. Please check the prompt and try again."})
+		follow_up = check_extracted(extracted, retry_times, min_exercises)
+		if follow_up is not None:
+			messages.append({"role": "user", "content": follow_up})
 			retry_times += 1
 			continue
 
-		exercises = extracted["exercises"]
+		extracted_exercises = extracted["exercises"]
+		break
+
+	return prefix_exercise_ids(extracted_exercises, file_meta)
 
-		# If the number of exercises is too small, ask the LLM to check again
-		if ((len(exercises) < 5) and (retry_times == 0)):
-			print("The number of exercises is too small. Asking the LLM to check again.")
-			messages.append({"role": "user", "content": f"Are you sure that you have extracted all the exercises? Please check again. \nIf everything works fine, please return the same JSON again. Otherwise, please extract again."})
-			retry_times += 1
+def stitch_segments(segments: list[dict], results: list[list[dict]], file_meta: dict = None):
+	"""
+	Joins the exercises extracted from the segments of a paper, in paper order.
+
+	Exercises extracted twice (e.g. a question repeated at the edge of a segment) are
+	kept once, and the questions of a segment missing from its exercises are reported.
+	The ids are prefixed once the exercises are joined.
+	"""
+	exercises = []
+	seen = set()
+	for (segment, extracted) in zip(segments, results):
+		found = set(get_exercise_question(exercise["id"]) for exercise in extracted)
+		missing = [number for number in segment["questions"] if number not in found]
+		if missing:
+			print(f"Warning: No exercise extracted for question(s) {', '.join(map(str, missing))}.")
+		for exercise in extracted:
+			if exercise["id"] in seen:
+				continue
+			seen.add(exercise["id"])
+			exercises.append(exercise)
+	return prefix_exercise_ids(exercises, file_meta)
+
+def extract_segmented_paper(paper_md_text: str, client: OpenAI, model: str, file_meta: dict = None, handshake: bool = False, stream: bool = False, max_chars: int = 12000, concurrency: int = 4):
+	"""
+	Extracts the exercises of a paper split at question boundaries (see
+	`paper_segmentation.segment_paper`), extracting the segments concurrently.
+
+	Args:
+		paper_md_text (str): The Markdown of the paper.
+		max_chars (int, optional): The target size of a segment.
+		concurrency (int, optional): The maximum number of segments extracted at the same time.
+
+	Other arguments and the return value are those of `extract_exercises_to_json`.
+	"""
+	segments = segment_paper(paper_md_text, max_chars)
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		# Worker threads do not inherit the telemetry tags of the caller
+		futures = [
+			executor.submit(
+				contextvars.copy_context().run, extract_exercises_to_json,
+				segment["text"], client, model, None, handshake, stream, len(segment["questions"]) or 5
+			)
+			for segment in segments
+		]
+		results = [future.result() for future in futures]
+	return stitch_segments(segments, results, file_meta)
+
+async def extract_segmented_paper_async(paper_md_text: str, client: AsyncOpenAI, model: str, file_meta: dict = None, handshake: bool = False, max_chars: int = 12000, stream: bool = False):
+	"""
+	Asynchronous counterpart of `extract_segmented_paper`. Concurrency is left to the
+	throttle of the LLM client layer.
+	"""
+	segments = segment_paper(paper_md_text, max_chars)
+	results = await asyncio.gather(*[
+		extract_exercises_to_json_async(segment["text"], client, model, None, handshake, len(segment["questions"]) or 5, stream)
+		for segment in segments
+	])
+	return stitch_segments(segments, results, file_meta)
+
+def get_extraction_prompt_version() -> str:
+	"""
+	Returns a fingerprint of the extraction prompts, so that papers extracted with an
+	older prompt are extracted again.
+	"""
+	prompts = [load_prompt("extraction-prompt"), load_prompt("extraction-pre-content-prompt")]
+	return hashlib.sha256("\n".join(prompts).encode("utf-8")).hexdigest()
+
+def get_extraction_entry(connection, file: str):
+	row = connection.execute(read_sql_file("src/queries/select-extraction-entry.sql"), (file,)).fetchone()
+	if row is None:
+		return None
+	return dict(zip(["pdf_hash", "json_hash", "prompt_version", "model", "status"], row))
+
+def update_extraction_manifest(connection, file: str, entry: dict, status: str):
+	"""
+	Records the extraction status of a paper. Extracted papers also record the hash of
+	the JSON written from them.
+	"""
+	json_path = get_filename_with_other_ext(file, "json")
+	json_hash = file_sha256(json_path) if status == "extracted" else None
+	with transaction(connection):
+		write_extraction_entry(connection, file, {**entry, "json_hash": json_hash, "status": status})
+
+def get_extraction_fingerprint(file: str, prompt_version: str, model: str) -> dict:
+	return {"pdf_hash": file_sha256(file), "prompt_version": prompt_version, "model": model}
+
+def get_extraction_state(connection, file: str, prompt_version: str, model: str):
+	"""
+	Compares a PDF paper with its extraction manifest entry.
+
+	Returns:
+		tuple: The manifest entry describing the paper as it is now, the previous entry
+		(or None), and whether its exercise JSON is up to date. A JSON without an entry
+		was extracted before extractions were recorded, and is taken as up to date.
+	"""
+	entry = get_extraction_fingerprint(file, prompt_version, model)
+	previous = get_extraction_entry(connection, file)
+	extracted = pathlib.Path(get_filename_with_other_ext(file, "json")).exists()
+	if previous is None:
+		return (entry, previous, extracted)
+	up_to_date = extracted and previous["status"] == "extracted" and all(previous[key] == entry[key] for key in entry)
+	return (entry, previous, up_to_date)
+
+def get_pending_extractions(connection, files: list[str], prompt_version: str, model: str) -> dict[str, dict]:
+	"""
+	Returns:
+		dict[str, dict]: The manifest entry of each paper still to be extracted: papers
+		that are new, changed, extracted with another prompt or model, or whose
+		extraction failed. Papers in a job that was not ingested yet are left out.
+	"""
+	in_open_jobs = set(source for job in get_open_batch_jobs(connection, "extraction") for source in job["items"]["sources"])
+	pending = {}
+	for file in files:
+		if file in in_open_jobs:
 			continue
+		(entry, previous, up_to_date) = get_extraction_state(connection, file, prompt_version, model)
+		if not up_to_date:
+			pending[file] = entry
+	return pending
 
-		exercise_valid_flag = True
-		for exercise in exercises:
-			if(set(exercise.keys()) != set(["id", "stem",  "options", "figures"])):
-				print("The extracted JSON does not contain the correct keys. Asking the LLM to check again.")
-				messages.append({"role": "user", "content": f"The extracted JSON does not contain the correct keys. Please check the prompt and try again."})
-				exercise_valid_flag = False
-				break
-			if(not isinstance(exercise["stem"], str)):
-				print("The extracted JSON does not contain the correct stem. Asking the LLM to check again.")
-				messages.append({"role": "user", "content": f"The extracted JSON does not contain the correct stem. Please check the prompt and try again."})
-				exercise_valid_flag = False
-				break
+def prepare_extraction_batch(connection, endpoint, pending: dict[str, dict], texts: dict[str, str], model: str, segmentation: dict = None, directory: str = "batch"):
+	"""
+	Writes the extraction requests of the pending papers (see `get_pending_extractions`),
+	segment by segment if `segmentation` is given, to a batch file and submits it. The
+	papers are marked as batched in the extraction manifest.
 
-		if(not exercise_valid_flag):
-			retry_times += 1
+	Batch requests cannot be followed up, so the results are validated without asking
+	the LLM to check again (see `ingest_extraction_batch`).
+
+	Returns:
+		dict | None: The job, or None if there is nothing to extract.
+	"""
+	pre_content_prompt = load_prompt("extraction-pre-content-prompt")
+	requests = []
+	sources = {}
+	for (file, entry) in pending.items():
+		if file not in texts:
 			continue
+		if segmentation is not None:
+			segments = segment_paper(texts[file], segmentation.get("max-chars", 12000))
+		else:
+			segments = [{"questions": [], "text": texts[file]}]
+		for (i, segment) in enumerate(segments):
+			messages = open_single_shot("extraction-prompt")
+			messages.append({"role": "user", "content": f"{pre_content_prompt}\n\n{segment['text']}"})
+			requests.append(batch_request(f"{file}#{i}", model, messages, True, 8192))
+		sources[file] = {"entry": entry, "segments": [{"questions": segment["questions"]} for segment in segments]}
 
-		exit_flag = True
-		extracted_exercises = extracted["exercises"]
+	if not requests:
+		return None
+	job = submit_batch_job(connection, endpoint, "extraction", requests, {"sources": sources}, directory)
+	for (file, source) in sources.items():
+		update_extraction_manifest(connection, file, source["entry"], "batched")
+	return job
 
-	# Use the given file meta to format the exercise id (adding meta prefix)
-	if file_meta is not None:
-		for exercise in extracted_exercises:
-			exercise["id"] = f'{get_paper_meta_prefix(file_meta["syllabus_id"], file_meta["time_id"], file_meta["component_id"])}-{exercise["id"]}'
+def ingest_extraction_batch(connection, job: dict, results: dict) -> dict[str, Exception]:
+	"""
+	Validates the results of an extraction job with `check_extracted`, stitches the
+	segments of each paper and writes the exercises next to it as JSON, the same way
+	the sequential loop does. The papers are marked as extracted in the extraction
+	manifest, or as pending if they failed or changed since they were batched.
+
+	Returns:
+		dict[str, Exception]: The papers that failed, with the error they failed with.
+			They are left to the next run.
+	"""
+	failed = {}
+	for (file, source) in job["items"]["sources"].items():
+		entry = source["entry"]
+		try:
+			if file_sha256(file) != entry["pdf_hash"]:
+				raise RuntimeError("the paper changed since it was batched")
+			extracted = []
+			for i in range(len(source["segments"])):
+				response = parse_extraction_response(get_content(results.get(f"{file}#{i}")))
+				# No follow-up is possible, so only the structure is checked
+				follow_up = check_extracted(response, 1)
+				if follow_up is not None:
+					raise RuntimeError(follow_up)
+				extracted.append(response["exercises"])
+		except (RuntimeError, OSError) as e:
+			print(f"Warning: Fail to extract exercises from {file} in batch job {job['job_id']} due to", e)
+			failed[file] = e
+			if pathlib.Path(file).exists():
+				update_extraction_manifest(connection, file, entry, "pending")
+			continue
+		exercises = stitch_segments(source["segments"], extracted, get_file_meta(file))
+		pathlib.Path(get_filename_with_other_ext(file, "json")).write_text(json.dumps(exercises, indent=2, ensure_ascii=False))
+		update_extraction_manifest(connection, file, entry, "extracted")
+	return failed
+
+async def extract_paper_async(file: str, client: AsyncOpenAI, model: str, semaphore: asyncio.Semaphore, converter: PDFMarkdownConverter, handshake: bool = False, segmentation: dict = None, stream: bool = False):
+	"""
+	Extracts the exercises of a single PDF paper and writes them next to it as JSON,
+	the same way the sequential loop does.
+
+	Args:
+		file (str): The path to the PDF paper.
+		client (AsyncOpenAI): The async client used to interact with the LLM.
+		model (str): The model name to be used for the LLM.
+		semaphore (asyncio.Semaphore): Limits how many papers are extracted at the same time.
+		converter (PDFMarkdownConverter): Converts the paper to Markdown, or reads it from the cache.
+		handshake (bool, optional): Whether to wait for the LLM to confirm it is ready.
+		segmentation (dict, optional): The `segmentation` section of `config.json`, to
+			extract the paper segment by segment.
+		stream (bool, optional): Whether to stream the responses (see `AsyncExtractionStream`).
+	"""
+	async with semaphore:
+		text = await asyncio.to_thread(converter.to_markdown, file)
+		pathlib.Path(get_filename_with_other_ext(file, "md")).write_text(text)
+		with telemetry_context(paper=file):
+			if segmentation is not None:
+				extracted = await extract_segmented_paper_async(text, client, model, get_file_meta(file), handshake, segmentation.get("max-chars", 12000), stream)
+			else:
+				extracted = await extract_exercises_to_json_async(text, client, model, get_file_meta(file), handshake, stream=stream)
+		pathlib.Path(get_filename_with_other_ext(file, "json")).write_text(json.dumps(extracted, indent=2, ensure_ascii=False))
 
-	return extracted_exercises
+async def batch_extract_async(files: list[str], client: AsyncOpenAI, model: str, converter: PDFMarkdownConverter, concurrency: int = 4, handshake: bool = False, segmentation: dict = None, stream: bool = False):
+	"""
+	Extracts several PDF papers concurrently. The papers are first converted to
+	Markdown together over the process pool of the converter.
+
+	A failure while converting or extracting one paper does not abort the others; it
+	is reported and returned instead.
+
+	Args:
+		files (list[str]): The paths to the PDF papers.
+		client (AsyncOpenAI): The async client used to interact with the LLM.
+		model (str): The model name to be used for the LLM.
+		converter (PDFMarkdownConverter): Converts the papers to Markdown, caching the output.
+		concurrency (int, optional): The maximum number of papers extracted at the same time.
+		handshake (bool, optional): Whether to wait for the LLM to confirm it is ready.
+		segmentation (dict, optional): The `segmentation` section of `config.json`, to
+			extract each paper segment by segment.
+		stream (bool, optional): Whether to stream the responses (see `AsyncExtractionStream`).
+
+	Returns:
+		dict[str, Exception]: The papers that failed, with the error they failed with.
+	"""
+	failed = {}
+	converted = await asyncio.to_thread(converter.convert, files, failed)
+	for (file, e) in failed.items():
+		print(f"Warning: Fail to convert {file} to Markdown due to", e)
+	semaphore = asyncio.Semaphore(concurrency)
+	progress_bar = tqdm.tqdm(total=len(converted))
+
+	async def run(file: str):
+		try:
+			await extract_paper_async(file, client, model, semaphore, converter, handshake, segmentation, stream)
+		except Exception as e:
+			print(f"Warning: Fail to extract exercises from {file} due to", e)
+			failed[file] = e
+		progress_bar.update(1)
+
+	await asyncio.gather(*[run(file) for file in files if file in converted])
+	progress_bar.close()
+	return failed
 
 def batch_extract_to_json(pdf_paths: list[str], client, model: str):
 	return [{"file": pdf_path, "json": extract_exercises_to_json(pdf_path, client, model)} for pdf_path in tqdm.tqdm(pdf_paths)]
 
 if __name__ == "__main__":
 	config = json.loads(pathlib.Path("config.json").read_text())
-	client = OpenAI(api_key=config["openai"]["key"], base_url=config["openai"]["base-url"])
-	# client = ZhipuAI(api_key=config["zhipuai"]["key"])
+	# Several keys or providers (e.g. ZhipuAI through its OpenAI-compatible API) are
+	# configured in the "providers" section
+	client = load_client(config)
 
 	pdf_folder = "papers"
 	model = config["model"]
+	set_llm_cache(load_llm_cache(config))
+	set_llm_throttle(load_llm_throttle(config))
+	set_telemetry(load_telemetry(config))
 
 	files = [file for file in list_files(pdf_folder) if file.endswith(".pdf")]
-	progress_bar = tqdm.tqdm(files)
+	converter = load_pdf_converter(config)
+	# "segmentation": {"max-chars": 12000, "concurrency": 4} extracts papers segment by segment
+	segmentation = config.get("segmentation")
 
-	for file in files:
-		text = pymupdf4llm.to_markdown(file, show_progress=False)
-		(syllabus_id, time_id, component_id) =  get_paper_meta(file)
-		file_meta = {"syllabus_id": syllabus_id, "time_id": time_id, "component_id": component_id}
-		extracted = extract_exercises_to_json(text, client, model, file_meta)
-		pathlib.Path(get_filename_with_other_ext(file, "json")).write_text(json.dumps(extracted, indent=2, ensure_ascii=False))
-		progress_bar.update(1)
+	# Batch jobs and the extraction manifest are tracked in the exercise database
+	connection = connect("./papers.db")
+	prepare_database(connection)
+	prompt_version = get_extraction_prompt_version()
+
+	# python src/extract_exercises.py [batch-prepare | batch-ingest]
+	mode = sys.argv[1] if len(sys.argv) > 1 else "interactive"
+	if mode in ["batch-prepare", "batch-ingest"]:
+		batch_config = config.get("batch", {})
+		endpoint = load_batch_endpoint(config, client)
+		if mode == "batch-prepare":
+			# Only the papers without an up-to-date JSON are converted and batched
+			pending = get_pending_extractions(connection, files, prompt_version, model)
+			failed = {}
+			texts = converter.convert(list(pending), failed)
+			for (file, e) in failed.items():
+				print(f"Warning: Fail to convert {file} to Markdown due to", e)
+			for file in texts:
+				pathlib.Path(get_filename_with_other_ext(file, "md")).write_text(texts[file])
+			job = prepare_extraction_batch(connection, endpoint, pending, texts, model, segmentation, batch_config.get("directory", "batch"))
+			print(f"Submitted batch job {job['job_id']}" if job is not None else "Nothing to extract.")
+		else:
+			for job in get_open_batch_jobs(connection, "extraction"):
+				results = collect_batch_job(connection, endpoint, job, batch_config.get("wait", False), batch_config.get("poll-interval", 60))
+				if results is not None:
+					ingest_extraction_batch(connection, job, results)
+					finish_batch_job(connection, job)
+	elif config.get("async", False):
+		async_client = load_async_client(config)
+		failed = asyncio.run(batch_extract_async(files, async_client, model, converter, config.get("concurrency", 4), config.get("handshake", False), segmentation, config.get("stream", False)))
+		for file in files:
+			if file not in failed:
+				update_extraction_manifest(connection, file, get_extraction_fingerprint(file, prompt_version, model), "extracted")
+	else:
+		failed = {}
+		texts = converter.convert(files, failed)
+		for (file, e) in failed.items():
+			print(f"Warning: Fail to convert {file} to Markdown due to", e)
+		progress_bar = tqdm.tqdm(texts)
+
+		for (file, text) in texts.items():
+			pathlib.Path(get_filename_with_other_ext(file, "md")).write_text(text)
+			with telemetry_context(paper=file):
+				if segmentation is not None:
+					extracted = extract_segmented_paper(text, client, model, get_file_meta(file), config.get("handshake", False), config.get("stream", False), segmentation.get("max-chars", 12000), segmentation.get("concurrency", 4))
+				else:
+					extracted = extract_exercises_to_json(text, client, model, get_file_meta(file), config.get("handshake", False), config.get("stream", False))
+			pathlib.Path(get_filename_with_other_ext(file, "json")).write_text(json.dumps(extracted, indent=2, ensure_ascii=False))
+			update_extraction_manifest(connection, file, get_extraction_fingerprint(file, prompt_version, model), "extracted")
+			progress_bar.update(1)
+	connection.close()
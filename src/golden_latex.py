@@ -0,0 +1,64 @@
+from latex_frontend import markdown2latex
+from compile_paper import remove_redundant_newline
+import difflib
+import pathlib
+import sys
+
+GOLDEN_DIR = "golden/latex"
+
+def render_case(markdown: str) -> dict:
+	"""
+	Returns:
+		dict: The LaTeX of a stem (`.tex`), and the same after the line break clean-up
+		of `compile_paper` (`.cleaned.tex`).
+	"""
+	latex = markdown2latex(markdown)
+	return {".tex": latex, ".cleaned.tex": remove_redundant_newline(latex)}
+
+def check_golden(directory: str = GOLDEN_DIR) -> list[str]:
+	"""
+	Renders each Markdown stem of the golden corpus (`<name>.md`) and compares the
+	result with its expected LaTeX (`<name>.tex` and `<name>.cleaned.tex`).
+
+	Returns:
+		list[str]: A unified diff for each mismatch, empty if the output is unchanged.
+	"""
+	failures = []
+	for path in sorted(pathlib.Path(directory).glob("*.md")):
+		for (suffix, actual) in render_case(path.read_text(encoding="utf-8")).items():
+			expected_path = path.with_suffix(suffix)
+			expected = expected_path.read_text(encoding="utf-8") if expected_path.exists() else ""
+			if actual != expected:
+				failures.append("".join(difflib.unified_diff(
+					expected.splitlines(keepends=True),
+					actual.splitlines(keepends=True),
+					str(expected_path),
+					"actual",
+				)))
+	return failures
+
+def update_golden(directory: str = GOLDEN_DIR):
+	"""
+	Rewrites the expected LaTeX of the golden corpus, after an intended change of output
+	(which also needs a new `RENDERER_VERSION`).
+	"""
+	for path in sorted(pathlib.Path(directory).glob("*.md")):
+		for (suffix, actual) in render_case(path.read_text(encoding="utf-8")).items():
+			path.with_suffix(suffix).write_text(actual, encoding="utf-8")
+
+if __name__ == "__main__":
+	# python src/golden_latex.py : checks the LaTeX frontend against the golden corpus
+	# python src/golden_latex.py update : rewrites the expected output
+	if len(sys.argv) > 1 and sys.argv[1] == "update":
+		update_golden()
+		print(f"Updated the golden corpus in {GOLDEN_DIR}.")
+		sys.exit(0)
+
+	failures = check_golden()
+	for failure in failures:
+		print(failure)
+	cases = len(list(pathlib.Path(GOLDEN_DIR).glob("*.md")))
+	if failures:
+		print(f"{len(failures)} mismatches in {cases} golden cases.")
+		sys.exit(1)
+	print(f"All {cases} golden cases match.")
@@ -0,0 +1,84 @@
+import json
+
+class JSONArrayStreamParser:
+	"""
+	An incremental parser that picks the elements of an array out of a JSON document
+	while the document is still being received.
+
+	Only the objects of the array stored under `key` in the top-level object are
+	returned, e.g. the exercises of `{"exercises": [{...}, {...}]}`. Each of them is
+	returned as soon as its closing brace arrives.
+
+	Args:
+		key (str): The key of the array in the top-level object.
+	"""
+
+	def __init__(self, key: str):
+		self.key = key
+		self.buffer = ""
+		self.position = 0
+		self.stack = []
+		self.in_string = False
+		self.escaped = False
+		self.string_start = None
+		self.last_string = None
+		self.array_key = None
+		self.element_start = None
+		self.completed_end = None
+
+	def feed(self, text: str) -> list:
+		"""
+		Feeds the next chunk of the document to the parser.
+
+		Args:
+			text (str): The next chunk of the document.
+
+		Returns:
+			list: The array elements completed by this chunk.
+		"""
+		self.buffer += text
+		completed = []
+		buffer = self.buffer
+
+		for i in range(self.position, len(buffer)):
+			char = buffer[i]
+			if self.in_string:
+				if self.escaped:
+					self.escaped = False
+				elif char == "\\":
+					self.escaped = True
+				elif char == '"':
+					self.in_string = False
+					if len(self.stack) == 1:
+						self.last_string = buffer[self.string_start:i + 1]
+				continue
+
+			if char == '"':
+				self.in_string = True
+				self.string_start = i
+			elif char in "{[":
+				if char == "[" and len(self.stack) == 1:
+					self.array_key = json.loads(self.last_string) if self.last_string else None
+				elif char == "{" and self.stack == ["{", "["]:
+					self.element_start = i
+				self.stack.append(char)
+			elif char in "}]":
+				if self.stack:
+					self.stack.pop()
+				if char == "}" and self.stack == ["{", "["] and self.element_start is not None:
+					if self.array_key == self.key:
+						completed.append(json.loads(buffer[self.element_start:i + 1]))
+						self.completed_end = i + 1
+					self.element_start = None
+
+		self.position = len(buffer)
+		return completed
+
+	def get_completed_prefix(self) -> str:
+		"""
+		Returns:
+			str: The document received so far, cut after the last completed element.
+		"""
+		if self.completed_end is None:
+			return ""
+		return self.buffer[:self.completed_end]
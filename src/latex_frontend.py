@@ -7,24 +7,39 @@ from mistune.util import strip_end
 from mistune.plugins.table import table
 from mistune.plugins.math import math
 
+# Bump whenever a change to the renderer changes its output, to invalidate the
+# LaTeX cached in the database
+RENDERER_VERSION = "1"
+
+ANSWER_AREA_PATTERN = re.compile(r'<answer-area size="(\d+)"\s*\/>')
+FIGURE_PATTERN = re.compile(r'<figure description="([^"]+)" id="([^"]+)"\s*\/>')
+FIGURE_OPENING = '<figure description="'
+
+# The characters escaped by `to_escaped_code`, unless already escaped
+ESCAPED_CHARACTER_PATTERN = re.compile(r"(?<!\\)([{}$&#^_~%])")
+
 def get_answer_area(size: int):
 	'''
 	<answer-area size="<integer>"/>
 	'''
 	return "\\\\" + "\\newline\n".join(["\\parbox[t][2em][c]{\\linewidth}{\\dotfill}"] * size) + "\\\\"
 
+def in_verbatim(latex_code: str, in_code_block: bool):
+	"""
+	Wraps LaTeX code inserted into a verbatim block, so that it is typeset rather than printed.
+	"""
+	if in_code_block:
+		return r"\end{verbatim}" + latex_code + r"\begin{verbatim}"
+	return latex_code
+
 def handle_answer_area(code: str, in_code_block = False):
-	pattern = re.compile(r'<answer-area size="(\d+)"\s*\/>')
-
-	exit_flag = False
-	while not exit_flag:
-		match = pattern.search(code)
-		if match:
-			size = int(match.group(1))
-			code = f"{code[:match.start()]}{r'\end{verbatim}' if in_code_block else ''}{get_answer_area(size) if (not in_code_block) else ('\\' + get_answer_area(size).strip("\\"))}{r'\begin{verbatim}' if in_code_block else ''}{code[match.end():]}"
-		else:
-			exit_flag = True
-	return code
+	def replace(match: re.Match) -> str:
+		size = int(match.group(1))
+		area = get_answer_area(size) if (not in_code_block) else ('\\' + get_answer_area(size).strip("\\"))
+		return in_verbatim(area, in_code_block)
+
+	# The replacement has neither "<" nor '"', so it never forms a new tag and one pass suffices
+	return ANSWER_AREA_PATTERN.sub(replace, code)
 
 def get_figure(description: str, id: str):
 	'''
@@ -42,35 +57,40 @@ f"""
 """
 
 def handle_figure(code: str, in_code_block = False):
-	pattern = re.compile(r'<figure description="([^"]+)" id="([^"]+)"\s*\/>')
-
-	exit_flag = False
-	while not exit_flag:
-		match = pattern.search(code)
-		if match:
-			(description, id) = match.groups()
-			code = f"{code[:match.start()]}{r'\end{verbatim}' if in_code_block else ''}{get_figure(description, id)}{r'\begin{verbatim}' if in_code_block else ''}{code[match.end():]}"
-		else:
-			exit_flag = True
+	replaced = 0
+
+	def replace(match: re.Match) -> str:
+		nonlocal replaced
+		replaced += 1
+		(description, id) = match.groups()
+		return in_verbatim(get_figure(description, id), in_code_block)
+
+	result = FIGURE_PATTERN.sub(replace, code)
+	if replaced == code.count(FIGURE_OPENING):
+		return result
+
+	# An unmatched opening may combine with a replacement into a new tag, which
+	# replacing the tags one by one (leftmost first) picks up. Only the last opening
+	# before a replacement can start such a tag, so the search resumes from there.
+	match = FIGURE_PATTERN.search(code)
+	while match:
+		code = code[:match.start()] + replace(match) + code[match.end():]
+		opening = code.rfind(FIGURE_OPENING, 0, match.start())
+		match = FIGURE_PATTERN.search(code, opening if opening != -1 else match.start())
 	return code
 
 def handle_custom_tags_to_latex(code: str, in_code_block = False):
+	if "<" not in code:
+		return code
 	code = handle_figure(code, in_code_block)
 	code = handle_answer_area(code, in_code_block)
 	return code
 
 def to_escaped_code(code: str) -> str:
-	code = re.sub(r"(?<!\\)\\", '\\\\', code)
-	code = re.sub(r"(?<!\\){", '\\{', code)
-	code = re.sub(r"(?<!\\)}", '\\}', code)
-	code = re.sub(r"(?<!\\)\$", '\\$', code)
-	code = re.sub(r"(?<!\\)&", '\\&', code)
-	code = re.sub(r"(?<!\\)#", '\\#', code)
-	code = re.sub(r"(?<!\\)\^", '\\^', code)
-	code = re.sub(r"(?<!\\)_", '\\_', code)
-	code = re.sub(r"(?<!\\)~", '\\~', code)
-	code = re.sub(r"(?<!\\)%", '\\%', code)
-	return code
+	"""
+	Escapes the special LaTeX characters of a text, leaving the already escaped ones as they are.
+	"""
+	return ESCAPED_CHARACTER_PATTERN.sub(r"\\\1", code)
 
 def render_list(
 	renderer: "BaseRenderer", token: Dict[str, Any], state: "BlockState"
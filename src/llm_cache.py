@@ -0,0 +1,237 @@
+import hashlib
+import json
+import pathlib
+import sqlite3
+import sys
+import threading
+import time
+
+CACHE_MODES = ("use", "refresh", "bypass")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+	key TEXT PRIMARY KEY, -- SHA-256 of the request (model, messages, response_format, max_tokens)
+	model TEXT NOT NULL,
+	response TEXT NOT NULL, -- The serialised chat completion
+	size INTEGER NOT NULL, -- Size of the serialised response in bytes
+	created_at REAL NOT NULL,
+	accessed_at REAL NOT NULL,
+	hit_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses (accessed_at);
+
+CREATE TABLE IF NOT EXISTS counters (
+	name TEXT PRIMARY KEY,
+	value INTEGER NOT NULL
+);
+"""
+
+
+def request_key(model: str, messages: list[dict[str, str]], response_format: dict, max_tokens: int) -> str:
+	"""
+	Computes the content address of a chat request.
+
+	Args:
+		model (str): The name of the LLM model.
+		messages (list[dict]): The messages sent to the LLM.
+		response_format (dict): The response format sent to the LLM, or None.
+		max_tokens (int): The maximum number of tokens to generate.
+
+	Returns:
+		str: The hex SHA-256 digest of the canonical JSON form of the request.
+	"""
+	canonical = json.dumps(
+		{"model": model, "messages": messages, "response_format": response_format, "max_tokens": max_tokens},
+		sort_keys=True,
+		ensure_ascii=False,
+		separators=(",", ":"),
+	)
+	return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+	"""
+	A persistent, content-addressed cache of LLM responses backed by SQLite.
+
+	Entries are keyed by `request_key`. Entries older than `max_age` seconds are
+	dropped, and the least recently used entries are evicted once the cache grows
+	beyond `max_size` bytes.
+
+	The `mode` controls how the cache is used:
+
+	- ``"use"``: serve hits from the cache and store misses.
+	- ``"refresh"``: never serve from the cache, but store the fresh responses.
+	- ``"bypass"``: neither read nor write the cache.
+	"""
+
+	def __init__(self, path: str = "cache/llm-cache.db", max_size: int = None, max_age: float = None, mode: str = "use"):
+		if mode not in CACHE_MODES:
+			raise ValueError(f"Unknown cache mode: {mode}")
+
+		self.path = path
+		self.max_size = max_size
+		self.max_age = max_age
+		self.mode = mode
+		self.hits = 0
+		self.misses = 0
+		self._puts_since_eviction = 0
+		self._lock = threading.Lock()
+
+		pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+		self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self._connection.execute("PRAGMA journal_mode=WAL")
+		self._connection.executescript(SCHEMA)
+		self.evict()
+
+	def get(self, key: str):
+		"""
+		Looks up a cached response.
+
+		Returns:
+			str | None: The serialised response, or None on a miss (or when the cache is not read).
+		"""
+		if self.mode != "use":
+			return None
+
+		now = time.time()
+		with self._lock:
+			row = self._connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+			if row is not None and self.max_age is not None and now - row[1] > self.max_age:
+				self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+				row = None
+
+			if row is None:
+				self.misses += 1
+				self._count("misses")
+				return None
+
+			self.hits += 1
+			self._count("hits")
+			self._connection.execute(
+				"UPDATE responses SET accessed_at = ?, hit_count = hit_count + 1 WHERE key = ?", (now, key)
+			)
+			return row[0]
+
+	def put(self, key: str, model: str, response: str):
+		"""
+		Stores a serialised response under the given key.
+		"""
+		if self.mode == "bypass":
+			return
+
+		now = time.time()
+		with self._lock:
+			self._connection.execute(
+				"INSERT OR REPLACE INTO responses (key, model, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+				(key, model, response, len(response.encode("utf-8")), now, now),
+			)
+			self._puts_since_eviction += 1
+
+		if self._puts_since_eviction >= 100:
+			self.evict()
+
+	def evict(self):
+		"""
+		Drops expired entries, then the least recently used ones until the cache fits `max_size`.
+
+		Returns:
+			int: The number of evicted entries.
+		"""
+		evicted = 0
+		with self._lock:
+			self._puts_since_eviction = 0
+			if self.max_age is not None:
+				evicted += self._connection.execute(
+					"DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,)
+				).rowcount
+
+			if self.max_size is not None:
+				total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+				if total > self.max_size:
+					stale = []
+					for (key, size) in self._connection.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC"):
+						if total <= self.max_size:
+							break
+						stale.append((key,))
+						total -= size
+					self._connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+					evicted += len(stale)
+		return evicted
+
+	def clear(self):
+		with self._lock:
+			self._connection.execute("DELETE FROM responses")
+			self._connection.execute("DELETE FROM counters")
+
+	def stats(self) -> dict:
+		"""
+		Returns:
+			dict: The number of entries and bytes stored, and the hit/miss counters of both
+			this session and the lifetime of the cache file.
+		"""
+		with self._lock:
+			(entries, size) = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+			counters = dict(self._connection.execute("SELECT name, value FROM counters").fetchall())
+		return {
+			"entries": entries,
+			"size": size,
+			"hits": self.hits,
+			"misses": self.misses,
+			"total-hits": counters.get("hits", 0),
+			"total-misses": counters.get("misses", 0),
+		}
+
+	def close(self):
+		self._connection.close()
+
+	def _count(self, name: str):
+		self._connection.execute(
+			"INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,)
+		)
+
+
+def load_llm_cache(config: dict):
+	"""
+	Creates the LLM cache described by the `cache` section of `config.json`.
+
+	```json
+	"cache": {
+		"path": "cache/llm-cache.db",
+		"max-size-mb": 512,
+		"max-age-days": 30,
+		"mode": "use"
+	}
+	```
+
+	Returns:
+		LLMCache | None: The cache, or None if `config.json` has no `cache` section.
+	"""
+	cache_config = config.get("cache")
+	if cache_config is None:
+		return None
+
+	max_size = cache_config.get("max-size-mb")
+	max_age = cache_config.get("max-age-days")
+	return LLMCache(
+		cache_config.get("path", "cache/llm-cache.db"),
+		int(max_size * 1024 * 1024) if max_size is not None else None,
+		max_age * 24 * 60 * 60 if max_age is not None else None,
+		cache_config.get("mode", "use"),
+	)
+
+
+if __name__ == "__main__":
+	config = json.loads(pathlib.Path("config.json").read_text())
+	cache = load_llm_cache(config) or LLMCache()
+	command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+
+	if command == "evict":
+		print(f"Evicted {cache.evict()} entries.")
+	elif command == "clear":
+		cache.clear()
+		print("Cleared the LLM cache.")
+	elif command != "stats":
+		print(f"Unknown command: {command} (expected stats, evict or clear)")
+		exit(1)
+	print(json.dumps(cache.stats(), indent=2))
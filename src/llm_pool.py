@@ -0,0 +1,315 @@
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+import importlib.util
+import json
+import random
+import threading
+import time
+
+import httpx
+
+from llm_throttle import is_retryable, get_status_code, get_retry_after
+
+# Errors by which a provider, rather than the request, is at fault
+PROVIDER_ERROR_STATUS = set([401, 402, 403])
+
+def is_provider_error(error: BaseException) -> bool:
+	return is_retryable(error) or get_status_code(error) in PROVIDER_ERROR_STATUS
+
+def get_http_limits(http_config: dict) -> dict:
+	"""
+	Returns the settings of the pooled httpx connections described by the `http`
+	section of `config.json`.
+	"""
+	return {
+		"http2": http_config.get("http2", False),
+		"limits": httpx.Limits(
+			max_connections=http_config.get("max-connections", 64),
+			max_keepalive_connections=http_config.get("max-keepalive-connections", 32),
+			keepalive_expiry=http_config.get("keepalive-expiry", 30),
+		),
+	}
+
+class Provider:
+	"""
+	One key and base URL of the pool, with a sync and an async client sharing its
+	connection settings, and the statistics used for routing.
+
+	Args:
+		name (str): The name of the provider, for reporting.
+		key (str): The API key.
+		base_url (str): The base URL of the OpenAI-compatible API.
+		weight (float, optional): The share of the requests routed to the provider,
+			relative to the other providers, all else being equal.
+		model (str, optional): The model to use with this provider, overriding the
+			model of the requests (e.g. when providers name the same model differently).
+		http_config (dict, optional): The `http` section of `config.json`.
+	"""
+
+	def __init__(self, name: str, key: str, base_url: str, weight: float = 1.0, model: str = None, http_config: dict = {}):
+		self.name = name
+		self.key = key
+		self.base_url = base_url
+		self.weight = weight
+		self.model = model
+		self.http_config = http_config
+		self._client = None
+		self._async_client = None
+		self._views = {}
+		self._lock = threading.Lock()
+
+		self.latency = None # Exponentially weighted moving average, in seconds
+		self.in_flight = 0
+		self.failures = 0
+		self.down_until = 0.0
+		self.calls = 0
+		self.errors = 0
+
+	def get_client(self, asynchronous: bool = False, options: dict = None):
+		"""
+		Returns the client of the provider, with the given `with_options` applied.
+		Clients are created once, so that their connections are reused.
+		"""
+		with self._lock:
+			if asynchronous and self._async_client is None:
+				self._async_client = AsyncOpenAI(
+					api_key=self.key,
+					base_url=self.base_url,
+					timeout=self.http_config.get("timeout", 600),
+					http_client=DefaultAsyncHttpxClient(**get_http_limits(self.http_config)),
+				)
+			elif not asynchronous and self._client is None:
+				self._client = OpenAI(
+					api_key=self.key,
+					base_url=self.base_url,
+					timeout=self.http_config.get("timeout", 600),
+					http_client=DefaultHttpxClient(**get_http_limits(self.http_config)),
+				)
+			client = self._async_client if asynchronous else self._client
+			if not options:
+				return client
+			key = (asynchronous, tuple(sorted(options.items())))
+			if key not in self._views:
+				self._views[key] = client.with_options(**options)
+			return self._views[key]
+
+	def is_up(self, now: float) -> bool:
+		return now >= self.down_until
+
+	def on_start(self):
+		with self._lock:
+			self.in_flight += 1
+			self.calls += 1
+
+	def on_success(self, latency: float, alpha: float = 0.3):
+		with self._lock:
+			self.in_flight -= 1
+			self.failures = 0
+			self.latency = latency if self.latency is None else alpha * latency + (1 - alpha) * self.latency
+
+	def on_failure(self, error: BaseException, base_cooldown: float = 1.0, max_cooldown: float = 300.0):
+		"""
+		Takes the provider out of the rotation for a while, doubling the delay with each
+		consecutive failure, or for the delay requested by the provider.
+		"""
+		with self._lock:
+			self.in_flight -= 1
+			self.errors += 1
+			self.failures += 1
+			cooldown = get_retry_after(error)
+			if cooldown is None:
+				cooldown = min(max_cooldown, base_cooldown * 2 ** (self.failures - 1))
+			self.down_until = time.monotonic() + cooldown
+
+	def on_abort(self):
+		with self._lock:
+			self.in_flight -= 1
+
+class ClientPool:
+	"""
+	A pool of providers standing in for an OpenAI (or AsyncOpenAI) client: requests made
+	through `pool.chat.completions.create` are routed to one of the providers, and fail
+	over to the next one on provider errors (rate limits, server and connection errors,
+	rejected keys).
+
+	Providers are picked at random in proportion to their weight divided by their
+	current latency, scaled down by the requests they already have in flight. Failing
+	providers are left out of the rotation for an increasing delay.
+
+	Other attributes (e.g. `files` and `batches`) are those of the client of the first
+	provider.
+
+	Args:
+		providers (list[Provider]): The providers of the pool.
+		asynchronous (bool, optional): Whether the pool stands in for an AsyncOpenAI client.
+		options (dict, optional): The `with_options` applied to the clients of the providers.
+	"""
+
+	def __init__(self, providers: list[Provider], asynchronous: bool = False, options: dict = None):
+		if not providers:
+			raise ValueError("A client pool needs at least one provider")
+		self.providers = providers
+		self.asynchronous = asynchronous
+		self.options = options or {}
+		self.chat = _Chat(self)
+		self._random = random.Random()
+
+	def with_options(self, **options):
+		return ClientPool(self.providers, self.asynchronous, {**self.options, **options})
+
+	def __getattr__(self, name: str):
+		return getattr(self.providers[0].get_client(self.asynchronous, self.options), name)
+
+	def get_score(self, provider: Provider, default_latency: float) -> float:
+		return provider.weight / ((provider.latency or default_latency) * (1 + provider.in_flight))
+
+	def route(self, exclude: set = set()) -> Provider:
+		"""
+		Picks the provider of the next request among the providers not in `exclude`.
+		If they are all out of the rotation, the first one back is picked.
+		"""
+		candidates = [provider for provider in self.providers if provider not in exclude]
+		now = time.monotonic()
+		up = [provider for provider in candidates if provider.is_up(now)]
+		if not up:
+			return min(candidates, key=lambda provider: provider.down_until)
+
+		latencies = [provider.latency for provider in up if provider.latency is not None]
+		default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+		scores = [self.get_score(provider, default_latency) for provider in up]
+		return self._random.choices(up, weights=scores)[0]
+
+	def _prepare(self, provider: Provider, kwargs: dict) -> dict:
+		return {**kwargs, "model": provider.model} if provider.model is not None else kwargs
+
+	def create(self, **kwargs):
+		tried = set()
+		while True:
+			provider = self.route(tried)
+			provider.on_start()
+			started = time.perf_counter()
+			try:
+				response = provider.get_client(False, self.options).chat.completions.create(**self._prepare(provider, kwargs))
+			except BaseException as e:
+				if not isinstance(e, Exception) or not is_provider_error(e):
+					provider.on_abort()
+					raise
+				provider.on_failure(e)
+				tried.add(provider)
+				if len(tried) == len(self.providers):
+					raise
+				print(f"Warning: Provider {provider.name} failed due to {type(e).__name__}, failing over.")
+				continue
+			# For streams, this is the time until the response starts
+			provider.on_success(time.perf_counter() - started)
+			return response
+
+	async def create_async(self, **kwargs):
+		tried = set()
+		while True:
+			provider = self.route(tried)
+			provider.on_start()
+			started = time.perf_counter()
+			try:
+				response = await provider.get_client(True, self.options).chat.completions.create(**self._prepare(provider, kwargs))
+			except BaseException as e:
+				if not isinstance(e, Exception) or not is_provider_error(e):
+					provider.on_abort()
+					raise
+				provider.on_failure(e)
+				tried.add(provider)
+				if len(tried) == len(self.providers):
+					raise
+				print(f"Warning: Provider {provider.name} failed due to {type(e).__name__}, failing over.")
+				continue
+			provider.on_success(time.perf_counter() - started)
+			return response
+
+	def get_stats(self) -> list[dict]:
+		return [
+			{
+				"name": provider.name,
+				"calls": provider.calls,
+				"errors": provider.errors,
+				"latency": provider.latency,
+				"in_flight": provider.in_flight,
+				"up": provider.is_up(time.monotonic()),
+			}
+			for provider in self.providers
+		]
+
+class _Completions:
+	def __init__(self, pool: ClientPool):
+		self.pool = pool
+
+	def create(self, **kwargs):
+		if self.pool.asynchronous:
+			return self.pool.create_async(**kwargs)
+		return self.pool.create(**kwargs)
+
+class _Chat:
+	def __init__(self, pool: ClientPool):
+		self.completions = _Completions(pool)
+
+def load_providers(config: dict) -> list[Provider]:
+	"""
+	Creates the providers described by the `providers` section of `config.json`, or a
+	single provider from the `openai` section if there is none.
+
+	```json
+	"providers": [
+		{"name": "deepseek-1", "key": "...", "base-url": "https://api.deepseek.com", "weight": 2},
+		{"name": "deepseek-2", "key": "...", "base-url": "https://api.deepseek.com", "weight": 1},
+		{"name": "zhipuai", "key": "...", "base-url": "https://open.bigmodel.cn/api/paas/v4/", "model": "glm-4-flash"}
+	],
+	"http": {
+		"http2": true,
+		"max-connections": 64,
+		"max-keepalive-connections": 32,
+		"keepalive-expiry": 30,
+		"timeout": 600
+	}
+	```
+	"""
+	http_config = config.get("http", {})
+	if http_config.get("http2", False) and importlib.util.find_spec("h2") is None:
+		print("Warning: HTTP/2 needs the h2 package (pip install httpx[http2]), falling back to HTTP/1.1.")
+		http_config = {**http_config, "http2": False}
+	providers_config = config.get("providers")
+	if providers_config is None:
+		providers_config = [{"name": "openai", "key": config["openai"]["key"], "base-url": config["openai"]["base-url"]}]
+	return [
+		Provider(
+			provider_config.get("name", f"provider-{i + 1}"),
+			provider_config["key"],
+			provider_config["base-url"],
+			provider_config.get("weight", 1.0),
+			provider_config.get("model"),
+			http_config,
+		)
+		for (i, provider_config) in enumerate(providers_config)
+	]
+
+_providers = {}
+
+def _get_providers(config: dict) -> list[Provider]:
+	# The sync and async clients of a run share the same providers and statistics
+	key = json.dumps([config.get("providers"), config.get("openai"), config.get("http")], sort_keys=True)
+	if key not in _providers:
+		_providers[key] = load_providers(config)
+	return _providers[key]
+
+def load_client(config: dict):
+	"""
+	Creates the client used by the scripts: a pool over the providers of `config.json`
+	(see `load_providers`), with pooled keep-alive connections.
+
+	Returns:
+		ClientPool: A stand-in for an OpenAI client.
+	"""
+	return ClientPool(_get_providers(config))
+
+def load_async_client(config: dict):
+	"""
+	Asynchronous counterpart of `load_client`, standing in for an AsyncOpenAI client.
+	"""
+	return ClientPool(_get_providers(config), asynchronous=True)
@@ -0,0 +1,268 @@
+from contextlib import contextmanager
+import contextvars
+import functools
+import inspect
+import json
+import pathlib
+import sys
+import threading
+import time
+
+# What the LLM calls made in the current context are made for. Asyncio tasks
+# inherit the context they are created in; threads need `contextvars.copy_context`.
+_stage = contextvars.ContextVar("llm_stage", default=None)
+_paper = contextvars.ContextVar("llm_paper", default=None)
+_attempt = contextvars.ContextVar("llm_attempt", default=0)
+_retry_reason = contextvars.ContextVar("llm_retry_reason", default=None)
+
+@contextmanager
+def telemetry_context(stage: str = None, paper: str = None, attempt: int = None, retry_reason: str = None):
+	"""
+	Tags the LLM calls made within the block with a stage, a paper and a retry attempt.
+	Tags left as None keep the value of the enclosing block.
+	"""
+	tokens = []
+	for (variable, value) in [(_stage, stage), (_paper, paper), (_attempt, attempt), (_retry_reason, retry_reason)]:
+		if value is not None:
+			tokens.append((variable, variable.set(value)))
+	try:
+		yield
+	finally:
+		for (variable, token) in reversed(tokens):
+			variable.reset(token)
+
+def telemetry_stage(stage: str):
+	"""
+	Decorates a function, or a coroutine function, so that the LLM calls it makes are
+	tagged with the given stage.
+	"""
+	def decorator(function):
+		if inspect.iscoroutinefunction(function):
+			@functools.wraps(function)
+			async def async_wrapper(*args, **kwargs):
+				with telemetry_context(stage=stage):
+					return await function(*args, **kwargs)
+			return async_wrapper
+
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			with telemetry_context(stage=stage):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+class TelemetryRecorder:
+	"""
+	Appends a JSON line per LLM call to a file.
+
+	Each record holds the stage, paper, model, retry attempt, outcome ("ok", "length",
+	"cached", "error", or "abandoned" for streams closed early), token usage,
+	wall-clock latency and, for streamed calls, the time to the first token.
+
+	Args:
+		path (str, optional): The path to the JSONL file.
+	"""
+
+	def __init__(self, path: str = "cache/telemetry.jsonl"):
+		self.path = path
+		self._lock = threading.Lock()
+		pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+		self._file = open(path, "a", encoding="utf-8")
+
+	def record(self, record: dict):
+		line = json.dumps(record, ensure_ascii=False)
+		with self._lock:
+			self._file.write(line + "\n")
+			self._file.flush()
+
+	def close(self):
+		with self._lock:
+			self._file.close()
+
+telemetry: TelemetryRecorder = None
+
+def set_telemetry(recorder: TelemetryRecorder):
+	"""
+	Installs the recorder of the LLM calls, or None to disable telemetry.
+	"""
+	global telemetry
+	telemetry = recorder
+
+def load_telemetry(config: dict):
+	"""
+	Creates the recorder described by the `telemetry` section of `config.json`.
+
+	```json
+	"telemetry": {
+		"path": "cache/telemetry.jsonl",
+		"pricing": {
+			"deepseek-chat": {"prompt": 0.27, "completion": 1.10}
+		}
+	}
+	```
+
+	Prices are in dollars per million tokens, and are only used by the report.
+
+	Returns:
+		TelemetryRecorder | None: The recorder, or None if `config.json` has no `telemetry` section.
+	"""
+	telemetry_config = config.get("telemetry")
+	if telemetry_config is None:
+		return None
+	return TelemetryRecorder(telemetry_config.get("path", "cache/telemetry.jsonl"))
+
+def estimate_tokens(text: str) -> int:
+	return len(text) // 4 + 1
+
+def record_call(model: str, started: float, outcome: str, usage=None, finish_reason: str = None, time_to_first_token: float = None, stream: bool = False, error: BaseException = None, estimated_prompt: str = None, estimated_completion: str = None):
+	"""
+	Records one LLM call with the tags of the current context.
+
+	Args:
+		model (str): The name of the LLM model.
+		started (float): The `time.perf_counter()` of the start of the call.
+		outcome (str): "ok", "length", "cached", "error" or "abandoned".
+		usage (optional): The `usage` block of the response, if any.
+		finish_reason (str, optional): The finish reason of the response.
+		time_to_first_token (float, optional): Seconds until the first streamed token.
+		stream (bool, optional): Whether the response was streamed.
+		error (BaseException, optional): The error the call failed with.
+		estimated_prompt (str, optional): The prompt to estimate the prompt tokens
+			from, when the response carries no usage (e.g. streams).
+		estimated_completion (str, optional): The content to estimate the completion
+			tokens from, likewise.
+	"""
+	if telemetry is None:
+		return
+
+	prompt_tokens = getattr(usage, "prompt_tokens", None)
+	completion_tokens = getattr(usage, "completion_tokens", None)
+	estimated = False
+	if prompt_tokens is None and estimated_prompt is not None:
+		prompt_tokens = estimate_tokens(estimated_prompt)
+		estimated = True
+	if completion_tokens is None and estimated_completion is not None:
+		completion_tokens = estimate_tokens(estimated_completion)
+		estimated = True
+
+	telemetry.record({
+		"time": time.time(),
+		"stage": _stage.get(),
+		"paper": _paper.get(),
+		"model": model,
+		"attempt": _attempt.get(),
+		"retry_reason": _retry_reason.get(),
+		"outcome": outcome,
+		"finish_reason": finish_reason,
+		"stream": stream,
+		"prompt_tokens": prompt_tokens,
+		"completion_tokens": completion_tokens,
+		"estimated_tokens": estimated,
+		"latency": time.perf_counter() - started,
+		"time_to_first_token": time_to_first_token,
+		"error": f"{type(error).__name__}: {error}" if error is not None else None,
+	})
+
+def record_response(model: str, started: float, response, cached: bool = False):
+	"""
+	Records a non-streamed call from its chat completion.
+	"""
+	if telemetry is None:
+		return
+	finish_reason = response.choices[0].finish_reason if response.choices else None
+	if cached:
+		outcome = "cached"
+	else:
+		outcome = "length" if finish_reason == "length" else "ok"
+	record_call(model, started, outcome, response.usage, finish_reason)
+
+def read_records(path: str) -> list[dict]:
+	records = []
+	with open(path, encoding="utf-8") as file:
+		for line in file:
+			if line.strip():
+				records.append(json.loads(line))
+	return records
+
+def percentile(values: list[float], p: float):
+	if not values:
+		return None
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def get_cost(record: dict, pricing: dict) -> float:
+	"""
+	Computes the cost of a call in dollars. Cached calls cost nothing.
+	"""
+	prices = pricing.get(record["model"])
+	if prices is None or record["outcome"] == "cached":
+		return 0.0
+	return ((record["prompt_tokens"] or 0) * prices.get("prompt", 0) + (record["completion_tokens"] or 0) * prices.get("completion", 0)) / 1_000_000
+
+def summarise(records: list[dict], key: str, pricing: dict) -> dict[str, dict]:
+	"""
+	Aggregates calls by a record field (e.g. "stage" or "paper").
+
+	Returns:
+		dict[str, dict]: For each value of the field, the number of calls, retries,
+		errors and truncations, the tokens, the cost and the latency percentiles.
+	"""
+	groups = {}
+	for record in records:
+		groups.setdefault(record.get(key) or "-", []).append(record)
+
+	summary = {}
+	for (name, group) in sorted(groups.items()):
+		live = [record for record in group if record["outcome"] != "cached"]
+		latencies = [record["latency"] for record in live]
+		first_tokens = [record["time_to_first_token"] for record in live if record.get("time_to_first_token") is not None]
+		summary[name] = {
+			"calls": len(group),
+			"cached": len(group) - len(live),
+			"retries": sum(1 for record in group if record.get("attempt")),
+			"errors": sum(1 for record in group if record["outcome"] == "error"),
+			"truncated": sum(1 for record in group if record["outcome"] == "length"),
+			"prompt_tokens": sum(record["prompt_tokens"] or 0 for record in live),
+			"completion_tokens": sum(record["completion_tokens"] or 0 for record in live),
+			"cost": sum(get_cost(record, pricing) for record in group),
+			"latency_total": sum(latencies),
+			"latency_p50": percentile(latencies, 50),
+			"latency_p95": percentile(latencies, 95),
+			"ttft_p50": percentile(first_tokens, 50),
+			"ttft_p95": percentile(first_tokens, 95),
+		}
+	return summary
+
+def print_summary(title: str, summary: dict[str, dict]):
+	def seconds(value):
+		return f"{value:.2f}s" if value is not None else "-"
+
+	print(title)
+	print(f"{'':<32} {'calls':>6} {'cached':>6} {'retry':>6} {'error':>6} {'trunc':>6} {'prompt':>10} {'compl.':>10} {'cost':>9} {'total':>9} {'p50':>8} {'p95':>8} {'ttft50':>8} {'ttft95':>8}")
+	for (name, row) in summary.items():
+		print(
+			f"{name[:32]:<32} {row['calls']:>6} {row['cached']:>6} {row['retries']:>6} {row['errors']:>6} {row['truncated']:>6} "
+			f"{row['prompt_tokens']:>10} {row['completion_tokens']:>10} {'$' + format(row['cost'], '.4f'):>9} "
+			f"{seconds(row['latency_total']):>9} {seconds(row['latency_p50']):>8} {seconds(row['latency_p95']):>8} "
+			f"{seconds(row['ttft_p50']):>8} {seconds(row['ttft_p95']):>8}"
+		)
+	print()
+
+if __name__ == "__main__":
+	# python src/llm_telemetry.py report [path]
+	config = json.loads(pathlib.Path("config.json").read_text()) if pathlib.Path("config.json").exists() else {}
+	telemetry_config = config.get("telemetry", {})
+	command = sys.argv[1] if len(sys.argv) > 1 else "report"
+	if command != "report":
+		print(f"Unknown command: {command} (expected report)")
+		exit(1)
+
+	path = sys.argv[2] if len(sys.argv) > 2 else telemetry_config.get("path", "cache/telemetry.jsonl")
+	if not pathlib.Path(path).exists():
+		print(f"No telemetry recorded at {path}")
+		exit(1)
+	records = read_records(path)
+	pricing = telemetry_config.get("pricing", {})
+	print_summary("By stage", summarise(records, "stage", pricing))
+	print_summary("By paper", summarise(records, "paper", pricing))
+	print_summary("By model", summarise(records, "model", pricing))
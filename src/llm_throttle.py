@@ -0,0 +1,319 @@
+import asyncio
+import random
+import threading
+import time
+
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS = set([408, 409, 429, 500, 502, 503, 504])
+# Status codes by which the provider asks us to slow down
+PUSHBACK_STATUS = set([429, 503])
+
+def get_status_code(error: BaseException):
+	return getattr(error, "status_code", None)
+
+def get_retry_after(error: BaseException):
+	"""
+	Reads the delay requested by the provider in the `Retry-After` (or `retry-after-ms`)
+	header of an error response.
+
+	Returns:
+		float | None: The delay in seconds, or None if the provider did not request one.
+	"""
+	response = getattr(error, "response", None)
+	headers = getattr(response, "headers", None)
+	if headers is None:
+		return None
+	try:
+		if headers.get("retry-after-ms") is not None:
+			return float(headers["retry-after-ms"]) / 1000
+		if headers.get("retry-after") is not None:
+			return float(headers["retry-after"])
+	except ValueError:
+		# HTTP dates are not worth parsing for the delays providers use
+		return None
+	return None
+
+def is_timeout(error: BaseException) -> bool:
+	return "Timeout" in type(error).__name__
+
+def is_retryable(error: BaseException) -> bool:
+	status = get_status_code(error)
+	if status is not None:
+		return status in RETRYABLE_STATUS
+	# No response at all: timeouts and connection errors
+	return is_timeout(error) or "Connection" in type(error).__name__
+
+def is_pushback(error: BaseException) -> bool:
+	return get_status_code(error) in PUSHBACK_STATUS or is_timeout(error)
+
+class TokenBucket:
+	"""
+	A token bucket refilled continuously at `rate` units per minute, holding at most
+	`capacity` units (one minute worth by default).
+
+	Units are taken before they are available, and the caller waits until the
+	bucket is back to zero, so that requests larger than the bucket still go through.
+	"""
+
+	def __init__(self, rate: float, capacity: float = None):
+		self.rate = rate / 60
+		self.capacity = capacity if capacity is not None else rate
+		self.level = self.capacity
+		self.updated = time.monotonic()
+		self._lock = threading.Lock()
+
+	def _refill(self, now: float):
+		self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def reserve(self, amount: float) -> float:
+		"""
+		Takes units from the bucket.
+
+		Returns:
+			float: The number of seconds to wait before using them.
+		"""
+		with self._lock:
+			now = time.monotonic()
+			self._refill(now)
+			self.level -= min(amount, self.capacity)
+			return max(0.0, -self.level / self.rate)
+
+	def adjust(self, amount: float):
+		"""
+		Takes (or gives back, if negative) units after the fact, e.g. once the actual
+		token usage of a response is known.
+		"""
+		with self._lock:
+			self._refill(time.monotonic())
+			self.level = min(self.capacity, self.level - amount)
+
+class AdaptiveConcurrencyLimiter:
+	"""
+	Limits the number of requests in flight, adapting the limit with AIMD: it grows
+	by about one per round of successful requests, and halves when the provider
+	pushes back (at most once per `cooldown` seconds, so that one burst of 429s
+	counts as a single signal).
+
+	Args:
+		initial (int): The initial limit.
+		minimum (int, optional): The lowest the limit may go.
+		maximum (int, optional): The highest the limit may go.
+		cooldown (float, optional): The minimum number of seconds between two decreases.
+	"""
+
+	def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, cooldown: float = 2.0):
+		self.limit = float(initial)
+		self.minimum = minimum
+		self.maximum = maximum
+		self.cooldown = cooldown
+		self.in_flight = 0
+		self.decreased = 0.0
+		self._condition = threading.Condition()
+
+	def try_acquire(self) -> bool:
+		with self._condition:
+			if self.in_flight < max(self.minimum, int(self.limit)):
+				self.in_flight += 1
+				return True
+			return False
+
+	def acquire(self):
+		with self._condition:
+			while self.in_flight >= max(self.minimum, int(self.limit)):
+				self._condition.wait()
+			self.in_flight += 1
+
+	async def acquire_async(self):
+		# Waiting on the condition would block the event loop, so poll instead
+		delay = 0.01
+		while not self.try_acquire():
+			await asyncio.sleep(delay)
+			delay = min(delay * 2, 0.2)
+
+	def release(self, outcome: str):
+		"""
+		Frees a slot, adapting the limit to the outcome of the request: "success",
+		"pushback" or "error" (which leaves the limit unchanged).
+		"""
+		with self._condition:
+			self.in_flight -= 1
+			if outcome == "success":
+				self.limit = min(self.maximum, self.limit + 1 / self.limit)
+			elif outcome == "pushback":
+				now = time.monotonic()
+				if now - self.decreased >= self.cooldown:
+					self.limit = max(self.minimum, self.limit / 2)
+					self.decreased = now
+			self._condition.notify_all()
+
+class LLMThrottle:
+	"""
+	Paces the requests to the LLM provider, shared by every stage of the pipeline.
+
+	Before a request is sent, it waits for a slot of the adaptive concurrency limiter,
+	for the requests per minute and tokens per minute buckets, and for any pause
+	requested by the provider. Failed requests are retried with exponential backoff
+	and full jitter, or after the delay given by `Retry-After`, which also pauses
+	every other request.
+
+	Args:
+		requests_per_minute (float, optional): The request rate limit, if any.
+		tokens_per_minute (float, optional): The token rate limit, if any.
+		initial_concurrency (int, optional): The initial number of requests in flight.
+		min_concurrency (int, optional): The lowest number of requests in flight.
+		max_concurrency (int, optional): The highest number of requests in flight.
+		max_retries (int, optional): How many times a failed request is retried.
+		base_delay (float, optional): The backoff delay of the first retry, in seconds.
+		max_delay (float, optional): The maximum backoff delay, in seconds.
+		timeout (float, optional): The timeout of each request, in seconds.
+	"""
+
+	def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None, initial_concurrency: int = 4, min_concurrency: int = 1, max_concurrency: int = 32, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0, timeout: float = None):
+		self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+		self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+		self.limiter = AdaptiveConcurrencyLimiter(initial_concurrency, min_concurrency, max_concurrency)
+		self.max_retries = max_retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.timeout = timeout
+		self.paused_until = 0.0
+		self._random = random.Random()
+
+	def prepare_client(self, client):
+		"""
+		Returns a view of the client without its own retries, which would otherwise
+		multiply with the retries of the throttle, and with the configured timeout.
+		"""
+		with_options = getattr(client, "with_options", None)
+		if with_options is None:
+			return client
+		if self.timeout is not None:
+			return with_options(max_retries=0, timeout=self.timeout)
+		return with_options(max_retries=0)
+
+	def _wait_time(self, tokens: int) -> float:
+		wait = max(0.0, self.paused_until - time.monotonic())
+		if self.requests is not None:
+			wait = max(wait, self.requests.reserve(1))
+		if self.tokens is not None:
+			wait = max(wait, self.tokens.reserve(tokens))
+		return wait
+
+	def _retry_delay(self, error: BaseException, attempt: int) -> float:
+		"""
+		Returns:
+			float | None: The delay before the next attempt, or None if the error is
+			not worth retrying.
+		"""
+		if attempt >= self.max_retries or not is_retryable(error):
+			return None
+		retry_after = get_retry_after(error)
+		if retry_after is not None:
+			# Hold every request back, not only this one
+			self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+			return retry_after + self._random.uniform(0, self.base_delay)
+		return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+	def _on_response(self, response, tokens: int):
+		usage = getattr(response, "usage", None)
+		if self.tokens is not None and usage is not None:
+			self.tokens.adjust((getattr(usage, "total_tokens", None) or tokens) - tokens)
+
+	def run(self, request, tokens: int = 0, hold: bool = False):
+		"""
+		Sends a request through the throttle, retrying it on transient errors.
+
+		Args:
+			request (callable): Sends the request and returns the response.
+			tokens (int, optional): The estimated number of prompt tokens.
+			hold (bool, optional): Whether to keep the concurrency slot after the
+				request returns (e.g. while a stream is read). It must then be freed
+				with `release`.
+
+		Returns:
+			The response.
+		"""
+		attempt = 0
+		while True:
+			self.limiter.acquire()
+			time.sleep(self._wait_time(tokens))
+			try:
+				response = request()
+			except Exception as e:
+				self.limiter.release("pushback" if is_pushback(e) else "error")
+				delay = self._retry_delay(e, attempt)
+				if delay is None:
+					raise
+				time.sleep(delay)
+				attempt += 1
+				continue
+			self._on_response(response, tokens)
+			if not hold:
+				self.limiter.release("success")
+			return response
+
+	async def run_async(self, request, tokens: int = 0, hold: bool = False):
+		"""
+		Asynchronous counterpart of `run`, for a request returning an awaitable.
+		"""
+		attempt = 0
+		while True:
+			await self.limiter.acquire_async()
+			await asyncio.sleep(self._wait_time(tokens))
+			try:
+				response = await request()
+			except Exception as e:
+				self.limiter.release("pushback" if is_pushback(e) else "error")
+				delay = self._retry_delay(e, attempt)
+				if delay is None:
+					raise
+				await asyncio.sleep(delay)
+				attempt += 1
+				continue
+			self._on_response(response, tokens)
+			if not hold:
+				self.limiter.release("success")
+			return response
+
+	def release(self, outcome: str = "success"):
+		"""
+		Frees the slot kept by `run(..., hold=True)` or `run_async(..., hold=True)`.
+		"""
+		self.limiter.release(outcome)
+
+def load_llm_throttle(config: dict):
+	"""
+	Creates the throttle described by the `throttle` section of `config.json`.
+
+	```json
+	"throttle": {
+		"requests-per-minute": 500,
+		"tokens-per-minute": 200000,
+		"initial-concurrency": 4,
+		"min-concurrency": 1,
+		"max-concurrency": 32,
+		"max-retries": 6,
+		"base-delay": 1,
+		"max-delay": 60,
+		"timeout": 300
+	}
+	```
+
+	Returns:
+		LLMThrottle | None: The throttle, or None if `config.json` has no `throttle` section.
+	"""
+	throttle_config = config.get("throttle")
+	if throttle_config is None:
+		return None
+	return LLMThrottle(
+		throttle_config.get("requests-per-minute"),
+		throttle_config.get("tokens-per-minute"),
+		throttle_config.get("initial-concurrency", 4),
+		throttle_config.get("min-concurrency", 1),
+		throttle_config.get("max-concurrency", 32),
+		throttle_config.get("max-retries", 6),
+		throttle_config.get("base-delay", 1.0),
+		throttle_config.get("max-delay", 60.0),
+		throttle_config.get("timeout"),
+	)
@@ -1,16 +1,25 @@
-import pymupdf4llm
 import pathlib
 import json
 import os
 from openai import OpenAI
 
-from utils import llm_chat, list_files, get_filename_with_other_ext
+from utils import llm_chat, list_files, get_filename_with_other_ext, set_llm_cache, set_llm_throttle
+from llm_cache import load_llm_cache
+from llm_throttle import load_llm_throttle
+from llm_pool import load_client
+from pdf_markdown import PDFMarkdownConverter, load_pdf_converter
+from llm_telemetry import telemetry_context, telemetry_stage, set_telemetry, load_telemetry
+from prompt_templates import build_messages
+from syllabus_sections import split_sections, stitch_markdown
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 
 
-def to_markdown(pdf_path):
-	return pymupdf4llm.to_markdown(pdf_path, show_progress=False)
+def to_markdown(pdf_path: str, converter: PDFMarkdownConverter = None):
+	return (converter or PDFMarkdownConverter()).to_markdown(pdf_path)
 
 
+@telemetry_stage("markdown-refine")
 def llm_markdown_refine(text: str, client: OpenAI, model: str):
 	"""
 	Refines the given markdown text using an LLM (Large Language Model).
@@ -23,26 +32,56 @@ def llm_markdown_refine(text: str, client: OpenAI, model: str):
 	Returns:
 		str: The refined markdown text generated by the LLM.
 	"""
-	prompt = pathlib.Path("prompts/refine-markdown.md").read_text()
-	messages = [
-		{"role": "system", "content": prompt},
-		{"role": "user", "content": text},
-	]
+	messages = build_messages("refine-markdown", text)
 	return llm_chat(model, client, messages, False, 8192).choices[0].message.content
 
 
+def refine_syllabus(text: str, client: OpenAI, model: str, max_chars: int = 12000, concurrency: int = 4) -> str:
+	"""
+	Refines a syllabus section by section, so that long syllabi are not truncated by the
+	token limit of a single response, and the sections are refined concurrently.
+
+	The syllabus is split at its headings and topic numbers (see
+	`syllabus_sections.split_sections`), and the refined sections are joined in order,
+	without the lines a section repeats from the previous one.
+
+	Args:
+		text (str): The markdown text to be refined.
+		client (OpenAI): The OpenAI client instance used to interact with the LLM.
+		model (str): The name of the LLM model to be used for refining the text.
+		max_chars (int, optional): The target size of a section.
+		concurrency (int, optional): The maximum number of sections refined at the same time.
+
+	Returns:
+		str: The refined markdown text.
+	"""
+	sections = split_sections(text, max_chars, split_large=True)
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		# Worker threads do not inherit the telemetry tags of the caller
+		futures = [
+			executor.submit(contextvars.copy_context().run, llm_markdown_refine, section["text"], client, model)
+			for section in sections
+		]
+		return stitch_markdown([future.result() for future in futures])
+
+
 if __name__ == "__main__":
 	config = json.loads(pathlib.Path("config.json").read_text())
-	client = OpenAI(
-		api_key=config["openai"]["key"], base_url=config["openai"]["base-url"]
-	)
+	client = load_client(config)
 	model = config["model"]
+	set_llm_cache(load_llm_cache(config))
+	set_llm_throttle(load_llm_throttle(config))
+	set_telemetry(load_telemetry(config))
 
 	syllabuses = [file for file in list_files("syllabus") if file.endswith(".pdf")]
+	texts = load_pdf_converter(config).convert(syllabuses)
+	# "syllabus-sections": {"max-chars": 12000} sets the size of the sections refined at once
+	sections_config = config.get("syllabus-sections", {})
 	for syllabus in syllabuses:
 		md_name = get_filename_with_other_ext(syllabus, "md")
 		if os.path.exists(md_name):
 			os.remove(md_name)
-		pathlib.Path(md_name).write_text(
-			llm_markdown_refine(to_markdown(syllabus), client, model)
-		)
+		with telemetry_context(paper=syllabus):
+			pathlib.Path(md_name).write_text(
+				refine_syllabus(texts[syllabus], client, model, sections_config.get("max-chars", 12000), config.get("concurrency", 4))
+			)
@@ -0,0 +1,401 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import math
+import pathlib
+import random
+import sys
+import threading
+import time
+import uuid
+
+from llm_cache import LLMCache, request_key
+from prompt_templates import load_prompt, HANDSHAKE_OPENING
+from synthetic_corpus import generate_stem, generate_syllabus
+from paper_segmentation import find_question_boundaries
+
+DEFAULT_SETTINGS = {
+	"host": "127.0.0.1",
+	"port": 8765,
+	"seed": 0,
+	# Time to first token, in seconds
+	"latency": {"distribution": "lognormal", "median": 1.0, "sigma": 0.5},
+	# Generation speed once the first token is out
+	"tokens-per-second": 100,
+	# Probability of each injected error status
+	"errors": {"429": 0.0, "500": 0.0},
+	"retry-after": 1,
+	# Requests in flight beyond this are rejected with 429, as by a rate-limited provider
+	"max-concurrency": None,
+	# Probability of cutting a response off with finish_reason "length"
+	"truncate-rate": 0.0,
+	# Serve recorded responses from the LLM cache when the request was recorded
+	"replay": False,
+	"cache-path": "cache/llm-cache.db",
+	"exercises-per-paper": 8,
+}
+
+def estimate_tokens(text: str) -> int:
+	return len(text) // 4 + 1
+
+def get_seed(*parts: str) -> int:
+	return int.from_bytes(hashlib.sha256("\x00".join(parts).encode("utf-8")).digest()[:8], "big")
+
+def sample_latency(rng: random.Random, latency: dict) -> float:
+	"""
+	Samples a latency in seconds from the configured distribution: `fixed` (`value`),
+	`uniform` (`min`, `max`), `normal` (`mean`, `stddev`) or `lognormal` (`median`, `sigma`).
+	"""
+	distribution = latency.get("distribution", "fixed")
+	if distribution == "fixed":
+		value = latency.get("value", 0)
+	elif distribution == "uniform":
+		value = rng.uniform(latency["min"], latency["max"])
+	elif distribution == "normal":
+		value = rng.gauss(latency["mean"], latency["stddev"])
+	elif distribution == "lognormal":
+		value = rng.lognormvariate(math.log(latency["median"]), latency["sigma"])
+	else:
+		raise ValueError(f"Unknown latency distribution: {distribution}")
+	return max(0.0, value)
+
+def get_stage(messages: list[dict]) -> str:
+	"""
+	Recognises the pipeline stage of a request by its system prompt.
+
+	Returns:
+		str: The name of the prompt file of the stage, or None if it is not known.
+	"""
+	system = next((message["content"] for message in messages if message["role"] == "system"), "")
+	for name in ["extraction-prompt", "classify-exercises", "syllabus-index", "refine-markdown"]:
+		if system.startswith(load_prompt(name).rstrip()):
+			return name
+	return None
+
+def is_handshake(messages: list[dict]) -> bool:
+	system = next((message["content"] for message in messages if message["role"] == "system"), "")
+	confirmation = load_prompt("handshake-confirmation").strip()
+	return system.rstrip().endswith(confirmation) and not any(message["role"] == "assistant" for message in messages)
+
+def generate_extraction(messages: list[dict], exercise_count: int) -> dict:
+	# Follow-ups re-extract the same paper, continuations return what was not returned yet
+	papers = [message["content"] for message in messages if message["role"] == "user" and message["content"] != HANDSHAKE_OPENING]
+	rng = random.Random(get_seed(papers[0] if papers else ""))
+	# One exercise per question found in the paper (or segment), as a real model would
+	numbers = [number for (_, number) in find_question_boundaries(papers[0], first=None)] if papers else []
+	exercises = []
+	for number in numbers or range(1, exercise_count + 1):
+		exercise_id = f"{number}{rng.choice('abc')}"
+		exercises.append({
+			"id": exercise_id,
+			"stem": generate_stem(rng, exercise_id),
+			"options": [],
+			"figures": [],
+		})
+
+	if messages[-1]["content"].startswith("Your response was cut off"):
+		returned = 0
+		for message in messages:
+			if message["role"] == "assistant":
+				try:
+					returned += len(json.loads(message["content"]).get("exercises", []))
+				except (json.JSONDecodeError, AttributeError):
+					pass
+		exercises = exercises[returned:]
+	return {"exercises": exercises}
+
+def generate_classification(messages: list[dict]) -> dict:
+	points = []
+	for message in messages:
+		if message["role"] == "user" and message["content"].startswith("{"):
+			try:
+				points = json.loads(message["content"]).get("points", points)
+			except json.JSONDecodeError:
+				pass
+	exercises = json.loads(messages[-1]["content"])
+
+	classified = []
+	for exercise in exercises:
+		rng = random.Random(get_seed(str(exercise.get("id"))))
+		matches = [
+			{"syllabus-id": point["id"], "relevance": round(rng.uniform(0.3, 1.0), 2)}
+			for point in rng.sample(points, min(len(points), rng.randint(1, 3)))
+		]
+		classified.append({"matches": matches, "question-id": exercise.get("id")})
+	return {"classified": classified}
+
+def generate_content(messages: list[dict], settings: dict) -> str:
+	"""
+	Makes up a response in the format expected by the stage of the request, so that
+	the pipeline can run end to end without recorded responses.
+	"""
+	if is_handshake(messages):
+		return json.dumps({"response": "ready"})
+
+	stage = get_stage(messages)
+	if stage == "extraction-prompt":
+		return json.dumps(generate_extraction(messages, settings["exercises-per-paper"]), ensure_ascii=False)
+	if stage == "classify-exercises":
+		return json.dumps(generate_classification(messages), ensure_ascii=False)
+	if stage == "syllabus-index":
+		return json.dumps({"points": generate_syllabus(4, 4, 3, get_seed(messages[-1]["content"]) % 1000)})
+	if stage == "refine-markdown":
+		return messages[-1]["content"]
+	return json.dumps({"response": "ok"})
+
+class MockLLMServer(ThreadingHTTPServer):
+	"""
+	A local stand-in for an OpenAI-compatible provider, serving `/v1/chat/completions`
+	with and without streaming.
+
+	Responses are replayed from the LLM cache when `replay` is enabled and the
+	request was recorded, and made up according to the pipeline stage otherwise.
+	Latency, errors and truncation are injected according to the settings (see
+	`DEFAULT_SETTINGS`), so that throughput, concurrency limits and retries can be
+	measured offline.
+
+	Args:
+		settings (dict, optional): Overrides of `DEFAULT_SETTINGS`.
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, settings: dict = None):
+		self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+		self.rng = random.Random(self.settings["seed"])
+		self.lock = threading.Lock()
+		self.in_flight = 0
+		self.stats = {"requests": 0, "responses": 0, "errors": {}, "truncated": 0, "replayed": 0, "peak-in-flight": 0}
+		self.cache = None
+		if self.settings["replay"] and pathlib.Path(self.settings["cache-path"]).exists():
+			self.cache = LLMCache(self.settings["cache-path"], mode="use")
+		super().__init__((self.settings["host"], self.settings["port"]), MockLLMRequestHandler)
+
+	@property
+	def base_url(self) -> str:
+		(host, port) = self.server_address[:2]
+		return f"http://{host}:{port}/v1"
+
+	def sample(self, function, *args):
+		with self.lock:
+			return function(self.rng, *args)
+
+	def count(self, name: str, status: str = None):
+		with self.lock:
+			if status is None:
+				self.stats[name] += 1
+			else:
+				self.stats[name][status] = self.stats[name].get(status, 0) + 1
+
+	def enter(self) -> bool:
+		"""
+		Registers a request in flight.
+
+		Returns:
+			bool: False if the request exceeds `max-concurrency` and must be rejected.
+		"""
+		with self.lock:
+			self.stats["requests"] += 1
+			limit = self.settings["max-concurrency"]
+			if limit is not None and self.in_flight >= limit:
+				return False
+			self.in_flight += 1
+			self.stats["peak-in-flight"] = max(self.stats["peak-in-flight"], self.in_flight)
+			return True
+
+	def leave(self):
+		with self.lock:
+			self.in_flight -= 1
+
+	def handle_error(self, request, client_address):
+		# Clients closing their connections (e.g. on timeout) are expected under load
+		if not isinstance(sys.exc_info()[1], ConnectionError):
+			super().handle_error(request, client_address)
+
+	def get_stats(self) -> dict:
+		with self.lock:
+			return json.loads(json.dumps({**self.stats, "in-flight": self.in_flight}))
+
+	def respond(self, request: dict) -> tuple[str, str]:
+		"""
+		Returns:
+			tuple[str, str]: The content and the finish reason of the response.
+		"""
+		if self.cache is not None:
+			key = request_key(request.get("model"), request["messages"], request.get("response_format"), request.get("max_tokens"))
+			recorded = self.cache.get(key)
+			if recorded is not None:
+				self.count("replayed")
+				choice = json.loads(recorded)["choices"][0]
+				return (choice["message"]["content"] or "", choice["finish_reason"])
+
+		content = generate_content(request["messages"], self.settings)
+		max_tokens = request.get("max_tokens")
+		truncate = self.sample(lambda rng: rng.random() < self.settings["truncate-rate"])
+		if max_tokens is not None and estimate_tokens(content) > max_tokens:
+			(content, truncate) = (content[:max_tokens * 4], True)
+		elif truncate:
+			content = content[:self.sample(lambda rng: rng.randint(len(content) // 2, max(len(content) // 2, len(content) - 1)))]
+		if truncate:
+			self.count("truncated")
+			return (content, "length")
+		return (content, "stop")
+
+class MockLLMRequestHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	server: MockLLMServer
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_json(self, status: int, body: dict, headers: dict = None):
+		data = json.dumps(body).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		for (name, value) in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(data)
+
+	def send_error_json(self, status: int, message: str, error_type: str):
+		headers = {"Retry-After": str(self.server.settings["retry-after"])} if status == 429 else None
+		self.send_json(status, {"error": {"message": message, "type": error_type, "code": status}}, headers)
+
+	def send_chunk(self, data: str):
+		encoded = data.encode("utf-8")
+		self.wfile.write(f"{len(encoded):x}\r\n".encode("ascii") + encoded + b"\r\n")
+		self.wfile.flush()
+
+	def do_GET(self):
+		if self.path.rstrip("/") in ["/stats", "/v1/stats"]:
+			self.send_json(200, self.server.get_stats())
+		elif self.path.rstrip("/") in ["/models", "/v1/models"]:
+			self.send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+		else:
+			self.send_error_json(404, f"Unknown path: {self.path}", "invalid_request_error")
+
+	def do_POST(self):
+		request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+		if self.path.rstrip("/") not in ["/chat/completions", "/v1/chat/completions"]:
+			self.send_error_json(404, f"Unknown path: {self.path}", "invalid_request_error")
+			return
+
+		server = self.server
+		if not server.enter():
+			server.count("errors", "429")
+			self.send_error_json(429, "Too many concurrent requests", "rate_limit_error")
+			return
+		try:
+			injected = None
+			roll = server.sample(lambda rng: rng.random())
+			for (status, probability) in server.settings["errors"].items():
+				if roll < probability:
+					injected = int(status)
+					break
+				roll -= probability
+
+			time_to_first_token = server.sample(sample_latency, server.settings["latency"])
+			if injected is not None:
+				time.sleep(time_to_first_token)
+				server.count("errors", str(injected))
+				if injected == 429:
+					self.send_error_json(429, "Rate limit reached (injected)", "rate_limit_error")
+				else:
+					self.send_error_json(injected, "Internal server error (injected)", "server_error")
+				return
+
+			(content, finish_reason) = server.respond(request)
+			if request.get("stream"):
+				self.stream_completion(request, content, finish_reason, time_to_first_token)
+			else:
+				time.sleep(time_to_first_token + estimate_tokens(content) / server.settings["tokens-per-second"])
+				self.send_json(200, self.completion(request, content, finish_reason))
+			server.count("responses")
+		finally:
+			server.leave()
+
+	def completion(self, request: dict, content: str, finish_reason: str) -> dict:
+		prompt_tokens = sum(estimate_tokens(message["content"] or "") for message in request["messages"])
+		completion_tokens = estimate_tokens(content)
+		return {
+			"id": f"chatcmpl-{uuid.uuid4().hex}",
+			"object": "chat.completion",
+			"created": int(time.time()),
+			"model": request.get("model", "mock"),
+			"choices": [{
+				"index": 0,
+				"message": {"role": "assistant", "content": content},
+				"finish_reason": finish_reason,
+			}],
+			"usage": {
+				"prompt_tokens": prompt_tokens,
+				"completion_tokens": completion_tokens,
+				"total_tokens": prompt_tokens + completion_tokens,
+			},
+		}
+
+	def stream_completion(self, request: dict, content: str, finish_reason: str, time_to_first_token: float):
+		self.send_response(200)
+		self.send_header("Content-Type", "text/event-stream")
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+
+		completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+		created = int(time.time())
+
+		def chunk(delta: dict, reason: str = None) -> str:
+			return "data: " + json.dumps({
+				"id": completion_id,
+				"object": "chat.completion.chunk",
+				"created": created,
+				"model": request.get("model", "mock"),
+				"choices": [{"index": 0, "delta": delta, "finish_reason": reason}],
+			}) + "\n\n"
+
+		# About four tokens per chunk, paced at the configured generation speed
+		piece_size = 16
+		delay = (piece_size / 4) / self.server.settings["tokens-per-second"]
+		time.sleep(time_to_first_token)
+		self.send_chunk(chunk({"role": "assistant", "content": ""}))
+		for start in range(0, len(content), piece_size):
+			self.send_chunk(chunk({"content": content[start:start + piece_size]}))
+			time.sleep(delay)
+		self.send_chunk(chunk({}, finish_reason))
+		if (request.get("stream_options") or {}).get("include_usage"):
+			usage = self.completion(request, content, finish_reason)["usage"]
+			self.send_chunk("data: " + json.dumps({
+				"id": completion_id,
+				"object": "chat.completion.chunk",
+				"created": created,
+				"model": request.get("model", "mock"),
+				"choices": [],
+				"usage": usage,
+			}) + "\n\n")
+		self.send_chunk("data: [DONE]\n\n")
+		self.wfile.write(b"0\r\n\r\n")
+		self.wfile.flush()
+
+def start_mock_server(settings: dict = None) -> MockLLMServer:
+	"""
+	Starts a mock server in a background thread, e.g. for a load test in the same process.
+
+	Returns:
+		MockLLMServer: The running server. Point the OpenAI client at its `base_url`,
+		and stop it with `shutdown()`.
+	"""
+	server = MockLLMServer(settings)
+	threading.Thread(target=server.serve_forever, name="mock-llm-server", daemon=True).start()
+	return server
+
+if __name__ == "__main__":
+	# Serves the "mock-server" section of config.json. Point "openai.base-url" at the
+	# printed URL to run the pipeline against it.
+	config = json.loads(pathlib.Path("config.json").read_text()) if pathlib.Path("config.json").exists() else {}
+	server = MockLLMServer(config.get("mock-server"))
+	print(f"Mock LLM server listening on {server.base_url} (statistics at {server.base_url}/stats)")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	print(json.dumps(server.get_stats(), indent=2))
@@ -0,0 +1,220 @@
+from sqlite3 import Connection
+import hashlib
+import json
+import random
+import re
+import struct
+
+from utils import read_sql_file
+
+# The signatures stored in the database depend on these, so changing them requires
+# `db_writer.rebuild_near_duplicates`. The first 32 values of a signature are banded
+# into 8 bands of 4 rows, which makes exercises with a Jaccard similarity of 0.8
+# candidates of each other with a probability of about 0.985, and 0.5 of about 0.4.
+# The candidates are then checked against all 128 values. Each band costs one row per
+# exercise in a table with random keys, so there are few of them.
+# Stems with fewer than MIN_SHINGLES shingles ("Explain your answer.", "Complete the
+# table.") are generic enough to match across unrelated questions, so they are neither
+# clustered nor inherit a mapping.
+NUM_PERM = 128
+BANDS = 8
+ROWS = 4
+SHINGLE_SIZE = 3
+MIN_SHINGLES = 5
+DEFAULT_THRESHOLD = 0.8
+
+EMPTY = 2 ** 32
+# The order in which each bin looks for a non-empty bin to borrow from
+DONORS = [random.Random(slot).sample(range(NUM_PERM), NUM_PERM) for slot in range(NUM_PERM)]
+TAG_PATTERN = re.compile(r"<[^>]*>")
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+def normalise_stem(stem: str) -> str:
+	"""
+	Normalises a stem for near-duplicate detection: lower case, without the custom
+	tags (figures, answer areas) whose attributes differ between variants, and
+	without punctuation or Markdown.
+
+	Examples
+	--------
+	>>> normalise_stem('**State** the value of $x_1$. <answer-area size="2"/>')
+	'state the value of x 1'
+	"""
+	return " ".join(NON_WORD_PATTERN.sub(" ", TAG_PATTERN.sub(" ", stem.lower())).split())
+
+def get_shingles(text: str, size: int = SHINGLE_SIZE) -> set[str]:
+	"""
+	Returns the word `size`-grams of a normalised text, or the text itself if it is shorter.
+	"""
+	words = text.split()
+	if len(words) <= size:
+		return set([" ".join(words)]) if words else set()
+	return set(" ".join(words[i:i + size]) for i in range(len(words) - size + 1))
+
+def hash_value(value: str) -> int:
+	return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+def minhash(stem: str):
+	"""
+	Computes the MinHash signature of a stem by one permutation hashing: each shingle is
+	hashed once into one of `NUM_PERM` bins, and each bin keeps its minimum. Empty bins
+	borrow the value of a bin picked in a fixed pseudo-random order, so that the bins of
+	a band stay independent even for short stems. The signature costs one hash per
+	shingle rather than `NUM_PERM`.
+
+	Returns:
+		list[int] | None: The signature of 32-bit values, or None if the stem has fewer
+		than `MIN_SHINGLES` shingles.
+
+	Examples
+	--------
+	>>> minhash("Explain your answer.") is None
+	True
+	>>> len(minhash("Explain why a binary search is faster than a linear search."))
+	128
+	"""
+	shingles = get_shingles(normalise_stem(stem))
+	if len(shingles) < MIN_SHINGLES:
+		return None
+	binned = [EMPTY] * NUM_PERM
+	for shingle in shingles:
+		# The low bits pick the bin, the high 32 bits are the value
+		value = hash_value(shingle)
+		slot = value % NUM_PERM
+		binned[slot] = min(binned[slot], value >> 32)
+	return [
+		value if value != EMPTY else next(binned[donor] for donor in DONORS[slot] if binned[donor] != EMPTY)
+		for (slot, value) in enumerate(binned)
+	]
+
+def get_similarity(a: list[int], b: list[int]) -> float:
+	"""
+	Estimates the Jaccard similarity of the shingles of two stems from their signatures.
+	"""
+	return sum(1 for (x, y) in zip(a, b) if x == y) / len(a)
+
+def get_buckets(signature: list[int]) -> list[int]:
+	"""
+	Returns the LSH bucket of a signature in each band. The band is part of the hash,
+	so the buckets of all bands share one key space.
+	"""
+	return [
+		int.from_bytes(hashlib.blake2b(struct.pack(f"<{ROWS + 1}I", band, *signature[band * ROWS:(band + 1) * ROWS]), digest_size=8).digest(), "little", signed=True)
+		for band in range(BANDS)
+	]
+
+def pack_signature(signature: list[int]) -> bytes:
+	return struct.pack(f"<{len(signature)}I", *signature)
+
+def unpack_signature(data: bytes) -> list[int]:
+	return list(struct.unpack(f"<{len(data) // 4}I", data))
+
+def find_near_duplicates(connection: Connection, signature: list[int], threshold: float = DEFAULT_THRESHOLD, exclude_origin: str = None, buckets: list[int] = None) -> list[dict]:
+	"""
+	Finds the indexed exercises similar to a signature, through the LSH buckets it falls in.
+
+	Args:
+		connection (Connection): The connection to the exercise database.
+		signature (list[int]): The signature (see `minhash`).
+		threshold (float, optional): The minimum estimated Jaccard similarity.
+		exclude_origin (str, optional): A paper whose exercises are left out, e.g. the
+			paper being ingested.
+		buckets (list[int], optional): The buckets of the signature, if
+			already computed (see `get_buckets`).
+
+	Returns:
+		list[dict]: The `exercise_id`, `cluster_id`, `origin` and `similarity` of each
+		near-duplicate, most similar first.
+	"""
+	query = read_sql_file("src/queries/select-near-duplicate-candidates.sql")
+	duplicates = []
+	for (exercise_id, cluster_id, origin, data) in connection.execute(query, (json.dumps(buckets or get_buckets(signature)),)):
+		if exclude_origin is not None and origin == exclude_origin:
+			continue
+		similarity = get_similarity(signature, unpack_signature(data))
+		if similarity >= threshold:
+			duplicates.append({"exercise_id": exercise_id, "cluster_id": cluster_id, "origin": origin, "similarity": similarity})
+	return sorted(duplicates, key=lambda duplicate: duplicate["similarity"], reverse=True)
+
+def index_exercises(connection: Connection, exercises: list[dict], signatures: dict = None, threshold: float = DEFAULT_THRESHOLD):
+	"""
+	Adds exercises to the near-duplicate index. Each exercise joins the cluster of its
+	most similar indexed exercise, or starts a cluster named after itself. Exercises are
+	indexed one after the other, so near-duplicates within the same paper are clustered too.
+	Exercises whose stem is too short for a signature are not indexed.
+
+	Args:
+		connection (Connection): The connection to write with, within a transaction.
+		exercises (list[dict]): The exercises, each with an `id` and a `stem`.
+		signatures (dict, optional): The signatures already computed, by exercise id.
+		threshold (float, optional): The minimum estimated Jaccard similarity of near-duplicates.
+	"""
+	signatures = signatures or {}
+	insert_minhash = read_sql_file("src/queries/insert-exercise-minhash.sql")
+	insert_buckets = read_sql_file("src/queries/insert-exercise-lsh-bucket.sql")
+	for exercise in exercises:
+		signature = signatures[exercise["id"]] if exercise["id"] in signatures else minhash(exercise["stem"])
+		if signature is None:
+			continue
+		buckets = get_buckets(signature)
+		duplicates = [duplicate for duplicate in find_near_duplicates(connection, signature, threshold, buckets=buckets) if duplicate["exercise_id"] != exercise["id"]]
+		cluster_id = duplicates[0]["cluster_id"] if duplicates else exercise["id"]
+		connection.execute(insert_minhash, (exercise["id"], pack_signature(signature), cluster_id))
+		connection.executemany(insert_buckets, [(bucket, exercise["id"]) for bucket in buckets])
+
+def delete_index_by_origin(connection: Connection, origin: str):
+	# The buckets are found from the stored signatures, which spares an index on exercise_id
+	rows = connection.execute(read_sql_file("src/queries/select-minhashes-by-origin.sql"), (origin,)).fetchall()
+	connection.executemany(
+		read_sql_file("src/queries/delete-lsh-bucket.sql"),
+		[(bucket, exercise_id) for (exercise_id, data) in rows for bucket in get_buckets(unpack_signature(data))],
+	)
+	connection.execute(read_sql_file("src/queries/delete-minhashes-by-origin.sql"), (origin,))
+
+def get_signatures(exercises: list[dict]) -> dict:
+	"""
+	Returns:
+		dict[str, list[int] | None]: The signature of each exercise, by id (see `minhash`).
+	"""
+	return {exercise["id"]: minhash(exercise["stem"]) for exercise in exercises}
+
+def get_inherited_classification(connection: Connection, exercises: list[dict], signatures: dict = None, threshold: float = DEFAULT_THRESHOLD) -> list[dict]:
+	"""
+	Reuses the syllabus mapping of near-duplicates ingested from other papers, so that
+	re-used questions are not classified again.
+
+	Args:
+		connection (Connection): The connection to the exercise database.
+		exercises (list[dict]): The exercises of a paper, each with an `id`, a `stem`
+			and an `origin`.
+		signatures (dict, optional): The signatures already computed, by exercise id
+			(see `get_signatures`).
+		threshold (float, optional): The minimum estimated Jaccard similarity of near-duplicates.
+
+	Returns:
+		list[dict]: The classification of the exercises with a mapped near-duplicate,
+		in the format of `exercise_classification`, taken from the most similar one.
+	"""
+	query = read_sql_file("src/queries/select-mappings-by-exercise.sql")
+	signatures = signatures or get_signatures(exercises)
+	classified = []
+	for exercise in exercises:
+		signature = signatures.get(exercise["id"])
+		if signature is None:
+			continue
+		for duplicate in find_near_duplicates(connection, signature, threshold, exercise.get("origin")):
+			matches = [{"syllabus-id": row[0], "relevance": row[1]} for row in connection.execute(query, (duplicate["exercise_id"],))]
+			if matches:
+				classified.append({"matches": matches, "question-id": exercise["id"]})
+				break
+	return classified
+
+if __name__ == "__main__":
+	# python src/near_duplicates.py : rebuilds the index, e.g. after changing its parameters
+	from db_writer import connect, prepare_database, rebuild_near_duplicates
+
+	connection = connect("./papers.db")
+	prepare_database(connection)
+	rebuild_near_duplicates(connection)
+	clusters = connection.execute(read_sql_file("src/queries/count-near-duplicate-clusters.sql")).fetchone()
+	print(f"Indexed {clusters[0]} exercises in {clusters[1]} clusters.")
@@ -0,0 +1,118 @@
+"""
+Splits papers at their top-level questions, so that each segment can be extracted
+on its own. The question lines of each exam board are recognised as follows:
+
+>>> get_question_number("Question 3")
+3
+>>> get_question_number("**Q12** State the purpose of a compiler.")
+12
+>>> get_question_number("1 (a) Describe the purpose of a stack.")
+1
+>>> get_question_number("**2** Explain what is meant by abstraction.")
+2
+>>> get_question_number("0 1 . 1 Define the term algorithm.")
+1
+>>> get_question_number("**0 4**")
+4
+>>> get_question_number("0 2 Describe how a binary search works.")
+2
+>>> get_question_number("1. A numbered list item") is None
+True
+"""
+import re
+
+# Lines opening a top-level question in the Markdown produced by pymupdf4llm, for the
+# layouts of the exam boards we ingest. Each pattern captures the question number.
+QUESTION_PATTERNS = [
+	# "Question 3", "**Q3**", "## Question 3"
+	re.compile(r"^(?:#{1,6}[ \t]*)?(?:\*\*)?(?:Question|QUESTION|Q)[ \t]*(\d{1,2})\b"),
+	# CAIE / Edexcel: "1 (a) (i) ...", "**2** Describe ...". Markdown lists ("1. ...") never match.
+	re.compile(r"^(?:#{1,6}[ \t]*)?(?:\*\*)?(\d{1,2})(?:\*\*)?[ \t]+(?:\*\*)?(?=\([a-z]\)|[A-Z])"),
+	# AQA: "0 1 . 1", "01.1", "**0 4**", and single-part questions "0 2 Describe ..."
+	re.compile(r"^(?:#{1,6}[ \t]*)?(?:\*\*)?(\d[ \t]?\d)(?:\*\*)?(?:[ \t]*\.[ \t]*\d|[ \t]*$|[ \t]+\S)"),
+]
+CODE_FENCE = "```"
+
+def get_question_number(line: str):
+	"""
+	Returns:
+		int | None: The number of the top-level question opened by the line, if any.
+	"""
+	for pattern in QUESTION_PATTERNS:
+		match = pattern.match(line)
+		if match is not None:
+			return int(re.sub(r"\s", "", match.group(1)))
+	return None
+
+def find_question_boundaries(markdown: str, first: int = 1) -> list[tuple[int, int]]:
+	"""
+	Finds where each top-level question of a paper starts.
+
+	Numbered lines only count as questions when they continue the sequence (1, 2, 3...),
+	which rules out page numbers, numbered lists and table cells that happen to match.
+	Lines within code blocks are ignored.
+
+	Args:
+		markdown (str): The Markdown of the paper.
+		first (int, optional): The number of the first question, or None to accept any
+			(e.g. for a segment of a paper).
+
+	Returns:
+		list[tuple[int, int]]: The offset of the opening line and the number of each question.
+	"""
+	boundaries = []
+	in_code = False
+	offset = 0
+	for line in markdown.splitlines(keepends=True):
+		stripped = line.strip()
+		if stripped.startswith(CODE_FENCE):
+			in_code = not in_code
+		elif not in_code:
+			number = get_question_number(stripped)
+			if number is not None and (number == boundaries[-1][1] + 1 if boundaries else first in [None, number]):
+				boundaries.append((offset, number))
+		offset += len(line)
+	return boundaries
+
+def segment_paper(markdown: str, max_chars: int = 12000) -> list[dict]:
+	"""
+	Splits the Markdown of a paper at top-level question boundaries into segments of
+	about `max_chars` characters, each holding whole questions. The front matter before
+	the first question (cover page, instructions) is dropped.
+
+	Args:
+		markdown (str): The Markdown of the paper.
+		max_chars (int, optional): The target size of a segment. A question larger than
+			this gets a segment of its own.
+
+	Returns:
+		list[dict]: The segments in paper order, each with:
+
+			- questions (list[int]): The numbers of the questions in the segment.
+			- text (str): The Markdown of the segment.
+
+		A paper without recognisable question numbers is returned as a single segment
+		with no question numbers.
+	"""
+	boundaries = find_question_boundaries(markdown)
+	if len(boundaries) < 2:
+		return [{"questions": [number for (_, number) in boundaries], "text": markdown}]
+
+	ends = [offset for (offset, _) in boundaries[1:]] + [len(markdown)]
+	segments = []
+	for ((start, number), end) in zip(boundaries, ends):
+		question = markdown[start:end]
+		if segments and len(segments[-1]["text"]) + len(question) <= max_chars:
+			segments[-1]["questions"].append(number)
+			segments[-1]["text"] += question
+		else:
+			segments.append({"questions": [number], "text": question})
+	return segments
+
+def get_exercise_question(exercise_id: str):
+	"""
+	Returns:
+		int | None: The top-level question number of an extracted exercise id (e.g. 1 for "1a-i").
+	"""
+	match = re.match(r"\s*(?:Q|Question)?\s*0*(\d+)", str(exercise_id))
+	return int(match.group(1)) if match is not None else None
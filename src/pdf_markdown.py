@@ -0,0 +1,172 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import pathlib
+import sys
+
+import pymupdf
+import pymupdf4llm
+
+from utils import file_sha256, create_dir_if_not_exist
+
+MARKDOWN_CACHE_DIR = "cache/markdown"
+
+def get_markdown_cache_path(pdf_path: str, cache_dir: str = MARKDOWN_CACHE_DIR, digest: str = None) -> str:
+	"""
+	Returns the path of the cached Markdown of a PDF, addressed by the SHA-256 of its
+	content and the version of pymupdf4llm, so that a new converter invalidates the cache.
+	"""
+	digest = digest or file_sha256(pdf_path)
+	return str(pathlib.Path(cache_dir) / f"{digest}-{pymupdf4llm.__version__}.md")
+
+def convert_pages(pdf_path: str, pages: list[int] = None) -> str:
+	"""
+	Converts a PDF, or the given pages of it (0-based), to Markdown. Runs in the worker processes.
+	"""
+	return pymupdf4llm.to_markdown(pdf_path, pages=pages, show_progress=False)
+
+def split_pages(pdf_path: str, pages_per_chunk: int = None) -> list[list[int]]:
+	"""
+	Splits the pages of a PDF into runs of `pages_per_chunk` pages.
+
+	Returns:
+		list[list[int] | None]: The page runs, or `[None]` (the whole document) if it
+		is not larger than one run.
+	"""
+	if not pages_per_chunk:
+		return [None]
+	with pymupdf.open(pdf_path) as document:
+		page_count = document.page_count
+	if page_count <= pages_per_chunk:
+		return [None]
+	return [list(range(start, min(start + pages_per_chunk, page_count))) for start in range(0, page_count, pages_per_chunk)]
+
+class PDFMarkdownConverter:
+	"""
+	Converts PDFs to Markdown with pymupdf4llm over a process pool, caching the output
+	under `cache_dir`.
+
+	Large documents can be split into runs of `pages_per_chunk` pages converted in
+	parallel and joined in page order. Header levels are then inferred per run rather
+	than over the whole document, so this is off by default.
+
+	Args:
+		cache_dir (str, optional): The directory of the cached Markdown files.
+		workers (int, optional): The number of worker processes. Defaults to the CPU count.
+		pages_per_chunk (int, optional): The number of pages per parallel run, if any.
+	"""
+
+	def __init__(self, cache_dir: str = MARKDOWN_CACHE_DIR, workers: int = None, pages_per_chunk: int = None):
+		self.cache_dir = cache_dir
+		self.workers = workers or os.cpu_count() or 1
+		self.pages_per_chunk = pages_per_chunk
+
+	def _read_cached(self, cache_path: str):
+		path = pathlib.Path(cache_path)
+		return path.read_text(encoding="utf-8") if path.exists() else None
+
+	def _write_cached(self, cache_path: str, text: str):
+		create_dir_if_not_exist(self.cache_dir)
+		# Written aside then renamed, so that an interrupted run leaves no partial file
+		temporary = pathlib.Path(f"{cache_path}.{os.getpid()}.tmp")
+		temporary.write_text(text, encoding="utf-8")
+		os.replace(temporary, cache_path)
+
+	def convert(self, pdf_paths: list[str], failed: dict = None) -> dict[str, str]:
+		"""
+		Converts several PDFs, reading the cached Markdown where available.
+
+		Args:
+			pdf_paths (list[str]): The paths to the PDFs.
+			failed (dict, optional): If given, a PDF that fails to convert (e.g. a corrupt
+				file) is recorded in it with its error and left out of the result, rather
+				than aborting the others.
+
+		Returns:
+			dict[str, str]: The Markdown of each PDF, by path.
+		"""
+		def fail(pdf_path: str, error: Exception):
+			if failed is None:
+				raise error
+			failed[pdf_path] = error
+
+		results = {}
+		misses = {}
+		jobs = []
+		for pdf_path in pdf_paths:
+			try:
+				cache_path = get_markdown_cache_path(pdf_path, self.cache_dir)
+				text = self._read_cached(cache_path)
+				if text is not None:
+					results[pdf_path] = text
+					continue
+				jobs.extend((pdf_path, pages) for pages in split_pages(pdf_path, self.pages_per_chunk))
+				misses[pdf_path] = cache_path
+			except Exception as e:
+				fail(pdf_path, e)
+
+		if not jobs:
+			return {pdf_path: results[pdf_path] for pdf_path in pdf_paths if pdf_path in results}
+
+		# Each run succeeds or fails on its own, so that one bad PDF does not abort the others
+		if self.workers == 1 or len(jobs) == 1:
+			chunks = []
+			for (pdf_path, pages) in jobs:
+				try:
+					chunks.append(convert_pages(pdf_path, pages))
+				except Exception as e:
+					chunks.append(e)
+		else:
+			with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs))) as executor:
+				futures = [executor.submit(convert_pages, pdf_path, pages) for (pdf_path, pages) in jobs]
+				chunks = [future.exception() or future.result() for future in futures]
+
+		converted = {}
+		for ((pdf_path, _), chunk) in zip(jobs, chunks):
+			converted.setdefault(pdf_path, []).append(chunk)
+		for (pdf_path, parts) in converted.items():
+			errors = [part for part in parts if isinstance(part, Exception)]
+			if errors:
+				fail(pdf_path, errors[0])
+				continue
+			text = "".join(parts)
+			self._write_cached(misses[pdf_path], text)
+			results[pdf_path] = text
+
+		return {pdf_path: results[pdf_path] for pdf_path in pdf_paths if pdf_path in results}
+
+	def to_markdown(self, pdf_path: str) -> str:
+		"""
+		Converts a single PDF, reading the cached Markdown if available.
+		"""
+		return self.convert([pdf_path])[pdf_path]
+
+def load_pdf_converter(config: dict):
+	"""
+	Creates the converter described by the `pdf-markdown` section of `config.json`.
+
+	```json
+	"pdf-markdown": {
+		"cache-dir": "cache/markdown",
+		"workers": 8,
+		"pages-per-chunk": 20
+	}
+	```
+
+	Returns:
+		PDFMarkdownConverter: The converter, with the defaults if `config.json` has no
+		`pdf-markdown` section.
+	"""
+	converter_config = config.get("pdf-markdown", {})
+	return PDFMarkdownConverter(
+		converter_config.get("cache-dir", MARKDOWN_CACHE_DIR),
+		converter_config.get("workers"),
+		converter_config.get("pages-per-chunk"),
+	)
+
+if __name__ == "__main__":
+	# python src/pdf_markdown.py <pdf>... : warms the cache
+	config = json.loads(pathlib.Path("config.json").read_text()) if pathlib.Path("config.json").exists() else {}
+	converter = load_pdf_converter(config)
+	for (pdf_path, text) in converter.convert(sys.argv[1:]).items():
+		print(f"{pdf_path}: {len(text)} characters")
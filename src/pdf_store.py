@@ -0,0 +1,153 @@
+import sqlite3
+from sqlite3 import Connection
+import hashlib
+import os
+import pathlib
+
+from utils import read_sql_file, file_sha256
+
+CHUNK_SIZE = 1024 * 1024
+
+def store_pdf(connection: Connection, file_path: str, file_name: str = None, content_hash: str = None) -> str:
+	"""
+	Stores a PDF file in the database, keyed by its content.
+
+	The file is streamed into an incremental BLOB chunk by chunk, so memory use does
+	not depend on its size. Identical files stored under different names share
+	the same BLOB. The caller is responsible for the surrounding transaction.
+
+	Args:
+		connection (Connection): The connection to write with.
+		file_path (str): The path to the PDF file.
+		file_name (str, optional): The name to store the file under. Defaults to the
+			name of the file.
+		content_hash (str, optional): The SHA-256 of the file, if already known.
+
+	Returns:
+		str: The SHA-256 of the file.
+	"""
+	if file_name == None:
+		file_name = pathlib.Path(file_path).name
+	if content_hash == None:
+		content_hash = file_sha256(file_path)
+
+	if connection.execute(read_sql_file("src/queries/select-pdf-blob.sql"), (content_hash,)).fetchone() is None:
+		size = os.path.getsize(file_path)
+		cursor = connection.execute(read_sql_file("src/queries/insert-pdf-blob.sql"), (content_hash, size, size))
+		with connection.blobopen("pdf_blobs", "data", cursor.lastrowid) as blob, open(file_path, "rb") as file:
+			for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+				blob.write(chunk)
+
+	connection.execute(read_sql_file("src/queries/insert-pdf-file.sql"), (file_name, content_hash))
+	return content_hash
+
+def open_pdf(connection: Connection, file_name: str):
+	"""
+	Opens a stored PDF file for reading, without loading it whole.
+
+	Args:
+		connection (Connection): The connection to read with.
+		file_name (str): The name the file is stored under.
+
+	Returns:
+		sqlite3.Blob: A read-only file-like object over the content of the file,
+		to be used as a context manager.
+
+	Raises:
+		FileNotFoundError: If no PDF file is stored under the given name.
+	"""
+	row = connection.execute(read_sql_file("src/queries/select-pdf-file.sql"), (file_name,)).fetchone()
+	if row is None:
+		raise FileNotFoundError(f"No PDF file named {file_name} in the database")
+	return connection.blobopen("pdf_blobs", "data", row[0], readonly=True)
+
+def iter_pdf_chunks(connection: Connection, file_name: str, chunk_size: int = CHUNK_SIZE):
+	"""
+	Yields the content of a stored PDF file chunk by chunk.
+	"""
+	with open_pdf(connection, file_name) as blob:
+		for chunk in iter(lambda: blob.read(chunk_size), b""):
+			yield chunk
+
+def export_pdf(connection: Connection, file_name: str, output_path: str):
+	"""
+	Writes a stored PDF file to disk.
+	"""
+	with open(output_path, "wb") as file:
+		for chunk in iter_pdf_chunks(connection, file_name):
+			file.write(chunk)
+
+def prune_pdf_blobs(connection: Connection) -> int:
+	"""
+	Deletes the stored PDF content that no file name refers to anymore. Called by
+	`db_writer.write_pdf_file` in the transaction replacing a file, and by the command
+	line for databases written before.
+
+	Returns:
+		int: The number of deleted BLOBs.
+	"""
+	return connection.execute(read_sql_file("src/queries/delete-orphan-pdf-blobs.sql")).rowcount
+
+def migrate_legacy_pdf_files(connection: Connection):
+	"""
+	Converts a `pdf_files` table of earlier versions, which stored each file whole
+	under its name, to content-addressed storage. Does nothing on up-to-date databases.
+
+	Must be called once the schema has been created, outside of a transaction.
+	"""
+	columns = [row[1] for row in connection.execute("PRAGMA table_info(pdf_files)")]
+	if "file_data" in columns:
+		# Keep the references of other tables pointing at pdf_files
+		connection.execute("PRAGMA legacy_alter_table=ON")
+		connection.execute("ALTER TABLE pdf_files RENAME TO legacy_pdf_files")
+		connection.execute("PRAGMA legacy_alter_table=OFF")
+		connection.executescript(read_sql_file("src/queries/schema.sql"))
+
+	if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'legacy_pdf_files'").fetchone() is None:
+		return
+
+	connection.execute("BEGIN TRANSACTION")
+	try:
+		for (rowid, file_name) in connection.execute("SELECT rowid, file_name FROM legacy_pdf_files").fetchall():
+			digest = hashlib.sha256()
+			with connection.blobopen("legacy_pdf_files", "file_data", rowid, readonly=True) as legacy:
+				size = len(legacy)
+				for chunk in iter(lambda: legacy.read(CHUNK_SIZE), b""):
+					digest.update(chunk)
+			content_hash = digest.hexdigest()
+
+			if connection.execute(read_sql_file("src/queries/select-pdf-blob.sql"), (content_hash,)).fetchone() is None:
+				cursor = connection.execute(read_sql_file("src/queries/insert-pdf-blob.sql"), (content_hash, size, size))
+				with connection.blobopen("legacy_pdf_files", "file_data", rowid, readonly=True) as legacy, \
+					connection.blobopen("pdf_blobs", "data", cursor.lastrowid) as blob:
+					for chunk in iter(lambda: legacy.read(CHUNK_SIZE), b""):
+						blob.write(chunk)
+			connection.execute(read_sql_file("src/queries/insert-pdf-file.sql"), (file_name, content_hash))
+		connection.execute("DROP TABLE legacy_pdf_files")
+	except sqlite3.Error:
+		connection.execute("ROLLBACK")
+		raise RuntimeError("Failed to migrate the pdf_files table")
+	connection.execute("COMMIT")
+
+	# Recreate the index that was dropped with the legacy table
+	connection.executescript(read_sql_file("src/queries/schema.sql"))
+
+if __name__ == "__main__":
+	# python src/pdf_store.py export <file name> <output path> : writes a stored PDF file to disk
+	# python src/pdf_store.py prune : deletes the stored PDF content no file refers to
+	import sys
+	from db_writer import connect, prepare_database, transaction
+
+	if len(sys.argv) < 2 or sys.argv[1] not in ["export", "prune"] or (sys.argv[1] == "export" and len(sys.argv) < 4):
+		print("Usage: python src/pdf_store.py export <file name> <output path> | prune")
+		exit(1)
+
+	connection = connect("./papers.db")
+	prepare_database(connection)
+	if sys.argv[1] == "export":
+		export_pdf(connection, sys.argv[2], sys.argv[3])
+		print(f"Exported {sys.argv[2]} to {sys.argv[3]}.")
+	else:
+		with transaction(connection):
+			pruned = prune_pdf_blobs(connection)
+		print(f"Deleted {pruned} unused PDF files.")
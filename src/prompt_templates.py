@@ -0,0 +1,125 @@
+from openai import OpenAI, AsyncOpenAI
+import functools
+import json
+import pathlib
+
+from utils import llm_chat, llm_chat_async
+
+HANDSHAKE_OPENING = "Are you ready to begin?"
+
+@functools.lru_cache(maxsize=None)
+def load_prompt(name: str) -> str:
+	"""
+	Reads a prompt from the `prompts` folder.
+
+	Args:
+		name (str): The name of the prompt file, without the `.md` extension.
+
+	Returns:
+		str: The content of the prompt.
+	"""
+	return pathlib.Path(f"prompts/{name}.md").read_text()
+
+def get_system_prompt(name: str, handshake: bool = False) -> str:
+	"""
+	Builds the system prompt of a stage.
+
+	The system prompt only depends on the stage, so every request of a stage shares
+	the same prefix and provider-side prompt caching can be applied to it.
+
+	Args:
+		name (str): The name of the prompt file, without the `.md` extension.
+		handshake (bool, optional): Whether to ask the LLM to confirm it is ready
+			before the payload is sent.
+
+	Returns:
+		str: The system prompt.
+	"""
+	prompt = load_prompt(name)
+	if handshake:
+		prompt = f"{prompt.rstrip()}\n\n{load_prompt('handshake-confirmation')}"
+	return prompt
+
+def build_messages(name: str, payload: str, context: str = None) -> list[dict[str, str]]:
+	"""
+	Builds the message list of a single-shot request.
+
+	Args:
+		name (str): The name of the prompt file, without the `.md` extension.
+		payload (str): The content the LLM should work on.
+		context (str, optional): Reference material shared by the requests of a stage
+			(e.g. the syllabus index), sent before the payload so it stays in the
+			stable prefix.
+
+	Returns:
+		list[dict]: The messages to send to the LLM.
+	"""
+	messages = open_single_shot(name, context)
+	messages.append({"role": "user", "content": payload})
+	return messages
+
+def open_single_shot(name: str, context: str = None) -> list[dict[str, str]]:
+	"""
+	Builds the system prompt and context messages of a single-shot request.
+	"""
+	messages = [{"role": "system", "content": get_system_prompt(name)}]
+	if context is not None:
+		messages.append({"role": "user", "content": context})
+	return messages
+
+def check_ready(content: str):
+	"""
+	Raises:
+		RuntimeError: If the LLM did not confirm it is ready.
+	"""
+	if(json.loads(content)["response"] != "ready"):
+		raise RuntimeError("LLM not ready, please check the prompt")
+
+def open_conversation(model: str, client: OpenAI, name: str, context: str = None, handshake: bool = False) -> list[dict[str, str]]:
+	"""
+	Opens a conversation with the LLM, ready for the payload to be appended.
+
+	In single-shot mode the messages are built locally. In handshake mode (the
+	behaviour of earlier versions) the context, or a readiness probe if there is
+	none, is sent first and the LLM has to reply `{"response": "ready"}`.
+
+	Args:
+		model (str): The model name to be used for the LLM.
+		client (OpenAI): The OpenAI client used to interact with the LLM.
+		name (str): The name of the prompt file, without the `.md` extension.
+		context (str, optional): Reference material shared by the requests of a stage.
+		handshake (bool, optional): Whether to wait for the LLM to confirm it is ready.
+
+	Returns:
+		list[dict]: The messages of the conversation so far.
+
+	Raises:
+		RuntimeError: If the LLM is not ready.
+	"""
+	if not handshake:
+		return open_single_shot(name, context)
+
+	messages = [
+		{"role": "system", "content": get_system_prompt(name, True)},
+		{"role": "user", "content": context if context is not None else HANDSHAKE_OPENING},
+	]
+	response = llm_chat(model, client, messages)
+	check_ready(response.choices[0].message.content)
+	messages.append({"role": "assistant", "content": response.choices[0].message.content})
+	return messages
+
+async def open_conversation_async(model: str, client: AsyncOpenAI, name: str, context: str = None, handshake: bool = False) -> list[dict[str, str]]:
+	"""
+	Asynchronous counterpart of `open_conversation`, using an `AsyncOpenAI` client.
+	"""
+	if not handshake:
+		return open_single_shot(name, context)
+
+	messages = [
+		{"role": "system", "content": get_system_prompt(name, True)},
+		{"role": "user", "content": context if context is not None else HANDSHAKE_OPENING},
+	]
+	response = await llm_chat_async(model, client, messages)
+	check_ready(response.choices[0].message.content)
+	messages.append({"role": "assistant", "content": response.choices[0].message.content})
+	return messages
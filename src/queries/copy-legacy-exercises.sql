@@ -0,0 +1,10 @@
+INSERT INTO
+	exercises (id, stem, options, figures, origin)
+SELECT
+	id,
+	stem,
+	options,
+	figures,
+	origin
+FROM
+	legacy_exercises;
@@ -0,0 +1,5 @@
+SELECT
+	COUNT(*),
+	COUNT(DISTINCT cluster_id)
+FROM
+	exercise_minhash;
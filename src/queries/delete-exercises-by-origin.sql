@@ -0,0 +1,3 @@
+DELETE FROM exercises
+WHERE
+	origin = ?;
@@ -0,0 +1,4 @@
+DELETE FROM exercise_lsh_buckets
+WHERE
+	bucket = ?
+	AND exercise_id = ?;
@@ -0,0 +1 @@
+DELETE FROM exercise_lsh_buckets;
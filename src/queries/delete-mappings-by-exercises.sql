@@ -0,0 +1,8 @@
+DELETE FROM exercise_syllabus_mapping
+WHERE
+	exercise_id IN (
+		SELECT
+			value
+		FROM
+			json_each(?)
+	);
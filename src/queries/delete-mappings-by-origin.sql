@@ -0,0 +1,10 @@
+DELETE FROM exercise_syllabus_mapping
+WHERE
+	exercise_id IN (
+		SELECT
+			id
+		FROM
+			exercises
+		WHERE
+			origin = ?
+	);
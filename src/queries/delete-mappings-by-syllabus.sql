@@ -0,0 +1,3 @@
+DELETE FROM exercise_syllabus_mapping
+WHERE
+	syllabus_id = ?;
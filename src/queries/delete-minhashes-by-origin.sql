@@ -0,0 +1,10 @@
+DELETE FROM exercise_minhash
+WHERE
+	exercise_id IN (
+		SELECT
+			id
+		FROM
+			exercises
+		WHERE
+			origin = ?
+	);
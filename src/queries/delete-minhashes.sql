@@ -0,0 +1 @@
+DELETE FROM exercise_minhash;
@@ -0,0 +1,8 @@
+DELETE FROM pdf_blobs
+WHERE
+	content_hash NOT IN (
+		SELECT
+			content_hash
+		FROM
+			pdf_files
+	);
@@ -0,0 +1,20 @@
+-- Removes the hierarchy rows of a syllabus id once no point or mapping refers to it
+DELETE FROM syllabus_closure
+WHERE
+	descendant_id = ?1
+	AND NOT EXISTS (
+		SELECT
+			1
+		FROM
+			syllabus_points
+		WHERE
+			syllabus_id = ?1
+	)
+	AND NOT EXISTS (
+		SELECT
+			1
+		FROM
+			exercise_syllabus_mapping
+		WHERE
+			syllabus_id = ?1
+	);
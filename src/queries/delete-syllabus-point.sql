@@ -0,0 +1,3 @@
+DELETE FROM syllabus_points
+WHERE
+	syllabus_id = ?;
@@ -0,0 +1,4 @@
+INSERT
+OR IGNORE INTO exercise_lsh_buckets (bucket, exercise_id)
+VALUES
+	(?, ?);
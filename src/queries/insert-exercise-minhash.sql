@@ -0,0 +1,4 @@
+INSERT
+OR IGNORE INTO exercise_minhash (exercise_id, signature, cluster_id)
+VALUES
+	(?, ?, ?);
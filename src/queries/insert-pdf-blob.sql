@@ -0,0 +1,4 @@
+INSERT INTO
+	pdf_blobs (content_hash, size, data)
+VALUES
+	(?, ?, zeroblob(?));
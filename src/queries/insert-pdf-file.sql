@@ -1,4 +1,4 @@
 INSERT
-OR IGNORE INTO pdf_files (file_name, file_data)
+OR REPLACE INTO pdf_files (file_name, content_hash)
 VALUES
 	(?, ?)
@@ -0,0 +1,4 @@
+INSERT
+OR REPLACE INTO rendered_latex (stem_hash, renderer_version, latex)
+VALUES
+	(?, ?, ?);
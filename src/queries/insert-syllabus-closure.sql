@@ -0,0 +1,4 @@
+INSERT
+OR IGNORE INTO syllabus_closure (ancestor_id, descendant_id, depth)
+VALUES
+	(?, ?, ?);
@@ -0,0 +1,15 @@
+DROP TRIGGER IF EXISTS exercises_fts_insert;
+
+DROP TRIGGER IF EXISTS exercises_fts_delete;
+
+DROP TRIGGER IF EXISTS exercises_fts_update;
+
+DROP TABLE IF EXISTS exercises_fts;
+
+-- Keep the references of other tables pointing at exercises
+PRAGMA legacy_alter_table = ON;
+
+ALTER TABLE exercises
+RENAME TO legacy_exercises;
+
+PRAGMA legacy_alter_table = OFF;
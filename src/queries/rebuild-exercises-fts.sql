@@ -0,0 +1,4 @@
+INSERT INTO
+	exercises_fts (exercises_fts)
+VALUES
+	('rebuild');
@@ -0,0 +1,6 @@
+UPDATE
+OR IGNORE exercise_syllabus_mapping
+SET
+	syllabus_id = ?
+WHERE
+	syllabus_id = ?;
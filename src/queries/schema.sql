@@ -1,5 +1,6 @@
 CREATE TABLE IF NOT EXISTS exercises (
-	id TEXT PRIMARY KEY, -- Unique identifier for the exercise
+	row_id INTEGER PRIMARY KEY, -- Alias of the rowid, which VACUUM keeps, the key of exercises_fts
+	id TEXT NOT NULL UNIQUE, -- Unique identifier for the exercise
 	stem TEXT NOT NULL, -- The main content of the exercise
 	options TEXT, -- JSON or serialized data for options (if needed)
 	figures TEXT, -- JSON or serialized data for figures (if needed)
@@ -12,6 +13,13 @@ CREATE TABLE IF NOT EXISTS syllabus_points (
 	description TEXT -- Optional: Description of the syllabus point
 );
 
+CREATE TABLE IF NOT EXISTS syllabus_closure (
+	ancestor_id TEXT NOT NULL, -- A syllabus id or one of its prefixes (e.g. "1", "1.2" or "1.2.3")
+	descendant_id TEXT NOT NULL, -- A syllabus id in the subtree of the ancestor (e.g. "1.2.3")
+	depth INTEGER NOT NULL, -- Number of levels between the ancestor and the descendant
+	PRIMARY KEY (ancestor_id, descendant_id)
+) WITHOUT ROWID;
+
 CREATE TABLE IF NOT EXISTS exercise_syllabus_mapping (
 	exercise_id TEXT, -- Foreign key to exercises.id
 	syllabus_id TEXT, -- Foreign key to syllabus_points.syllabus_id
@@ -21,13 +29,97 @@ CREATE TABLE IF NOT EXISTS exercise_syllabus_mapping (
 	FOREIGN KEY (syllabus_id) REFERENCES syllabus_points (syllabus_id)
 );
 
+CREATE TABLE IF NOT EXISTS pdf_blobs (
+	content_hash TEXT PRIMARY KEY, -- SHA-256 of the PDF file
+	size INTEGER NOT NULL, -- Size of the PDF file in bytes
+	data BLOB NOT NULL -- Binary data of the PDF file, written and read incrementally
+);
+
 CREATE TABLE IF NOT EXISTS pdf_files (
 	file_name TEXT PRIMARY KEY, -- Name of the PDF file
-	file_data BLOB NOT NULL -- Binary data of the PDF file
+	content_hash TEXT NOT NULL, -- The content of the PDF file, shared by identical files
+	FOREIGN KEY (content_hash) REFERENCES pdf_blobs (content_hash)
+);
+
+CREATE TABLE IF NOT EXISTS ingestion_manifest (
+	source_file TEXT PRIMARY KEY, -- Path to the exercise JSON file
+	pdf_hash TEXT, -- SHA-256 of the original PDF file
+	json_hash TEXT NOT NULL, -- SHA-256 of the exercise JSON file
+	prompt_version TEXT NOT NULL, -- SHA-256 of the classification prompt
+	model TEXT NOT NULL, -- The LLM model used for classification
+	status TEXT NOT NULL, -- 'pending', 'batched', 'classified' or 'complete'
+	classification TEXT, -- JSON of the classification, kept to resume half-finished files
+	updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE TABLE IF NOT EXISTS extraction_manifest (
+	source_file TEXT PRIMARY KEY, -- Path to the PDF paper
+	pdf_hash TEXT NOT NULL, -- SHA-256 of the PDF file
+	json_hash TEXT, -- SHA-256 of the exercise JSON file written by the extraction, once extracted
+	prompt_version TEXT NOT NULL, -- SHA-256 of the extraction prompts
+	model TEXT NOT NULL, -- The LLM model used for extraction
+	status TEXT NOT NULL, -- 'pending', 'batched' or 'extracted'
+	updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS batch_jobs (
+	job_id TEXT PRIMARY KEY, -- Local identifier of the job (e.g. "classification-20250101-120000")
+	kind TEXT NOT NULL, -- 'extraction' or 'classification'
+	status TEXT NOT NULL, -- 'submitted', 'ingested' or 'failed'
+	endpoint_batch_id TEXT, -- The id of the batch at the batch endpoint
+	input_path TEXT NOT NULL, -- Path to the request JSONL file
+	output_path TEXT NOT NULL, -- Path the result JSONL file is downloaded to
+	items TEXT NOT NULL, -- JSON of the sources of the job and what each request (by custom_id) was made for
+	updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS exercise_minhash (
+	exercise_id TEXT PRIMARY KEY, -- Foreign key to exercises.id
+	signature BLOB NOT NULL, -- MinHash signature of the normalised stem, see near_duplicates.minhash
+	cluster_id TEXT NOT NULL, -- Id of the first exercise of its near-duplicate cluster
+	FOREIGN KEY (exercise_id) REFERENCES exercises (id)
+);
+
+CREATE TABLE IF NOT EXISTS exercise_lsh_buckets (
+	bucket INTEGER NOT NULL, -- Hash of a band of the signature and its rows, see near_duplicates.get_buckets
+	exercise_id TEXT NOT NULL, -- Foreign key to exercises.id
+	PRIMARY KEY (bucket, exercise_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS rendered_latex (
+	stem_hash TEXT NOT NULL, -- SHA-256 of the Markdown stem
+	renderer_version TEXT NOT NULL, -- latex_frontend.RENDERER_VERSION the stem was rendered with
+	latex TEXT NOT NULL, -- The rendered LaTeX
+	PRIMARY KEY (stem_hash, renderer_version)
+) WITHOUT ROWID;
+
+-- Full-text index over the exercises, kept in sync by the triggers below. It refers to
+-- the exercises by row_id, as VACUUM may renumber the implicit rowid of a table.
+CREATE VIRTUAL TABLE IF NOT EXISTS exercises_fts USING fts5 (
+	stem,
+	options,
+	content = 'exercises',
+	content_rowid = 'row_id',
+	tokenize = 'porter unicode61'
+);
+
+CREATE TRIGGER IF NOT EXISTS exercises_fts_insert AFTER INSERT ON exercises BEGIN
+	INSERT INTO exercises_fts (rowid, stem, options) VALUES (new.row_id, new.stem, new.options);
+END;
+
+CREATE TRIGGER IF NOT EXISTS exercises_fts_delete AFTER DELETE ON exercises BEGIN
+	INSERT INTO exercises_fts (exercises_fts, rowid, stem, options) VALUES ('delete', old.row_id, old.stem, old.options);
+END;
+
+CREATE TRIGGER IF NOT EXISTS exercises_fts_update AFTER UPDATE ON exercises BEGIN
+	INSERT INTO exercises_fts (exercises_fts, rowid, stem, options) VALUES ('delete', old.row_id, old.stem, old.options);
+	INSERT INTO exercises_fts (rowid, stem, options) VALUES (new.row_id, new.stem, new.options);
+END;
+
 CREATE INDEX IF NOT EXISTS idx_exercise_syllabus_mapping_syllabus_id ON exercise_syllabus_mapping (syllabus_id);
 
 CREATE INDEX IF NOT EXISTS idx_exercise_syllabus_mapping_exercise_id ON exercise_syllabus_mapping (exercise_id);
 
+CREATE INDEX IF NOT EXISTS idx_exercise_minhash_cluster_id ON exercise_minhash (cluster_id);
+
 CREATE INDEX IF NOT EXISTS idx_pdf_files_file_name ON pdf_files (file_name);
@@ -0,0 +1,25 @@
+SELECT
+	e.id,
+	e.stem,
+	esm.relevance,
+	COALESCE(m.cluster_id, e.id) AS cluster_id
+FROM
+	exercises_fts
+	JOIN exercises e ON e.row_id = exercises_fts.rowid
+	JOIN exercise_syllabus_mapping esm ON e.id = esm.exercise_id
+	LEFT JOIN exercise_minhash m ON m.exercise_id = e.id
+WHERE
+	(exercises_fts MATCH ?)
+	AND (
+		esm.syllabus_id IN (
+			SELECT
+				sc.descendant_id
+			FROM
+				json_each(?) subtree
+				JOIN syllabus_closure sc ON sc.ancestor_id = subtree.value
+		)
+	)
+	AND (esm.relevance >= ?)
+ORDER BY
+	bm25(exercises_fts),
+	esm.relevance DESC;
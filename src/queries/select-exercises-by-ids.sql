@@ -0,0 +1,18 @@
+SELECT
+	id,
+	stem,
+	options,
+	figures,
+	origin
+FROM
+	exercises
+WHERE
+	id IN (
+		SELECT
+			value
+		FROM
+			json_each(?)
+	)
+ORDER BY
+	origin,
+	rowid;
@@ -0,0 +1,11 @@
+SELECT DISTINCT
+	exercise_id
+FROM
+	exercise_syllabus_mapping
+WHERE
+	syllabus_id IN (
+		SELECT
+			value
+		FROM
+			json_each(?)
+	);
@@ -1,12 +1,15 @@
 SELECT
 	e.id,
 	e.stem,
-	esm.relevance
+	esm.relevance,
+	COALESCE(m.cluster_id, e.id) AS cluster_id
 FROM
-	exercises e
-	JOIN exercise_syllabus_mapping esm ON e.id = esm.exercise_id
+	json_each(?) subtree
+	JOIN syllabus_closure sc ON sc.ancestor_id = subtree.value
+	JOIN exercise_syllabus_mapping esm ON esm.syllabus_id = sc.descendant_id
+	JOIN exercises e ON e.id = esm.exercise_id
+	LEFT JOIN exercise_minhash m ON m.exercise_id = e.id
 WHERE
-	(esm.syllabus_id LIKE ?)
-	AND (esm.relevance >= ?)
+	(esm.relevance >= ?)
 ORDER BY
 	esm.relevance DESC;
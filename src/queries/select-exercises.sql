@@ -0,0 +1,8 @@
+SELECT
+	id,
+	stem,
+	options,
+	figures,
+	origin
+FROM
+	exercises;
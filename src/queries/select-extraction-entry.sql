@@ -0,0 +1,10 @@
+SELECT
+	pdf_hash,
+	json_hash,
+	prompt_version,
+	model,
+	status
+FROM
+	extraction_manifest
+WHERE
+	source_file = ?;
@@ -0,0 +1,11 @@
+SELECT
+	pdf_hash,
+	json_hash,
+	prompt_version,
+	model,
+	status,
+	classification
+FROM
+	ingestion_manifest
+WHERE
+	source_file = ?;
@@ -0,0 +1,7 @@
+SELECT
+	syllabus_id,
+	relevance
+FROM
+	exercise_syllabus_mapping
+WHERE
+	exercise_id = ?;
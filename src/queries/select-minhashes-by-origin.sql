@@ -0,0 +1,8 @@
+SELECT
+	m.exercise_id,
+	m.signature
+FROM
+	exercise_minhash m
+	JOIN exercises e ON e.id = m.exercise_id
+WHERE
+	e.origin = ?;
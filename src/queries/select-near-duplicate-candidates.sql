@@ -0,0 +1,22 @@
+SELECT
+	m.exercise_id,
+	m.cluster_id,
+	e.origin,
+	m.signature
+FROM
+	exercise_minhash m
+	JOIN exercises e ON e.id = m.exercise_id
+WHERE
+	m.exercise_id IN (
+		SELECT
+			lb.exercise_id
+		FROM
+			exercise_lsh_buckets lb
+		WHERE
+			lb.bucket IN (
+				SELECT
+					value
+				FROM
+					json_each(?)
+			)
+	);
@@ -0,0 +1,15 @@
+SELECT
+	job_id,
+	kind,
+	status,
+	endpoint_batch_id,
+	input_path,
+	output_path,
+	items
+FROM
+	batch_jobs
+WHERE
+	kind = ?
+	AND status = 'submitted'
+ORDER BY
+	job_id;
@@ -0,0 +1,7 @@
+SELECT
+	b.rowid,
+	b.size
+FROM
+	pdf_blobs b
+WHERE
+	b.content_hash = ?;
@@ -0,0 +1,8 @@
+SELECT
+	b.rowid,
+	b.size
+FROM
+	pdf_files f
+	JOIN pdf_blobs b ON f.content_hash = b.content_hash
+WHERE
+	f.file_name = ?;
@@ -0,0 +1,13 @@
+SELECT
+	stem_hash,
+	latex
+FROM
+	rendered_latex
+WHERE
+	renderer_version = ?
+	AND stem_hash IN (
+		SELECT
+			value
+		FROM
+			json_each(?)
+	);
@@ -0,0 +1,9 @@
+SELECT
+	syllabus_id
+FROM
+	syllabus_points
+UNION
+SELECT DISTINCT
+	syllabus_id
+FROM
+	exercise_syllabus_mapping;
@@ -0,0 +1,5 @@
+SELECT
+	syllabus_id,
+	description
+FROM
+	syllabus_points;
@@ -0,0 +1,6 @@
+SELECT DISTINCT
+	ancestor_id
+FROM
+	syllabus_closure
+WHERE
+	instr(ancestor_id, '.') = 0;
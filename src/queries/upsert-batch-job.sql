@@ -0,0 +1,13 @@
+INSERT
+OR REPLACE INTO batch_jobs (
+	job_id,
+	kind,
+	status,
+	endpoint_batch_id,
+	input_path,
+	output_path,
+	items,
+	updated_at
+)
+VALUES
+	(?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP);
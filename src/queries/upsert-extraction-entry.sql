@@ -0,0 +1,12 @@
+INSERT
+OR REPLACE INTO extraction_manifest (
+	source_file,
+	pdf_hash,
+	json_hash,
+	prompt_version,
+	model,
+	status,
+	updated_at
+)
+VALUES
+	(?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP);
@@ -0,0 +1,13 @@
+INSERT
+OR REPLACE INTO ingestion_manifest (
+	source_file,
+	pdf_hash,
+	json_hash,
+	prompt_version,
+	model,
+	status,
+	classification,
+	updated_at
+)
+VALUES
+	(?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP);
@@ -0,0 +1,7 @@
+INSERT INTO
+	syllabus_points (syllabus_id, description)
+VALUES
+	(?, ?) ON CONFLICT (syllabus_id) DO
+UPDATE
+SET
+	description = excluded.description;
@@ -0,0 +1,301 @@
+from sqlite3 import Connection
+from itertools import groupby
+import json
+import pathlib
+import sys
+
+from openai import OpenAI
+
+from utils import read_sql_file, set_llm_cache, set_llm_throttle
+from llm_cache import load_llm_cache
+from llm_throttle import load_llm_throttle
+from llm_pool import load_client
+from llm_telemetry import telemetry_context, set_telemetry, load_telemetry
+from exercise_classification import exercise_classification, index_classification
+from syllabus_search import SyllabusSearchIndex, tokenize, load_search_index, get_search_index_path, exercise_search_text
+from db_writer import connect, prepare_database, transaction, write_matchings, write_syllabus_closure
+
+# Prefix of the ids mappings are parked under while moved points are renumbered
+MOVING_PREFIX = "\x00moving:"
+
+def normalise_description(description: str) -> str:
+	return " ".join(str(description or "").lower().split())
+
+def get_syllabus_points(connection: Connection) -> dict[str, str]:
+	"""
+	Returns:
+		dict[str, str]: The description of each syllabus point of the database, by id.
+	"""
+	return {row[0]: row[1] for row in connection.execute(read_sql_file("src/queries/select-syllabus-points.sql"))}
+
+def diff_syllabus(old_points: dict[str, str], new_points: list[dict]) -> dict:
+	"""
+	Compares the syllabus points of the database with a new syllabus index.
+
+	A point whose description is unchanged but whose id differs (e.g. after a topic is
+	inserted before it) is a move rather than a removal and an addition, provided its
+	description identifies it unambiguously on both sides.
+
+	Args:
+		old_points (dict[str, str]): The descriptions of the current points, by id
+			(see `get_syllabus_points`).
+		new_points (list[dict]): The points of the new index, each with an `id` and a
+			`description`.
+
+	Returns:
+		dict: The differences:
+
+			- added (list[dict]): The new points.
+			- changed (list[dict]): The points whose description changed.
+			- removed (list[str]): The ids of the points no longer in the syllabus.
+			- moved (dict[str, dict]): The new point of each renumbered point, by old id.
+			- unchanged (int): The number of unchanged points.
+	"""
+	new_by_id = {str(point["id"]): point for point in new_points}
+	unchanged = set(
+		point_id for (point_id, point) in new_by_id.items()
+		if point_id in old_points and normalise_description(old_points[point_id]) == normalise_description(point["description"])
+	)
+
+	# Pair the remaining points by description, where it is unique on both sides
+	old_by_description = {}
+	for (point_id, description) in old_points.items():
+		if point_id not in unchanged:
+			old_by_description.setdefault(normalise_description(description), []).append(point_id)
+	new_by_description = {}
+	for (point_id, point) in new_by_id.items():
+		if point_id not in unchanged:
+			new_by_description.setdefault(normalise_description(point["description"]), []).append(point_id)
+	moved = {
+		old_ids[0]: new_by_id[new_by_description[description][0]]
+		for (description, old_ids) in old_by_description.items()
+		if len(old_ids) == 1 and len(new_by_description.get(description, [])) == 1
+	}
+	moved_to = set(str(point["id"]) for point in moved.values())
+
+	# An id left by a moved point and reused by another point is an addition, and a
+	# point whose id is taken over by a moved point is a removal
+	remaining = [point_id for point_id in new_by_id if point_id not in unchanged and point_id not in moved_to]
+	return {
+		"added": [new_by_id[point_id] for point_id in remaining if point_id not in old_points or point_id in moved],
+		"changed": [new_by_id[point_id] for point_id in remaining if point_id in old_points and point_id not in moved],
+		"removed": [
+			point_id for point_id in old_points
+			if point_id not in unchanged and point_id not in moved and (point_id not in new_by_id or point_id in moved_to)
+		],
+		"moved": moved,
+		"unchanged": len(unchanged),
+	}
+
+def find_affected_exercises(connection: Connection, diff: dict, search_index: SyllabusSearchIndex, top_k: int = 10, min_score: float = 1.0) -> set[str]:
+	"""
+	Finds the exercises to reclassify after a syllabus change: those mapped to a changed
+	or removed point, and the lexical candidates of the added and changed points.
+
+	An exercise is a candidate of a point if the point is among the `top_k` points of
+	the new syllabus it scores best against, with a score of at least `min_score`, i.e.
+	if the point would be shortlisted for it by `narrow_syllabus`. Only the exercises
+	sharing a term with the new descriptions are scored.
+
+	Args:
+		connection (Connection): The connection to the database.
+		diff (dict): The differences returned by `diff_syllabus`.
+		search_index (SyllabusSearchIndex): The search index over the new syllabus.
+		top_k (int, optional): The number of candidate points of an exercise.
+		min_score (float, optional): The score below which a point is not a candidate.
+
+	Returns:
+		set[str]: The ids of the affected exercises.
+	"""
+	mapped_ids = [point["id"] for point in diff["changed"]] + diff["removed"]
+	affected = set(
+		row[0] for row in connection.execute(read_sql_file("src/queries/select-exercises-by-mapped-syllabus.sql"), (json.dumps(mapped_ids),))
+	)
+
+	new_points = diff["added"] + diff["changed"]
+	new_ids = set(str(point["id"]) for point in new_points)
+	new_terms = set(term for point in new_points for term in tokenize(point["description"]))
+	if not new_terms:
+		return affected
+
+	for (exercise_id, stem, options, _, _) in connection.execute(read_sql_file("src/queries/select-exercises.sql")):
+		if exercise_id in affected:
+			continue
+		text = exercise_search_text({"stem": stem, "options": json.loads(options or "null")})
+		if new_terms.isdisjoint(tokenize(text)):
+			continue
+		ranked = sorted(search_index.score(text).items(), key=lambda item: item[1], reverse=True)[:top_k]
+		if any(point_id in new_ids and score >= min_score for (point_id, score) in ranked):
+			affected.add(exercise_id)
+	return affected
+
+def load_exercises_by_ids(connection: Connection, exercise_ids: set[str]) -> list[dict]:
+	keys = ["id", "stem", "options", "figures", "origin"]
+	exercises = [dict(zip(keys, row)) for row in connection.execute(read_sql_file("src/queries/select-exercises-by-ids.sql"), (json.dumps(sorted(exercise_ids)),))]
+	for exercise in exercises:
+		exercise["options"] = json.loads(exercise["options"] or "null")
+		exercise["figures"] = json.loads(exercise["figures"] or "null")
+	return exercises
+
+def reclassify_exercises(exercises: list[dict], syllabus_points: list[dict], client: OpenAI, model: str, handshake: bool = False, concurrency: int = 4, search_index: SyllabusSearchIndex = None, prefilter: dict = {}) -> list[dict]:
+	"""
+	Classifies exercises loaded from the database against the new syllabus, paper by paper.
+
+	Returns:
+		dict[str, list[dict]]: The new matchings of each classified exercise, by id, in
+		the format of `write_matchings`. Exercises the LLM skipped are left out.
+
+	Raises:
+		RuntimeError: If the classification of a paper fails.
+	"""
+	matchings = {}
+	for (origin, group) in groupby(exercises, key=lambda exercise: exercise["origin"]):
+		group = [{key: exercise[key] for key in ["id", "stem", "options", "figures"]} for exercise in group]
+		with telemetry_context(paper=origin):
+			classified = exercise_classification(
+				group,
+				syllabus_points,
+				client,
+				model,
+				handshake,
+				concurrency=concurrency,
+				search_index=search_index,
+				top_k=prefilter.get("top-k", 10),
+				min_score=prefilter.get("min-score", 1.0),
+			)
+		classification = index_classification(classified)
+		for exercise in group:
+			if exercise["id"] not in classification:
+				print("Warning: Fail to find matching for exercise: " + exercise["id"])
+				continue
+			matchings[exercise["id"]] = [
+				{"syllabus-id": match["syllabus-id"], "question-id": exercise["id"], "relevance": match["relevance"]}
+				for match in classification[exercise["id"]]
+			]
+	return matchings
+
+def apply_syllabus_diff(connection: Connection, diff: dict, matchings: dict[str, list[dict]]):
+	"""
+	Updates the syllabus of the database in a single transaction: upserts the added and
+	changed points, renumbers the mappings of moved points, replaces the mappings of the
+	reclassified exercises and deletes the removed points. Every mapping to a removed or
+	changed point is deleted, including those of affected exercises the LLM skipped. The
+	mappings of the other exercises are left as they are.
+
+	Args:
+		connection (Connection): The connection to write with.
+		diff (dict): The differences returned by `diff_syllabus`.
+		matchings (dict[str, list[dict]]): The new matchings of the reclassified
+			exercises (see `reclassify_exercises`).
+	"""
+	moved = {old_id: str(point["id"]) for (old_id, point) in diff["moved"].items()}
+	with transaction(connection):
+		connection.executemany(read_sql_file("src/queries/delete-syllabus-point.sql"), [(point_id,) for point_id in [*diff["removed"], *moved]])
+
+		# An exercise the LLM skipped is not in the matchings, so its mappings to removed
+		# and reworded points are cleared before the moves, while they still use the old ids.
+		stale_ids = [point["id"] for point in diff["changed"]] + diff["removed"]
+		connection.executemany(read_sql_file("src/queries/delete-mappings-by-syllabus.sql"), [(point_id,) for point_id in stale_ids])
+
+		# Moves may be chained (1.2.3 -> 1.2.4 -> 1.2.5), so the mappings are parked
+		# under temporary ids first. An exercise already mapped to the new id keeps that mapping.
+		rename = read_sql_file("src/queries/rename-mappings-syllabus-id.sql")
+		connection.executemany(rename, [(MOVING_PREFIX + new_id, old_id) for (old_id, new_id) in moved.items()])
+		connection.executemany(rename, [(new_id, MOVING_PREFIX + new_id) for new_id in moved.values()])
+		connection.executemany(read_sql_file("src/queries/delete-mappings-by-syllabus.sql"), [(MOVING_PREFIX + new_id,) for new_id in moved.values()])
+
+		points = diff["added"] + diff["changed"] + list(diff["moved"].values())
+		connection.executemany(read_sql_file("src/queries/upsert-syllabus-point.sql"), [(point["id"], point["description"]) for point in points])
+		write_syllabus_closure(connection, [point["id"] for point in points])
+
+		connection.execute(read_sql_file("src/queries/delete-mappings-by-exercises.sql"), (json.dumps(sorted(matchings)),))
+		write_matchings(connection, [match for exercise_matchings in matchings.values() for match in exercise_matchings])
+
+		connection.executemany(read_sql_file("src/queries/delete-syllabus-closure.sql"), [(point_id,) for point_id in [*diff["removed"], *moved]])
+
+def update_syllabus(connection: Connection, syllabus_points: list[dict], client: OpenAI, model: str, handshake: bool = False, concurrency: int = 4, search_index: SyllabusSearchIndex = None, prefilter: dict = {}, dry_run: bool = False) -> dict:
+	"""
+	Brings the syllabus of the database up to date with a new syllabus index, only
+	reclassifying the exercises affected by the change (see `find_affected_exercises`).
+
+	The affected exercises are classified before anything is written, so a failed
+	classification leaves the database untouched.
+
+	Args:
+		connection (Connection): The connection to the database.
+		syllabus_points (list[dict]): The points of the new syllabus index.
+		client (OpenAI): The client used for classification.
+		model (str): The model used for classification.
+		handshake (bool, optional): See `exercise_classification`.
+		concurrency (int, optional): See `exercise_classification`.
+		search_index (SyllabusSearchIndex, optional): The search index over the new
+			syllabus. Built if not given, as it is needed to find the candidates of new points.
+		prefilter (dict, optional): The `prefilter` section of `config.json`. If false,
+			the full syllabus is sent with each batch, but the search index is still used
+			to find the candidates of new points.
+		dry_run (bool, optional): Whether to only report the differences and the
+			affected exercises.
+
+	Returns:
+		dict: The differences (see `diff_syllabus`), and the ids of the `affected` exercises.
+	"""
+	diff = diff_syllabus(get_syllabus_points(connection), syllabus_points)
+	candidate_index = search_index if search_index is not None else SyllabusSearchIndex(syllabus_points)
+	prefilter_config = prefilter if prefilter is not False else {}
+	affected = find_affected_exercises(
+		connection, diff, candidate_index, prefilter_config.get("top-k", 10), prefilter_config.get("min-score", 1.0)
+	)
+	diff["affected"] = affected
+	if dry_run:
+		return diff
+
+	matchings = reclassify_exercises(
+		load_exercises_by_ids(connection, affected),
+		syllabus_points,
+		client,
+		model,
+		handshake,
+		concurrency,
+		candidate_index if prefilter is not False else None,
+		prefilter_config,
+	)
+	apply_syllabus_diff(connection, diff, matchings)
+	return diff
+
+if __name__ == "__main__":
+	# python src/syllabus_diff.py <syllabus index> [dry-run]
+	if len(sys.argv) < 2:
+		print("Usage: python src/syllabus_diff.py <syllabus index> [dry-run]")
+		exit(1)
+
+	config = json.loads(pathlib.Path("config.json").read_text())
+	client = load_client(config)
+	model = config["model"]
+	set_llm_cache(load_llm_cache(config))
+	set_llm_throttle(load_llm_throttle(config))
+	set_telemetry(load_telemetry(config))
+
+	syllabus = json.loads(pathlib.Path(sys.argv[1]).read_text())
+	dry_run = len(sys.argv) > 2 and sys.argv[2] == "dry-run"
+
+	db_path = "./papers.db"
+	connection = connect(db_path)
+	prepare_database(connection)
+
+	prefilter = config.get("prefilter", {})
+	diff = update_syllabus(
+		connection,
+		syllabus["points"],
+		client,
+		model,
+		config.get("handshake", False),
+		config.get("concurrency", 4),
+		load_search_index(syllabus["points"], get_search_index_path(db_path)),
+		prefilter,
+		dry_run,
+	)
+	print(
+		f"{len(diff['added'])} added, {len(diff['changed'])} changed, {len(diff['removed'])} removed, "
+		f"{len(diff['moved'])} moved and {diff['unchanged']} unchanged syllabus points."
+	)
+	print(f"{len(diff['affected'])} exercises {'to reclassify' if dry_run else 'reclassified'}.")
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import math
+import pathlib
+import re
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# Stored indexes are rebuilt when this changes, as their terms depend on `tokenize`
+TOKENIZER_VERSION = "2"
+
+STOPWORDS = set([
+	"a", "an", "and", "are", "as", "at", "be", "by", "can", "de", "describe", "do", "each", "explain", "for",
+	"from", "give", "has", "have", "how", "in", "into", "is", "it", "its", "of", "on", "one", "or", "show",
+	"state", "that", "the", "their", "this", "to", "two", "understanding", "use", "used", "using", "was",
+	"what", "when", "which", "why", "will", "with", "write", "you", "your",
+])
+
+def stem_token(token: str) -> str:
+	"""
+	Strips the most common English suffixes, so that e.g. "searching" and "search" match.
+	A final "s" is kept after "ss", "us" and "is", which are not plurals.
+
+	Examples
+	--------
+	>>> stem_token("process") == stem_token("processes") == "process"
+	True
+	>>> [stem_token(token) for token in ["searching", "queries", "status", "analysis"]]
+	['search', 'query', 'status', 'analysis']
+	"""
+	for suffix in ("ing", "ies", "es", "ed", "s"):
+		if suffix == "s" and token.endswith(("ss", "us", "is")):
+			continue
+		if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+			return token[:-len(suffix)] + ("y" if suffix == "ies" else "")
+	return token
+
+def tokenize(text: str) -> list[str]:
+	"""
+	Splits a text into lower-cased, stemmed terms, without stop words.
+	"""
+	return [stem_token(token) for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+def syllabus_hash(points: list[dict]) -> str:
+	"""
+	Computes a fingerprint of the syllabus points and of the tokenizer, used to detect
+	syllabus changes.
+	"""
+	canonical = json.dumps([TOKENIZER_VERSION, [[point["id"], point["description"]] for point in points]], ensure_ascii=False)
+	return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class SyllabusSearchIndex:
+	"""
+	A BM25 index over the descriptions of the syllabus points.
+
+	Args:
+		points (list[dict]): The syllabus points, each with an `id` and a `description`.
+		k1 (float, optional): The BM25 term frequency saturation parameter.
+		b (float, optional): The BM25 length normalisation parameter.
+	"""
+
+	def __init__(self, points: list[dict], k1: float = 1.5, b: float = 0.75):
+		self.k1 = k1
+		self.b = b
+		self.fingerprint = syllabus_hash(points)
+		self.ids = [point["id"] for point in points]
+		self.lengths = []
+		self.postings = {}
+
+		for (doc, point) in enumerate(points):
+			terms = tokenize(point["description"])
+			self.lengths.append(len(terms))
+			counts = {}
+			for term in terms:
+				counts[term] = counts.get(term, 0) + 1
+			for (term, count) in counts.items():
+				self.postings.setdefault(term, []).append((doc, count))
+
+		self._prepare()
+
+	def _prepare(self):
+		count = len(self.ids)
+		self.average_length = (sum(self.lengths) / count) if count else 0
+		self.idf = {
+			term: math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+			for (term, posting) in self.postings.items()
+		}
+
+	def score(self, text: str) -> dict[str, float]:
+		"""
+		Scores every syllabus point against a text.
+
+		Returns:
+			dict[str, float]: The BM25 score of each syllabus id with a non-zero score.
+		"""
+		scores = {}
+		for term in set(tokenize(text)):
+			if term not in self.postings:
+				continue
+			idf = self.idf[term]
+			for (doc, count) in self.postings[term]:
+				norm = self.k1 * (1 - self.b + self.b * self.lengths[doc] / (self.average_length or 1))
+				scores[doc] = scores.get(doc, 0) + idf * count * (self.k1 + 1) / (count + norm)
+		return {self.ids[doc]: value for (doc, value) in scores.items()}
+
+	def shortlist(self, texts: list[str], top_k: int = 10, min_score: float = 1.0):
+		"""
+		Shortlists the candidate syllabus points of several texts (e.g. a batch of exercises).
+
+		Args:
+			texts (list[str]): The texts to find candidates for.
+			top_k (int, optional): The number of candidates kept per text.
+			min_score (float, optional): If the best candidate of any text scores below
+				this, the texts are considered too ambiguous to shortlist.
+
+		Returns:
+			set[str] | None: The union of the top candidates of every text, or None if the
+			full syllabus should be used instead.
+		"""
+		candidates = set()
+		for text in texts:
+			ranked = sorted(self.score(text).items(), key=lambda item: item[1], reverse=True)[:top_k]
+			if len(ranked) == 0 or ranked[0][1] < min_score:
+				return None
+			candidates.update(syllabus_id for (syllabus_id, _) in ranked)
+		return candidates
+
+	def to_dict(self) -> dict:
+		return {
+			"fingerprint": self.fingerprint,
+			"k1": self.k1,
+			"b": self.b,
+			"ids": self.ids,
+			"lengths": self.lengths,
+			"postings": self.postings,
+		}
+
+	@classmethod
+	def from_dict(cls, data: dict) -> "SyllabusSearchIndex":
+		index = cls.__new__(cls)
+		index.k1 = data["k1"]
+		index.b = data["b"]
+		index.fingerprint = data["fingerprint"]
+		index.ids = data["ids"]
+		index.lengths = data["lengths"]
+		index.postings = {term: [tuple(entry) for entry in posting] for (term, posting) in data["postings"].items()}
+		index._prepare()
+		return index
+
+def get_search_index_path(db_path: str) -> str:
+	"""
+	Returns the path of the search index stored next to a database, e.g.
+	`papers.syllabus-search.json` for `papers.db`.
+	"""
+	path = pathlib.Path(db_path)
+	return str(path.with_name(f"{path.stem}.syllabus-search.json"))
+
+def load_search_index(points: list[dict], path: str) -> SyllabusSearchIndex:
+	"""
+	Loads the search index stored at the given path, rebuilding (and storing) it if
+	it is missing or was built from a different syllabus.
+
+	Args:
+		points (list[dict]): The current syllabus points.
+		path (str): The path of the stored index.
+
+	Returns:
+		SyllabusSearchIndex: An index over the given syllabus points.
+	"""
+	index_file = pathlib.Path(path)
+	if index_file.exists():
+		try:
+			index = SyllabusSearchIndex.from_dict(json.loads(index_file.read_text()))
+			if index.fingerprint == syllabus_hash(points):
+				return index
+		except (json.JSONDecodeError, KeyError):
+			print("Warning: Rebuilding the unreadable syllabus search index " + path)
+
+	index = SyllabusSearchIndex(points)
+	index_file.write_text(json.dumps(index.to_dict()))
+	return index
+
+def exercise_search_text(exercise: dict) -> str:
+	"""
+	Returns the text of an exercise used to look up its syllabus candidates.
+	"""
+	return " ".join([exercise["stem"], *[str(option) for option in exercise.get("options") or []]])
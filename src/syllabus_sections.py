@@ -0,0 +1,168 @@
+import re
+
+# A Markdown heading, or a line opening a numbered topic, as found in syllabi converted
+# by pymupdf4llm: a heading or bold line ("## 4 Processor Fundamentals", "**4.2 Assembly
+# Language**"), or a plain line numbered with a subtopic ("4.2 Assembly Language"). Plain
+# lines numbered "1." or "1" are numbered list items, such as learning outcomes.
+HEADING_PATTERN = re.compile(r"^#{1,6}[ \t]")
+TOPIC_PATTERN = re.compile(r"^(?:#{1,6}[ \t]+(?:\*\*)?|\*\*)(\d{1,2}(?:\.\d{1,2}){0,2})\.?(?:\*\*)?[ \t]+(?:\*\*)?[A-Z]")
+PLAIN_TOPIC_PATTERN = re.compile(r"^(\d{1,2}(?:\.\d{1,2}){1,2})[ \t]+(?:\*\*)?[A-Z]")
+CODE_FENCE = "```"
+
+def get_topic_number(line: str):
+	"""
+	Returns:
+		str | None: The number of the topic opened by the line (e.g. "4.2"), if any.
+
+	Examples
+	--------
+	>>> get_topic_number("## 4 Processor Fundamentals")
+	'4'
+	>>> get_topic_number("**4.2 Assembly Language**")
+	'4.2'
+	>>> get_topic_number("4.2 Assembly Language")
+	'4.2'
+	>>> get_topic_number("1. Show understanding of the basic Von Neumann model") is None
+	True
+	>>> get_topic_number("2 Describe the stored program concept") is None
+	True
+	"""
+	stripped = line.strip()
+	match = TOPIC_PATTERN.match(stripped) or PLAIN_TOPIC_PATTERN.match(stripped)
+	return match.group(1) if match is not None else None
+
+def split_units(markdown: str) -> list[dict]:
+	"""
+	Splits a syllabus at its headings and topic lines (outside code blocks).
+
+	Returns:
+		list[dict]: The units in document order, each with the `topic` number it opens
+		(or None) and its `text`.
+	"""
+	units = [{"topic": None, "text": ""}]
+	in_code = False
+	for line in markdown.splitlines(keepends=True):
+		stripped = line.strip()
+		if stripped.startswith(CODE_FENCE):
+			in_code = not in_code
+		elif not in_code and (HEADING_PATTERN.match(stripped) or get_topic_number(stripped) is not None):
+			units.append({"topic": get_topic_number(stripped), "text": ""})
+		units[-1]["text"] += line
+	return [unit for unit in units if unit["text"].strip()]
+
+def split_paragraphs(text: str, max_chars: int) -> list[str]:
+	"""
+	Splits a text larger than `max_chars` at blank lines into parts of about `max_chars`.
+	"""
+	parts = [""]
+	for paragraph in re.split(r"(?<=\n\n)", text):
+		if parts[-1] and len(parts[-1]) + len(paragraph) > max_chars:
+			parts.append("")
+		parts[-1] += paragraph
+	return parts
+
+def split_sections(markdown: str, max_chars: int = 12000, split_large: bool = False) -> list[dict]:
+	"""
+	Splits a syllabus into sections of about `max_chars` characters, made of whole
+	units (see `split_units`), so that each section fits in a single LLM response.
+
+	Args:
+		markdown (str): The syllabus.
+		max_chars (int, optional): The target size of a section.
+		split_large (bool, optional): Whether units larger than `max_chars` are split
+			further at blank lines. Otherwise they get a section of their own, which
+			keeps the knowledge points of a topic together.
+
+	Returns:
+		list[dict]: The sections in document order, each with:
+
+			- topics (list[str]): The topic numbers opened in the section.
+			- context (list[str]): The opening lines of the numbered topics enclosing the
+			  start of the section, e.g. `["## 4 Processor Fundamentals"]`.
+			- text (str): The Markdown of the section.
+
+	Examples
+	--------
+	The learning outcomes of a topic, numbered as a list, are numbered under it:
+
+	>>> markdown = "## 4 Processor Fundamentals\\n\\n### 4.1 Central Processing Unit\\n\\n1. Show understanding of registers\\n\\n2. Describe the buses\\n\\n3. Explain the fetch-execute cycle\\n"
+	>>> [(section["topics"], section["context"]) for section in split_sections(markdown, max_chars=60, split_large=True)]
+	[(['4'], []), (['4.1'], ['## 4 Processor Fundamentals']), ([], ['## 4 Processor Fundamentals', '### 4.1 Central Processing Unit']), ([], ['## 4 Processor Fundamentals', '### 4.1 Central Processing Unit'])]
+	"""
+	sections = []
+	enclosing = []
+	for unit in split_units(markdown):
+		if unit["topic"] is not None:
+			depth = unit["topic"].count(".")
+			enclosing = [(d, line) for (d, line) in enclosing if d < depth]
+		texts = split_paragraphs(unit["text"], max_chars) if split_large else [unit["text"]]
+		for (i, text) in enumerate(texts):
+			topic = unit["topic"] if i == 0 else None
+			if sections and len(sections[-1]["text"]) + len(text) <= max_chars:
+				sections[-1]["text"] += text
+				if topic is not None:
+					sections[-1]["topics"].append(topic)
+			else:
+				# The parts of a split unit continue its topic
+				context = [line for (_, line) in enclosing] + ([texts[0].strip().splitlines()[0]] if i > 0 and unit["topic"] is not None else [])
+				sections.append({"topics": [topic] if topic is not None else [], "context": context, "text": text})
+
+		if unit["topic"] is not None:
+			enclosing.append((depth, unit["text"].strip().splitlines()[0]))
+	return sections
+
+def get_context_prefix(section: dict) -> str:
+	"""
+	Returns the enclosing topic lines of a section that it does not already contain,
+	to be sent before it so that its knowledge points are numbered under them.
+	"""
+	lines = [line for line in section["context"] if line not in section["text"]]
+	return "\n\n".join(lines) + "\n\n" if lines else ""
+
+def stitch_markdown(parts: list[str]) -> str:
+	"""
+	Joins refined sections, dropping the lines a section repeats from the end of the
+	previous one (e.g. a heading restated at the start of a section).
+	"""
+	lines = []
+	for part in parts:
+		part_lines = part.strip("\n").splitlines()
+		previous = [line for line in lines if line.strip()]
+		current = [line for line in part_lines if line.strip()]
+		overlap = 0
+		for size in range(min(len(previous), len(current), 10), 0, -1):
+			if [line.strip() for line in previous[-size:]] == [line.strip() for line in current[:size]]:
+				overlap = size
+				break
+		# Skip the repeated non-blank lines, and the blank lines around them
+		skipped = 0
+		while overlap and part_lines:
+			if part_lines[0].strip():
+				skipped += 1
+			part_lines.pop(0)
+			if skipped == overlap:
+				break
+		while part_lines and not part_lines[0].strip():
+			part_lines.pop(0)
+		if lines and part_lines:
+			lines.append("")
+		lines.extend(part_lines)
+	return "\n".join(lines) + "\n"
+
+def get_id_key(point_id: str):
+	"""
+	Sorts syllabus ids in numeric order ("2.10.1" after "2.9.3"), ids with other parts last.
+	"""
+	parts = str(point_id).split(".")
+	return (0, [int(part) for part in parts]) if all(part.isdigit() for part in parts) else (1, parts)
+
+def stitch_points(results: list[list[dict]]) -> list[dict]:
+	"""
+	Merges the knowledge points indexed from each section in id order. A point indexed
+	by two sections (e.g. at a section boundary) is kept once, as first indexed.
+	"""
+	points = {}
+	for result in results:
+		for point in result:
+			points.setdefault(str(point["id"]), point)
+	return [points[point_id] for point_id in sorted(points, key=get_id_key)]
@@ -0,0 +1,115 @@
+import random
+
+WORDS = [
+	"algorithm", "array", "binary", "bit", "byte", "cache", "compiler", "data", "database", "file",
+	"function", "graph", "hardware", "integer", "interrupt", "key", "list", "logic", "loop", "memory",
+	"network", "node", "packet", "pointer", "process", "processor", "program", "protocol", "queue", "record",
+	"recursion", "register", "search", "sort", "stack", "string", "table", "tree", "value", "variable",
+]
+
+VERBS = ["describe", "explain", "state", "write", "identify", "calculate", "complete", "compare", "show", "outline"]
+
+SESSIONS = ["s", "w", "m"]
+
+def generate_sentence(rng: random.Random, length: int) -> str:
+	words = [rng.choice(WORDS) for _ in range(length)]
+	return (" ".join(words)).capitalize()
+
+def generate_syllabus(topics: int = 12, subtopics: int = 6, points: int = 4, seed: int = 0) -> list[dict]:
+	"""
+	Generates a syllabus index with the `X.Y.Z` ids of the syllabus index prompt.
+
+	Args:
+		topics (int, optional): The number of topics.
+		subtopics (int, optional): The number of subtopics per topic.
+		points (int, optional): The number of knowledge points per subtopic.
+		seed (int, optional): The seed of the generator.
+
+	Returns:
+		list[dict]: The syllabus points, each with an `id` and a `description`.
+	"""
+	rng = random.Random(seed)
+	return [
+		{
+			"id": f"{topic}.{subtopic}.{point}",
+			"description": f"{rng.choice(VERBS).capitalize()} {generate_sentence(rng, rng.randint(4, 12)).lower()}",
+		}
+		for topic in range(1, topics + 1)
+		for subtopic in range(1, subtopics + 1)
+		for point in range(1, points + 1)
+	]
+
+def generate_stem(rng: random.Random, exercise_id: str) -> str:
+	"""
+	Generates a Markdown stem using the constructs found in extracted exercises:
+	special LaTeX characters, math, lists, tables, code blocks and the custom tags.
+	"""
+	parts = [f"{generate_sentence(rng, rng.randint(8, 30))}, using 50% of the $x_1$ & {{y}} #{rng.randint(1, 9)}."]
+	kind = rng.random()
+	if kind < 0.2:
+		parts.append("\n".join(f"- {generate_sentence(rng, rng.randint(3, 8))}" for _ in range(rng.randint(2, 5))))
+	elif kind < 0.35:
+		columns = rng.randint(2, 4)
+		rows = [" | ".join(rng.choice(WORDS) for _ in range(columns)) for _ in range(rng.randint(2, 6))]
+		parts.append("\n".join([f"| {rows[0]} |", "|" + "---|" * columns] + [f"| {row} |" for row in rows[1:]]))
+	elif kind < 0.5:
+		lines = [f"{rng.choice(WORDS)} = {rng.choice(WORDS)}[{rng.randint(0, 9)}]" for _ in range(rng.randint(2, 8))]
+		parts.append("```\n" + "\n".join(lines) + '\n<answer-area size="2"/>\n```')
+	elif kind < 0.6:
+		parts.append(f'<figure description="{generate_sentence(rng, 5)}" id="{exercise_id}-fig"/>')
+	elif kind < 0.7:
+		parts.append(f"$$\n\\frac{{{rng.randint(1, 99)}}}{{{rng.randint(1, 99)}}} + x^{rng.randint(2, 9)}\n$$")
+	parts.append(f"{rng.choice(VERBS).capitalize()} {generate_sentence(rng, rng.randint(4, 12)).lower()}. **[{rng.randint(1, 8)}]**")
+	if rng.random() < 0.7:
+		parts.append(f'<answer-area size="{rng.randint(1, 6)}"/>')
+	return "\n\n".join(parts)
+
+def generate_papers(exercise_count: int, syllabus: list[dict], exercises_per_paper: int = 40, matchings_per_exercise: int = 3, seed: int = 0):
+	"""
+	Generates past papers with exercises and their syllabus matchings, lazily, so
+	that corpora of any size can be produced in constant memory.
+
+	Args:
+		exercise_count (int): The total number of exercises.
+		syllabus (list[dict]): The syllabus points the exercises are matched against.
+		exercises_per_paper (int, optional): The number of exercises of each paper.
+		matchings_per_exercise (int, optional): The maximum number of syllabus points
+			each exercise is matched to.
+		seed (int, optional): The seed of the generator.
+
+	Yields:
+		dict: One paper in the format of `db_writer.write_paper`, without a PDF file.
+	"""
+	rng = random.Random(seed)
+	syllabus_ids = [point["id"] for point in syllabus]
+	generated = 0
+	paper = 0
+	while generated < exercise_count:
+		# 2700 distinct sessions and components, then variants of them
+		(variant, index) = divmod(paper, 2700)
+		time_id = f"{SESSIONS[(index // 10) % len(SESSIONS)]}{10 + index // 30:02d}"
+		component = f"{11 + index % 10}" + (f"v{variant}" if variant else "")
+		origin = f"9618_{time_id}_qp_{component}.pdf"
+		prefix = f"9618-{time_id}-{component}"
+
+		exercises = []
+		matchings = []
+		for question in range(1, min(exercises_per_paper, exercise_count - generated) + 1):
+			exercise_id = f"{prefix}-{question}-{rng.choice('abcd')}"
+			exercises.append({
+				"id": exercise_id,
+				"stem": generate_stem(rng, exercise_id),
+				"options": [generate_sentence(rng, 4) for _ in range(4)] if rng.random() < 0.3 else None,
+				"figures": [],
+				"origin": origin,
+			})
+			for syllabus_id in rng.sample(syllabus_ids, rng.randint(1, matchings_per_exercise)):
+				matchings.append({
+					"question-id": exercise_id,
+					"syllabus-id": syllabus_id,
+					"relevance": round(rng.uniform(0.1, 1.0), 2),
+				})
+
+		generated += len(exercises)
+		paper += 1
+		yield {"origin": origin, "exercises": exercises, "matchings": matchings}
@@ -1,11 +1,91 @@
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletion
+import functools
+import hashlib
+import json
 import os
 import pathlib
+import time
 
+from llm_cache import LLMCache, request_key
+from llm_telemetry import record_call, record_response
+from llm_throttle import LLMThrottle
+
+llm_cache: LLMCache = None
+llm_throttle: LLMThrottle = None
+
+def set_llm_cache(cache: LLMCache):
+	"""
+	Installs the response cache used by `llm_chat` and `llm_chat_async`.
+
+	Parameters
+	----------
+	cache : LLMCache
+		The cache to use, or None to disable caching.
+	"""
+	global llm_cache
+	llm_cache = cache
+
+def set_llm_throttle(throttle: LLMThrottle):
+	"""
+	Installs the throttle shared by `llm_chat`, `llm_chat_stream`, `llm_chat_async`
+	and `llm_chat_stream_async`.
+
+	Parameters
+	----------
+	throttle : LLMThrottle
+		The throttle to use, or None to send requests unthrottled.
+	"""
+	global llm_throttle
+	llm_throttle = throttle
+
+def _prepare_client(client):
+	return llm_throttle.prepare_client(client) if llm_throttle is not None else client
+
+def _estimate_prompt_tokens(messages: list[dict[str, str]]) -> int:
+	return sum(len(message["content"] or "") for message in messages) // 4 + 1
+
+def _cached_response(model: str, messages: list[dict[str, str]], response_format: dict, max_tokens: int, validate=None):
+	if llm_cache is None:
+		return (None, None)
+	key = request_key(model, messages, response_format, max_tokens)
+	cached = llm_cache.get(key)
+	if cached is None:
+		return (key, None)
+	cached = ChatCompletion.model_validate_json(cached)
+	# A response cached before it was validated is requested again, and replaced
+	return (key, cached if _is_valid(cached, validate) else None)
+
+def _is_valid(response, validate) -> bool:
+	if validate is None:
+		return True
+	try:
+		validate(response.choices[0].message.content)
+	except Exception:
+		return False
+	return True
+
+def _is_complete(response, json_enabled: bool, validate=None) -> bool:
+	# Cut off or invalid responses are not cached, so that a retry can recover from them
+	if not response.choices or response.choices[0].finish_reason != "stop":
+		return False
+	if json_enabled:
+		try:
+			json.loads(response.choices[0].message.content or "")
+		except ValueError:
+			return False
+	return _is_valid(response, validate)
+
+def _store_response(key: str, model: str, response, json_enabled: bool, validate=None):
+	if llm_cache is not None and _is_complete(response, json_enabled, validate):
+		llm_cache.put(key, model, response.model_dump_json())
+
+@functools.lru_cache(maxsize=None)
 def read_sql_file(path: str) -> str:
     """
     Reads the content of an SQL file from the specified path and returns it as a string.
+    The content is read once and cached for the lifetime of the process.
 
     Args:
             path (str): The file path to the SQL file.
@@ -15,7 +95,7 @@ def read_sql_file(path: str) -> str:
     """
     return pathlib.Path(path).read_text()
 
-def llm_chat(model: str, client: OpenAI, messages: list[dict[str, str]], json_enabled=True, max_tokens=2048):
+def llm_chat(model: str, client: OpenAI, messages: list[dict[str, str]], json_enabled=True, max_tokens=2048, validate=None):
 	"""
 	Interact with an OpenAI LLM model using the chat API.
 
@@ -34,20 +114,247 @@ def llm_chat(model: str, client: OpenAI, messages: list[dict[str, str]], json_en
 	max_tokens : int, optional
 		The maximum number of tokens to generate in the response. The default is
 		2048.
+	validate : callable, optional
+		Called with the content of the response, raising if the caller would reject
+		it. A rejected response is neither cached nor served from the cache, so that
+		retrying the same request sends it again.
+
+	Returns
+	-------
+	dict
+		The response from the LLM, in JSON format if json_enabled is True.
+		Identical requests are served from the response cache, if one is installed
+		with `set_llm_cache`. Only complete responses (and, with json_enabled, valid
+		JSON accepted by `validate`) are cached. Every call is recorded by the telemetry recorder, if
+		one is installed with `llm_telemetry.set_telemetry`. Requests are paced and
+		retried on transient errors by the throttle, if one is installed with
+		`set_llm_throttle`.
+	"""
+	response_format = {"type": "json_object"} if json_enabled else None
+	started = time.perf_counter()
+	(key, cached) = _cached_response(model, messages, response_format, max_tokens, validate)
+	if cached is not None:
+		record_response(model, started, cached, cached=True)
+		return cached
+
+	def request():
+		started = time.perf_counter()
+		try:
+			response = _prepare_client(client).chat.completions.create(
+				model = model,
+				messages = messages,
+				response_format = response_format,
+				stream = False,
+				temperature=1,
+				max_tokens=max_tokens
+			)
+		except Exception as e:
+			record_call(model, started, "error", error=e)
+			raise
+		record_response(model, started, response)
+		return response
+
+	if llm_throttle is not None:
+		response = llm_throttle.run(request, _estimate_prompt_tokens(messages))
+	else:
+		response = request()
+	_store_response(key, model, response, json_enabled, validate)
+	return response
+
+def llm_chat_stream(model: str, client: OpenAI, messages: list[dict[str, str]], json_enabled=True, max_tokens=2048):
+	"""
+	Interact with an OpenAI LLM model using the chat API, streaming the response.
+
+	Streamed responses are not cached. The call is recorded once the stream ends,
+	with the time to the first token.
+
+	Parameters
+	----------
+	model : str
+		The name of the LLM model to use.
+	client : OpenAI
+		An OpenAI client object.
+	messages : list of dict
+		A list of messages to send to the LLM, in the format expected by the
+		OpenAI chat API.
+	json_enabled : bool, optional
+		If True, the response will be in JSON format. The default is True.
+	max_tokens : int, optional
+		The maximum number of tokens to generate in the response. The default is
+		2048.
+
+	Yields
+	------
+	tuple of (str, str)
+		The next piece of the content, and the finish reason of the response (None
+		until the last chunk).
+	"""
+	started = time.perf_counter()
+	time_to_first_token = None
+	finish_reason = None
+	usage = None
+	content = ""
+	outcome = "error"
+	error = None
+	held = False
+
+	def request():
+		return _prepare_client(client).chat.completions.create(
+			model = model,
+			messages = messages,
+			response_format = {"type": "json_object"} if json_enabled else None,
+			stream = True,
+			# The token usage of a stream comes in a last chunk without choices
+			stream_options = {"include_usage": True},
+			temperature=1,
+			max_tokens=max_tokens
+		)
+
+	try:
+		if llm_throttle is not None:
+			# The concurrency slot is kept until the stream is read
+			stream = llm_throttle.run(request, _estimate_prompt_tokens(messages), hold=True)
+			held = True
+		else:
+			stream = request()
+		for chunk in stream:
+			usage = getattr(chunk, "usage", None) or usage
+			if len(chunk.choices) == 0:
+				continue
+			choice = chunk.choices[0]
+			if time_to_first_token is None and choice.delta.content:
+				time_to_first_token = time.perf_counter() - started
+			content += choice.delta.content or ""
+			finish_reason = choice.finish_reason or finish_reason
+			yield (choice.delta.content or "", choice.finish_reason)
+		outcome = "length" if finish_reason == "length" else "ok"
+	except GeneratorExit:
+		outcome = "abandoned"
+		raise
+	except Exception as e:
+		error = e
+		raise
+	finally:
+		if held:
+			llm_throttle.release("success" if outcome in ["ok", "length"] else "error")
+		prompt = "".join(message["content"] or "" for message in messages)
+		record_call(model, started, outcome, usage, finish_reason, time_to_first_token, True, error, prompt, content)
+
+async def llm_chat_stream_async(model: str, client: AsyncOpenAI, messages: list[dict[str, str]], json_enabled=True, max_tokens=2048):
+	"""
+	Asynchronous counterpart of `llm_chat_stream`, for use with an `AsyncOpenAI` client.
+
+	Yields
+	------
+	tuple of (str, str)
+		The next piece of the content, and the finish reason of the response (None
+		until the last chunk).
+	"""
+	started = time.perf_counter()
+	time_to_first_token = None
+	finish_reason = None
+	usage = None
+	content = ""
+	outcome = "error"
+	error = None
+	held = False
+
+	async def request():
+		return await _prepare_client(client).chat.completions.create(
+			model = model,
+			messages = messages,
+			response_format = {"type": "json_object"} if json_enabled else None,
+			stream = True,
+			stream_options = {"include_usage": True},
+			temperature=1,
+			max_tokens=max_tokens
+		)
+
+	try:
+		if llm_throttle is not None:
+			stream = await llm_throttle.run_async(request, _estimate_prompt_tokens(messages), hold=True)
+			held = True
+		else:
+			stream = await request()
+		async for chunk in stream:
+			usage = getattr(chunk, "usage", None) or usage
+			if len(chunk.choices) == 0:
+				continue
+			choice = chunk.choices[0]
+			if time_to_first_token is None and choice.delta.content:
+				time_to_first_token = time.perf_counter() - started
+			content += choice.delta.content or ""
+			finish_reason = choice.finish_reason or finish_reason
+			yield (choice.delta.content or "", choice.finish_reason)
+		outcome = "length" if finish_reason == "length" else "ok"
+	except GeneratorExit:
+		outcome = "abandoned"
+		raise
+	except Exception as e:
+		error = e
+		raise
+	finally:
+		if held:
+			llm_throttle.release("success" if outcome in ["ok", "length"] else "error")
+		prompt = "".join(message["content"] or "" for message in messages)
+		record_call(model, started, outcome, usage, finish_reason, time_to_first_token, True, error, prompt, content)
+
+async def llm_chat_async(model: str, client: AsyncOpenAI, messages: list[dict[str, str]], json_enabled=True, max_tokens=2048, validate=None):
+	"""
+	Asynchronous counterpart of `llm_chat`, for use with an `AsyncOpenAI` client.
+
+	Parameters
+	----------
+	model : str
+		The name of the LLM model to use.
+	client : AsyncOpenAI
+		An AsyncOpenAI client object.
+	messages : list of dict
+		A list of messages to send to the LLM, in the format expected by the
+		OpenAI chat API.
+	json_enabled : bool, optional
+		If True, the response will be in JSON format. The default is True.
+	max_tokens : int, optional
+		The maximum number of tokens to generate in the response. The default is
+		2048.
+	validate : callable, optional
+		See `llm_chat`.
 
 	Returns
 	-------
 	dict
 		The response from the LLM, in JSON format if json_enabled is True.
 	"""
-	return client.chat.completions.create(
-		model = model,
-		messages = messages,
-		response_format = {"type": "json_object"} if json_enabled else None,
-		stream = False,
-		temperature=1,
-		max_tokens=max_tokens
-	)
+	response_format = {"type": "json_object"} if json_enabled else None
+	started = time.perf_counter()
+	(key, cached) = _cached_response(model, messages, response_format, max_tokens, validate)
+	if cached is not None:
+		record_response(model, started, cached, cached=True)
+		return cached
+
+	async def request():
+		started = time.perf_counter()
+		try:
+			response = await _prepare_client(client).chat.completions.create(
+				model = model,
+				messages = messages,
+				response_format = response_format,
+				stream = False,
+				temperature=1,
+				max_tokens=max_tokens
+			)
+		except Exception as e:
+			record_call(model, started, "error", error=e)
+			raise
+		record_response(model, started, response)
+		return response
+
+	if llm_throttle is not None:
+		response = await llm_throttle.run_async(request, _estimate_prompt_tokens(messages))
+	else:
+		response = await request()
+	_store_response(key, model, response, json_enabled, validate)
+	return response
 
 def list_files(dir_path: str):
 	"""
@@ -65,6 +372,30 @@ def list_files(dir_path: str):
 	"""
 	return [os.path.join(dir_path, file) for file in os.listdir(dir_path) if (os.path.isfile(os.path.join(dir_path, file)))]
 
+def file_sha256(file_path: str, chunk_size: int = 1024 * 1024):
+	"""
+	Compute the SHA-256 digest of a file without loading it whole.
+
+	Parameters
+	----------
+	file_path : str
+		The path to the file.
+	chunk_size : int, optional
+		The number of bytes read at a time. The default is 1 MiB.
+
+	Returns
+	-------
+	str or None
+		The hex digest of the file, or None if the file does not exist.
+	"""
+	if not os.path.exists(file_path):
+		return None
+	digest = hashlib.sha256()
+	with open(file_path, "rb") as file:
+		for chunk in iter(lambda: file.read(chunk_size), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
 def get_filename_with_other_ext(file_name: str, extension_name: str):
 	"""
 	Replace the file extension of a file name with the given extension name.